@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Malformed EXIF files and a harness that checks none of them makes
+EXIF.process_file slow or memory hungry.
+
+Every file is parsed in its own process, once per mode (all tags printed,
+thumbnail=True, tags='timestamp'), under a wall clock and address space
+ceiling.  The worst offenders by time and by memory are listed, and the exit
+status is 1 if any run failed or went over a ceiling.
+
+Usage: python adversarial.py [OPTIONS]
+
+Options:
+-c DIR --corpus DIR     Use (or create) the corpus in DIR instead of a
+                        temporary one.
+-t SECS --time SECS     Wall clock ceiling per run (default 5).
+-m MB --memory MB       Address space ceiling per run (default 512).
+-n N --worst N          How many of the worst runs to list (default 10).
+-o FILE --output FILE   Save every run as JSON.
+"""
+
+import getopt
+import json
+import os
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'pic_timeline'))
+
+import EXIF
+from exif_corpus import build_exif, jpeg_wrap, find_entry, ASCII, LONG
+
+MODES = {'full': {},
+         'thumbnail': {'thumbnail': True},
+         'timestamp': {'tags': 'timestamp'}}
+
+# -----------------------------------------------------------------------------
+# Corpus
+# -----------------------------------------------------------------------------
+def tiff_header(endian='I', first_ifd=8):
+    p = '<' if endian == 'I' else '>'
+    return ('II*\x00' if endian == 'I' else 'MM\x00*') + struct.pack(p + 'L', first_ifd)
+
+def raw_ifd(entries, next_ifd, p='<'):
+    """IFD bytes from (tag, type, count, value/offset) tuples."""
+    return (struct.pack(p + 'H', len(entries)) +
+            ''.join(struct.pack(p + 'HHLL', *e) for e in entries) +
+            struct.pack(p + 'L', next_ifd))
+
+def patch_entry(tiff, tag, count=None, value=None, field_type=None):
+    """Overwrite parts of the first entry for tag in tiff."""
+    p = '<' if tiff[0] == 'I' else '>'
+    tiff = bytearray(tiff)
+    pos = find_entry(tiff, p, tag)
+    if field_type is not None:
+        struct.pack_into(p + 'H', tiff, pos + 2, field_type)
+    if count is not None:
+        struct.pack_into(p + 'L', tiff, pos + 4, count)
+    if value is not None:
+        struct.pack_into(p + 'L', tiff, pos + 8, value)
+    return str(tiff)
+
+def segment(marker, data):
+    return '\xFF' + chr(marker) + struct.pack('>H', len(data) + 2) + data
+
+def cases():
+    """Yield (name, file data) for every malformed file."""
+    good = build_exif('I', 'NIKON2', 'tiff')
+    good_m = build_exif('M', 'CANON', 'jpeg')
+
+    # huge counts
+    yield 'huge_count_ascii.tif', patch_entry(good, 0x0110, count=0xFFFFFFFF)
+    yield 'huge_count_short.tif', patch_entry(good, 0x0128, count=0x7FFFFFFF, value=16)
+    yield 'huge_count_ratio.tif', patch_entry(good, 0x011A, count=0x1FFFFFFF)
+    yield 'huge_count_undefined.jpg', jpeg_wrap(patch_entry(good_m, 0x927C, count=0xFFFFFFF0))
+    yield 'huge_strip_counts.tif', patch_entry(good, 0x0117, count=0x3FFFFFFF)
+    yield 'huge_strip_bytes.tif', patch_entry(good, 0x0117, count=1, value=0xFFFFFFF0)
+    yield 'huge_thumbnail_length.jpg', jpeg_wrap(patch_entry(good_m, 0x0202, value=0xFFFFFFF0))
+    yield 'huge_entry_count.tif', tiff_header() + struct.pack('<H', 0xFFFF) + '\x00' * 64
+    yield 'bad_field_types.tif', tiff_header() + raw_ifd(
+        [(0x010F, 0, 10, 100), (0x0110, 13, 10, 100), (0x0112, 0xFFFF, 1, 1)], 0)
+    yield 'offsets_past_eof.tif', tiff_header() + raw_ifd(
+        [(0x010F, ASCII, 100, 0x7FFFFFF0), (0x8769, LONG, 1, 0xFFFFFF00),
+         (0x8825, LONG, 1, 0x7FFFFFFF)], 0xFFFFFFF0)
+
+    # IFD loops
+    yield 'ifd_cycle_self.tif', tiff_header() + raw_ifd([(0x010F, ASCII, 4, 0x00434241)], 8)
+    yield 'ifd_cycle_two.tif', (tiff_header() +
+                                raw_ifd([(0x010F, ASCII, 4, 0x00434241)], 26) +
+                                raw_ifd([(0x010F, ASCII, 4, 0x00434241)], 8))
+    chain = tiff_header()
+    for i in range(50):
+        chain += raw_ifd([(0x010F, ASCII, 4, 0x00434241)], 8 + 18 * ((i + 1) % 50))
+    yield 'ifd_cycle_long.tif', chain
+    chain = tiff_header()
+    for i in range(20000):
+        chain += raw_ifd([(0x010F, ASCII, 4, 0x00434241)], 8 + 18 * (i + 1))
+    yield 'ifd_chain_20000.tif', chain + '\x00' * 4
+    yield 'exif_points_to_ifd0.tif', tiff_header() + raw_ifd(
+        [(0x8769, LONG, 1, 8), (0x8825, LONG, 1, 8)], 0)
+    yield 'makernote_points_to_ifd0.jpg', jpeg_wrap(
+        patch_entry(build_exif('M', 'CANON', None), 0x927C, value=8))
+
+    # truncated files
+    for ext, data in (('tif', good), ('jpg', jpeg_wrap(good_m))):
+        for cut in (4, 9, 15, 40, 100, 300, len(data) // 2, len(data) - 10):
+            yield 'truncated_%d.%s' % (cut, ext), data[:cut]
+
+    # JPEG segment walking
+    yield 'jpeg_zero_length_app.jpg', '\xFF\xD8\xFF\xE0\x00\x00' + '\x00' * 100
+    yield 'jpeg_length_one.jpg', '\xFF\xD8\xFF\xE1\x00\x01Exif\x00\x00' + '\x00' * 100
+    yield 'jpeg_no_markers.jpg', '\xFF\xD8' + 'garbage' * 1000
+    yield 'jpeg_only_soi.jpg', '\xFF\xD8'
+    yield 'jpeg_fill_bytes.jpg', '\xFF\xD8' + '\xFF' * 1000000
+    yield 'jpeg_many_comments.jpg', '\xFF\xD8' + segment(0xFE, '') * 100000 + segment(0xE1, 'Exif\x00\x00' + good_m)
+    yield 'jpeg_app1_too_long.jpg', '\xFF\xD8\xFF\xE1\xFF\xFFExif\x00\x00' + good_m[:1000]
+    yield 'jpeg_icc_64k.jpg', '\xFF\xD8' + segment(0xE2, 'ICC_PROFILE\x00' + '\x11' * 65500) * 40 + segment(0xE1, 'Exif\x00\x00' + good_m)
+    yield 'jpeg_exif_not_tiff.jpg', '\xFF\xD8' + segment(0xE1, 'Exif\x00\x00' + 'XX' + '\x00' * 100)
+
+    # PNG and WebP chunks
+    yield 'png_huge_chunk.png', EXIF.PNG_SIGNATURE + struct.pack('>L4s', 0xFFFFFFF0, 'tEXt') + '\x00' * 100
+    yield 'png_huge_exif.png', EXIF.PNG_SIGNATURE + struct.pack('>L4s', 0xFFFFFFF0, 'eXIf') + good[:200]
+    yield 'png_many_chunks.png', EXIF.PNG_SIGNATURE + (struct.pack('>L4s', 0, 'tEXt') + '\x00' * 4) * 100000
+    yield 'webp_huge_riff.webp', 'RIFF' + struct.pack('<L', 0xFFFFFFF0) + 'WEBP' + 'VP8X' + struct.pack('<L', 10) + '\x08' + '\x00' * 9 + 'EXIF' + struct.pack('<L', 0xFFFFFFF0) + good[:200]
+
+def generate(outdir):
+    """Write the corpus to outdir and return the file paths."""
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    paths = []
+    for name, data in cases():
+        path = os.path.join(outdir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        paths.append(path)
+    return paths
+
+# -----------------------------------------------------------------------------
+# Harness
+# -----------------------------------------------------------------------------
+def child(path, mode):
+    """Parse path in mode and print what it cost as JSON (child process)."""
+    result = {}
+    start = time.time()
+    try:
+        with open(path, 'rb') as f:
+            tags = EXIF.process_file(f, **MODES[mode])
+            for name, value in tags.items():
+                str(value)
+        result['tags'] = len(tags)
+        result['truncated'] = getattr(tags, 'truncated', False)
+    except Exception, e:
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+    result['seconds'] = time.time() - start
+    result['maxrss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    print json.dumps(result)
+
+def run_one(path, mode, max_seconds, max_mb):
+    """Run child() for path in a process with the ceilings set."""
+    def limit():
+        limit = max_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                             '--child', mode, path],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            preexec_fn=limit)
+    deadline = time.time() + max_seconds
+    while proc.poll() is None and time.time() < deadline:
+        time.sleep(0.01)
+    result = {'file': os.path.basename(path), 'mode': mode}
+    if proc.poll() is None:
+        proc.kill()
+        proc.wait()
+        result.update(failed='over %ss' % max_seconds, seconds=max_seconds)
+        return result
+    out, err = proc.communicate()
+    try:
+        result.update(json.loads(out.strip().splitlines()[-1]))
+    except (ValueError, IndexError):
+        result.update(failed='exit status %d: %s' % (
+            proc.returncode, (err.strip().splitlines() or [''])[-1]))
+        return result
+    if 'error' in result and result['error'].startswith('MemoryError'):
+        result['failed'] = 'over %d MB' % max_mb
+    return result
+
+def report(results, worst):
+    def show(title, key, unit):
+        print title
+        for r in sorted(results, key=lambda r: -r.get(key, 0))[:worst]:
+            print '  {:>9.3f} {}  {:<36} {:<10} {}'.format(
+                r.get(key, 0), unit, r['file'], r['mode'],
+                r.get('failed') or r.get('error') or '%d tags%s' % (
+                    r['tags'], ' (truncated)' if r['truncated'] else ''))
+    show('Slowest runs:', 'seconds', 's ')
+    show('Biggest runs:', 'maxrss_mb', 'MB')
+    failed = [r for r in results if 'failed' in r]
+    print '%d runs, %d over a ceiling or crashed' % (len(results), len(failed))
+    for r in failed:
+        print '  %s %s: %s' % (r['file'], r['mode'], r['failed'])
+    return failed
+
+def main(argv):
+    if argv[:1] == ['--child']:
+        child(argv[2], argv[1])
+        return 0
+    try:
+        opts, args = getopt.getopt(argv, 'hc:t:m:n:o:',
+                                   ['help', 'corpus=', 'time=', 'memory=',
+                                    'worst=', 'output='])
+    except getopt.GetoptError:
+        print __doc__.strip()
+        return 2
+    corpus = None
+    max_seconds = 5.0
+    max_mb = 512
+    worst = 10
+    output = None
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            print __doc__.strip()
+            return 0
+        if o in ('-c', '--corpus'):
+            corpus = a
+        if o in ('-t', '--time'):
+            max_seconds = float(a)
+        if o in ('-m', '--memory'):
+            max_mb = int(a)
+        if o in ('-n', '--worst'):
+            worst = int(a)
+        if o in ('-o', '--output'):
+            output = a
+
+    temp_dir = None
+    if corpus is None:
+        corpus = temp_dir = tempfile.mkdtemp()
+    try:
+        results = []
+        for path in generate(corpus):
+            for mode in sorted(MODES):
+                results.append(run_one(path, mode, max_seconds, max_mb))
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir)
+
+    failed = report(results, worst)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if failed:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
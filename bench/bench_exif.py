@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark EXIF.process_file on the synthetic corpus from exif_corpus.py.
+
+Each file format (jpeg, tiff) is parsed in three modes:
+  full       all tags, MakerNotes included, every value printed
+  quick      details=False, every value printed
+  timestamp  tags='timestamp', what the timeline import uses
+and for each the files/s are timed on real files (memory mapped where the
+parser does that), then bytes read, reads and seeks are counted on a second
+pass through a file wrapper (which can't be mapped, so this is the plain
+read path).
+
+Usage: python bench_exif.py [OPTIONS]
+
+Options:
+-c DIR --corpus DIR      Use (or create) the corpus in DIR instead of a
+                         temporary one.
+-r N --repeat N          Parse the corpus N times per timing (default 20).
+-o FILE --output FILE    Save the results as JSON.
+-b FILE --baseline FILE  Compare with results saved earlier.
+"""
+
+import getopt
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'pic_timeline'))
+
+import EXIF
+import exif_corpus
+
+MODES = [('full', {}),
+         ('quick', {'details': False}),
+         ('timestamp', {'tags': 'timestamp'})]
+
+# -----------------------------------------------------------------------------
+# class Counting_File
+#        File wrapper that counts what the parser asks of the file.
+# -----------------------------------------------------------------------------
+class Counting_File(object):
+    def __init__(self, f):
+        self.f = f
+        self.bytes_read = 0
+        self.reads = 0
+        self.seeks = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.reads += 1
+        self.bytes_read += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        old = self.f.tell()
+        self.f.seek(offset, whence)
+        # only count seeks that go somewhere
+        if self.f.tell() != old:
+            self.seeks += 1
+
+    def tell(self):
+        return self.f.tell()
+
+def parse(f, options):
+    """Parse f and look at every tag, so deferred work gets done too."""
+    tags = EXIF.process_file(f, **options)
+    for name, value in tags.items():
+        str(value)
+    return tags
+
+def file_format(path):
+    return {'.jpg': 'jpeg', '.tif': 'tiff'}[os.path.splitext(path)[1]]
+
+def run(paths, repeat):
+    """Return {format: {mode: result}} for the files in paths."""
+    results = {}
+    for fmt in sorted(set(file_format(p) for p in paths)):
+        files = [p for p in paths if file_format(p) == fmt]
+        results[fmt] = {}
+        for mode, options in MODES:
+            start = time.time()
+            for i in xrange(repeat):
+                for path in files:
+                    with open(path, 'rb') as f:
+                        parse(f, options)
+            seconds = time.time() - start
+            counted = {'bytes_read': 0, 'reads': 0, 'seeks': 0}
+            for path in files:
+                with open(path, 'rb') as f:
+                    wrapper = Counting_File(f)
+                    parse(wrapper, options)
+                    for name in counted:
+                        counted[name] += getattr(wrapper, name)
+            result = {'files': len(files) * repeat,
+                      'seconds': round(seconds, 4),
+                      'files_per_s': round(len(files) * repeat / seconds, 1)}
+            for name, total in counted.items():
+                result[name + '_per_file'] = round(float(total) / len(files), 1)
+            results[fmt][mode] = result
+    return results
+
+def report(results, baseline=None):
+    print '{:<6} {:<10} {:>10} {:>10} {:>8} {:>8}'.format(
+        'format', 'mode', 'files/s', 'bytes/file', 'reads', 'seeks'),
+    if baseline:
+        print '{:>10}'.format('vs base'),
+    print
+    for fmt in sorted(results):
+        for mode, options in MODES:
+            r = results[fmt][mode]
+            print '{:<6} {:<10} {:>10.1f} {:>10.1f} {:>8.1f} {:>8.1f}'.format(
+                fmt, mode, r['files_per_s'], r['bytes_read_per_file'],
+                r['reads_per_file'], r['seeks_per_file']),
+            if baseline:
+                try:
+                    old = baseline['results'][fmt][mode]['files_per_s']
+                    print '{:>9.2f}x'.format(r['files_per_s'] / old),
+                except (KeyError, ZeroDivisionError):
+                    print '{:>10}'.format('-'),
+            print
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, 'hc:r:o:b:',
+                                   ['help', 'corpus=', 'repeat=', 'output=',
+                                    'baseline='])
+    except getopt.GetoptError:
+        print __doc__.strip()
+        return 2
+    corpus = None
+    repeat = 20
+    output = None
+    baseline = None
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            print __doc__.strip()
+            return 0
+        if o in ('-c', '--corpus'):
+            corpus = a
+        if o in ('-r', '--repeat'):
+            repeat = int(a)
+        if o in ('-o', '--output'):
+            output = a
+        if o in ('-b', '--baseline'):
+            with open(a) as f:
+                baseline = json.load(f)
+
+    temp_dir = None
+    if corpus is None:
+        corpus = temp_dir = tempfile.mkdtemp()
+    try:
+        paths = exif_corpus.generate(corpus)
+        results = run(paths, repeat)
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir)
+
+    report(results, baseline)
+    if output:
+        with open(output, 'w') as f:
+            json.dump({'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'repeat': repeat,
+                       'results': results}, f, indent=1, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
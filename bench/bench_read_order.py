@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Cold cache benchmark of the import's header reads (importer.Prefetcher) in
+listing order and in disk order, with and without posix_fadvise hints and
+O_NOATIME (see pic_timeline/diskio.py).
+
+The files are created in a shuffled order, so their names (the order the
+app lists them in) don't follow where they are on disk, like an archive
+that had photos deleted and added over the years.  Before each run the page
+cache is dropped: all of it when run as root, otherwise each file's pages
+with posix_fadvise, which leaves the inodes cached and so flatters the
+listing order a bit.  Create the files on the disk to test with -w, a
+temporary directory is often on another one.
+
+Usage: python bench_read_order.py [OPTIONS]
+
+Options:
+-w DIR --work DIR        Create the files in DIR instead of a temporary
+                         directory (they're removed afterwards).
+-d DIR --dir DIR         Read the image files under DIR (a real archive)
+                         instead of creating any.
+-n N --files N           Number of files to create (default 2000).
+-s KB --size KB          Size of each created file (default 512).
+-t N --threads N         Prefetch threads (default 8).
+-r N --repeat N          Runs of each setup, the fastest counts (default 3).
+-o FILE --output FILE    Save the results as JSON.
+"""
+
+import getopt
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'pic_timeline'))
+
+import diskio
+import exif_corpus
+from discover import find_images
+from importer import Prefetcher, DEF_PREFETCH_DEPTH
+
+# (name, read order, hints, noatime), the first is how reads were done before
+SETUPS = [('listing', diskio.ORDER_NONE, False, False),
+          ('inode', diskio.ORDER_INODE, False, False),
+          ('extent', diskio.ORDER_EXTENT, False, False),
+          ('auto+hints', diskio.ORDER_AUTO, True, True)]
+
+# -----------------------------------------------------------------------------
+# Files
+# -----------------------------------------------------------------------------
+def create_files(work_dir, count, size):
+    """Write count JPEGs of size bytes into work_dir in a shuffled order,
+    return their names sorted."""
+    corpus_dir = tempfile.mkdtemp()
+    try:
+        templates = []
+        for path in exif_corpus.generate(corpus_dir):
+            if path.endswith('.jpg'):
+                with open(path, 'rb') as f:
+                    templates.append(f.read())
+    finally:
+        shutil.rmtree(corpus_dir)
+    names = ['IMG_{:05d}.JPG'.format(i) for i in range(count)]
+    rng = random.Random(1)
+    shuffled = names[:]
+    rng.shuffle(shuffled)
+    for i, name in enumerate(shuffled):
+        data = templates[i % len(templates)]
+        # padding after the image, like the rest of a real photo
+        data += '\0' * max(size - len(data), 0)
+        with open(os.path.join(work_dir, name), 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+    return names
+
+def drop_caches(source_dir, names):
+    """Drop source_dir's files from the page cache, return how."""
+    subprocess.call(['sync'])
+    try:
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+        return 'all'
+    except IOError:
+        pass
+    if diskio.posix_fadvise is None:
+        return 'none'
+    for name in names:
+        try:
+            fd = os.open(os.path.join(source_dir, name), os.O_RDONLY)
+        except OSError:
+            continue
+        diskio.fadvise(fd, 0, 0, diskio.POSIX_FADV_DONTNEED)
+        os.close(fd)
+    return 'pages'
+
+# -----------------------------------------------------------------------------
+# Benchmark
+# -----------------------------------------------------------------------------
+def run(source_dir, names, threads, repeat):
+    """Return {setup: result} and how the cache was dropped."""
+    results = {}
+    dropped = None
+    for setup, order, hints, noatime in SETUPS:
+        best = None
+        for i in range(repeat):
+            dropped = drop_caches(source_dir, names)
+            prefetcher = Prefetcher(threads, DEF_PREFETCH_DEPTH, order, hints, noatime)
+            stats = {}
+            start = time.time()
+            count = 0
+            for item in prefetcher.prefetch(source_dir, names, stats=stats):
+                count += 1
+            seconds = time.time() - start
+            if best is None or seconds < best['seconds']:
+                best = {'files': count,
+                        'seconds': round(seconds, 4),
+                        'order_seconds': round(stats['order_seconds'], 4),
+                        'files_per_s': round(count / seconds, 1),
+                        'header_bytes': stats['bytes']}
+        results[setup] = best
+    return results, dropped
+
+def report(results, dropped):
+    if dropped == 'none':
+        print 'Warning: the page cache could not be dropped, these are warm reads'
+    elif dropped == 'pages':
+        print 'Page cache dropped per file (not root), inodes stayed cached'
+    print '{:<12} {:>10} {:>10} {:>10} {:>10}'.format(
+        'setup', 'files/s', 'seconds', 'ordering', 'vs listing')
+    base = results[SETUPS[0][0]]['seconds']
+    for setup, order, hints, noatime in SETUPS:
+        r = results[setup]
+        print '{:<12} {:>10.1f} {:>10.3f} {:>10.3f} {:>9.2f}x'.format(
+            setup, r['files_per_s'], r['seconds'], r['order_seconds'],
+            base / r['seconds'])
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, 'hw:d:n:s:t:r:o:',
+                                   ['help', 'work=', 'dir=', 'files=', 'size=',
+                                    'threads=', 'repeat=', 'output='])
+    except getopt.GetoptError:
+        print __doc__.strip()
+        return 2
+    work = None
+    source_dir = None
+    count = 2000
+    size = 512 * 1024
+    threads = 8
+    repeat = 3
+    output = None
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            print __doc__.strip()
+            return 0
+        if o in ('-w', '--work'):
+            work = a
+        if o in ('-d', '--dir'):
+            source_dir = a
+        if o in ('-n', '--files'):
+            count = int(a)
+        if o in ('-s', '--size'):
+            size = int(a) * 1024
+        if o in ('-t', '--threads'):
+            threads = int(a)
+        if o in ('-r', '--repeat'):
+            repeat = int(a)
+        if o in ('-o', '--output'):
+            output = a
+
+    temp_dir = None
+    try:
+        if source_dir is not None:
+            names = find_images(source_dir)[0]
+        else:
+            source_dir = temp_dir = tempfile.mkdtemp(dir=work)
+            names = create_files(source_dir, count, size)
+        results, dropped = run(source_dir, names, threads, repeat)
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir)
+
+    report(results, dropped)
+    if output:
+        with open(output, 'w') as f:
+            json.dump({'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'files': len(names),
+                       'threads': threads,
+                       'cache_dropped': dropped,
+                       'results': results}, f, indent=1, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
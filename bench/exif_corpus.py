@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Synthetic EXIF corpus for benchmarking (and eyeballing) EXIF.process_file.
+
+Builds TIFF files and JPEGs wrapping the same TIFF data, covering both byte
+orders, GPS and Interoperability IFDs, Nikon type 1/2, Canon, Olympus and
+Fujifilm MakerNotes and JPEG, uncompressed TIFF or no thumbnail.  Some JPEGs
+get a JFIF segment, an XMP segment or an ICC profile bigger than 64K in
+front of the EXIF segment.
+
+Usage: python exif_corpus.py OUTPUT_DIR
+"""
+
+import os
+import struct
+
+# TIFF field types
+BYTE, ASCII, SHORT, LONG, RATIONAL, UNDEFINED, SSHORT, SLONG, SRATIONAL = \
+    1, 2, 3, 4, 5, 7, 8, 9, 10
+TYPE_FMT = {BYTE: 'B', ASCII: 's', SHORT: 'H', LONG: 'L', RATIONAL: 'L',
+            UNDEFINED: 's', SSHORT: 'h', SLONG: 'l', SRATIONAL: 'l'}
+TYPE_LEN = {BYTE: 1, ASCII: 1, SHORT: 2, LONG: 4, RATIONAL: 8,
+            UNDEFINED: 1, SSHORT: 2, SLONG: 4, SRATIONAL: 8}
+
+# -----------------------------------------------------------------------------
+# TIFF building
+# -----------------------------------------------------------------------------
+class IFD(object):
+    """An IFD under construction.  Entries are (tag, type, value) where value
+    is a str for ASCII/UNDEFINED, a list of ints (or (num, den) pairs for
+    rationals), or another IFD/Blob which becomes a LONG pointer."""
+    def __init__(self, entries=None, next_ifd=None):
+        self.entries = list(entries or [])
+        self.next_ifd = next_ifd
+
+    def add(self, tag, field_type, value):
+        self.entries.append((tag, field_type, value))
+        return self
+
+    def has(self, tag):
+        return any(e[0] == tag for e in self.entries)
+
+    def set(self, tag, field_type, value):
+        for i, e in enumerate(self.entries):
+            if e[0] == tag:
+                self.entries[i] = (tag, field_type, value)
+                return
+        self.add(tag, field_type, value)
+
+
+class Blob(object):
+    """Raw data placed somewhere in the data area, pointer tags resolve to
+    its offset."""
+    def __init__(self, data):
+        self.data = data
+
+
+class TiffBuilder(object):
+    """Lays out IFDs and their data after a TIFF header."""
+    def __init__(self, endian='I'):
+        self.endian = endian
+        self.prefix = '<' if endian == 'I' else '>'
+
+    def pack(self, fmt, *args):
+        return struct.pack(self.prefix + fmt, *args)
+
+    def build(self, ifd0):
+        """Return TIFF bytes (starting with the byte order mark)."""
+        self.out = bytearray()
+        self.out += ('II*\x00' if self.endian == 'I' else 'MM\x00*')
+        self.out += self.pack('L', 8)
+        self.placed = {}
+        # objects laid out, kept alive so their ids stay unique
+        self.keep = []
+        self.fixups = []
+        self._place_ifd(ifd0)
+        while self.fixups:
+            pos, obj = self.fixups.pop(0)
+            self.keep.append(obj)
+            off = self._place(obj)
+            struct.pack_into(self.prefix + 'L', self.out, pos, off)
+        return str(self.out)
+
+    def _place(self, obj):
+        if id(obj) in self.placed:
+            return self.placed[id(obj)]
+        if isinstance(obj, IFD):
+            return self._place_ifd(obj)
+        if len(self.out) % 2:
+            self.out += '\x00'
+        off = len(self.out)
+        self.placed[id(obj)] = off
+        self.out += obj.data
+        return off
+
+    def _encode(self, field_type, value):
+        if field_type in (ASCII, UNDEFINED):
+            return value, len(value)
+        if field_type in (RATIONAL, SRATIONAL):
+            data = ''.join(self.pack(TYPE_FMT[field_type] * 2, n, d)
+                           for n, d in value)
+            return data, len(value)
+        return (self.pack('%d%s' % (len(value), TYPE_FMT[field_type]),
+                          *value), len(value))
+
+    def _place_ifd(self, ifd):
+        if len(self.out) % 2:
+            self.out += '\x00'
+        table = len(self.out)
+        self.placed[id(ifd)] = table
+        entries = sorted(ifd.entries, key=lambda e: e[0])
+        self.out += self.pack('H', len(entries))
+        self.out += '\x00' * (12 * len(entries) + 4)
+        for i, (tag, field_type, value) in enumerate(entries):
+            pos = table + 2 + 12 * i
+            if isinstance(value, (IFD, Blob)):
+                struct.pack_into(self.prefix + 'HHL', self.out, pos,
+                                 tag, LONG, 1)
+                self.fixups.append((pos + 8, value))
+                continue
+            data, count = self._encode(field_type, value)
+            struct.pack_into(self.prefix + 'HHL', self.out, pos,
+                             tag, field_type, count)
+            if len(data) <= 4:
+                self.out[pos + 8:pos + 8 + len(data)] = data
+            else:
+                self.fixups.append((pos + 8, Blob(data)))
+        if ifd.next_ifd is not None:
+            self.fixups.append((table + 2 + 12 * len(entries), ifd.next_ifd))
+        return table
+
+
+def build_at(endian, ifd, base):
+    """Lay out an IFD on its own so that its offsets are right when it
+    starts at base (relative to the enclosing TIFF header)."""
+    b = TiffBuilder(endian)
+    raw = bytearray(b.build(ifd))[8:]
+    p = b.prefix
+    n = struct.unpack_from(p + 'H', raw, 0)[0]
+    for i in range(n):
+        pos = 2 + 12 * i
+        tag, field_type, count = struct.unpack_from(p + 'HHL', raw, pos)
+        if count * TYPE_LEN.get(field_type, 1) > 4:
+            off = struct.unpack_from(p + 'L', raw, pos + 8)[0]
+            struct.pack_into(p + 'L', raw, pos + 8, off - 8 + base)
+    return str(raw)
+
+
+def find_entry(tiff, p, tag):
+    """Return the position of the first IFD entry for tag in tiff, looking
+    in the IFD chain and the EXIF, GPS and Interoperability IFDs."""
+    seen = set()
+    stack = [struct.unpack_from(p + 'L', tiff, 4)[0]]
+    while stack:
+        ifd = stack.pop(0)
+        if ifd in seen or not ifd:
+            continue
+        seen.add(ifd)
+        n = struct.unpack_from(p + 'H', tiff, ifd)[0]
+        for i in range(n):
+            pos = ifd + 2 + 12 * i
+            entry_tag = struct.unpack_from(p + 'H', tiff, pos)[0]
+            if entry_tag == tag:
+                return pos
+            if entry_tag in (0x8769, 0x8825, 0xA005):
+                stack.append(struct.unpack_from(p + 'L', tiff, pos + 8)[0])
+        stack.append(struct.unpack_from(p + 'L', tiff, ifd + 2 + 12 * n)[0])
+    raise KeyError(tag)
+
+
+def ascii(s):
+    return s + '\x00'
+
+
+def fake_jpeg(n=2000):
+    """SOI, filler and EOI, good enough for a thumbnail."""
+    body = ''.join(chr((i * 7) & 0xFF) for i in range(n))
+    return '\xFF\xD8' + body + '\xFF\xD9'
+
+# -----------------------------------------------------------------------------
+# EXIF layouts
+# -----------------------------------------------------------------------------
+MAKES = ('ACME', 'NIKON1', 'NIKON2', 'CANON', 'OLYMPUS', 'FUJIFILM')
+
+def makernote(make):
+    """Return (Make tag, MakerNote, label) for a vendor.  The MakerNote is
+    either raw bytes or an IFD that has to be laid out at its final offset
+    after label."""
+    if make == 'NIKON1':
+        ifd = IFD().add(0x0003, SHORT, [3]).add(0x0004, SHORT, [1]) \
+                   .add(0x0007, SHORT, [5])
+        return 'NIKON', ifd, 'Nikon\x00\x01\x00'
+    if make == 'NIKON2':
+        # labeled type 2: its own TIFF header, offsets relative to it
+        ifd = IFD().add(0x0002, SHORT, [0, 200]) \
+                   .add(0x0004, ASCII, ascii('FINE   ')) \
+                   .add(0x0007, ASCII, ascii('AF-S  ')) \
+                   .add(0x0012, UNDEFINED, '\x00\x01\x06\x00') \
+                   .add(0x0011, LONG, [0])
+        tiff = TiffBuilder('M').build(ifd)
+        return 'NIKON CORPORATION', 'Nikon\x00\x02\x10\x00\x00' + tiff, None
+    if make == 'CANON':
+        ifd = IFD().add(0x0001, SHORT, [92, 2, 0, 3] + [0] * 11) \
+                   .add(0x0004, SHORT, [68, 0, 160, 65471, 248, 148] + [0] * 14) \
+                   .add(0x0006, ASCII, ascii('IMG:PowerShot JPEG')) \
+                   .add(0x0008, LONG, [1001234])
+        return 'Canon', ifd, ''
+    if make == 'OLYMPUS':
+        ifd = IFD().add(0x0200, LONG, [0, 1, 0]).add(0x0201, SHORT, [2]) \
+                   .add(0x0202, SHORT, [1])
+        return 'OLYMPUS OPTICAL CO.,LTD', ifd, 'OLYMP\x00\x01\x00'
+    if make == 'FUJIFILM':
+        # 'FUJIFILM', offset of the IFD (12) and an Intel IFD whose offsets
+        # are relative to the start of the MakerNote
+        ifd = IFD().add(0x0000, UNDEFINED, '0130').add(0x1001, SHORT, [3]) \
+                   .add(0x1002, SHORT, [256]).add(0x1000, ASCII, ascii('NORMAL '))
+        return 'FUJIFILM', ('FUJIFILM' + struct.pack('<L', 12) +
+                            build_at('I', ifd, 12)), None
+    return 'ACME', None, None
+
+
+def build_exif(endian='I', make='ACME', thumb='jpeg', gps=True, interop=True,
+               datetime='2012:10:05 14:22:31', filler_tags=0):
+    """Return the TIFF data of an EXIF block."""
+    make_name, note, label = makernote(make)
+    exif = IFD().add(0x9003, ASCII, ascii('2012:10:05 14:22:30')) \
+                .add(0x9004, ASCII, ascii('2012:10:05 14:22:30')) \
+                .add(0x9291, ASCII, ascii('45')) \
+                .add(0x829A, RATIONAL, [(1, 250)]) \
+                .add(0x829D, RATIONAL, [(28, 10)]) \
+                .add(0x9204, SRATIONAL, [(-2, 3)]) \
+                .add(0x9000, UNDEFINED, '0230') \
+                .add(0x9286, UNDEFINED, 'ASCII\x00\x00\x00hello world') \
+                .add(0xA002, LONG, [4000]).add(0xA003, LONG, [3000])
+    if interop:
+        exif.add(0xA005, LONG, IFD().add(0x0001, ASCII, ascii('R98'))
+                                    .add(0x0002, UNDEFINED, '0100'))
+    for i in range(filler_tags):
+        exif.add(0xC000 + i, SHORT, [i, i + 1, i + 2])
+    ifd0 = IFD().add(0x010F, ASCII, ascii(make_name)) \
+                .add(0x0110, ASCII, ascii('Synth Model 1')) \
+                .add(0x0112, SHORT, [1]) \
+                .add(0x011A, RATIONAL, [(72, 1)]) \
+                .add(0x011B, RATIONAL, [(72, 1)]) \
+                .add(0x0128, SHORT, [2]) \
+                .add(0x0131, ASCII, ascii('SynthFirmware v1.0'))
+    if datetime:
+        ifd0.add(0x0132, ASCII, ascii(datetime))
+    ifd0.add(0x8769, LONG, exif)
+    if gps:
+        ifd0.add(0x8825, LONG, IFD().add(0x0000, BYTE, [2, 2, 0, 0])
+                                    .add(0x0001, ASCII, ascii('N'))
+                                    .add(0x0002, RATIONAL, [(37, 1), (46, 1), (3012, 100)])
+                                    .add(0x0003, ASCII, ascii('W'))
+                                    .add(0x0004, RATIONAL, [(122, 1), (25, 1), (1, 3)])
+                                    .add(0x001D, ASCII, ascii('2012:10:05')))
+    strips = None
+    if thumb == 'jpeg':
+        jpg = Blob(fake_jpeg())
+        ifd0.next_ifd = IFD().add(0x0103, SHORT, [6]) \
+                             .add(0x011A, RATIONAL, [(72, 1)]) \
+                             .add(0x0201, LONG, jpg) \
+                             .add(0x0202, LONG, [len(jpg.data)])
+    elif thumb == 'tiff':
+        w, h, rows = 16, 12, 4
+        strips = [''.join(chr((s * 31 + i) & 0xFF) for i in range(w * 3 * rows))
+                  for s in range(h // rows)]
+        # StripOffsets are filled in once the strips are placed
+        ifd0.next_ifd = IFD().add(0x0100, SHORT, [w]).add(0x0101, SHORT, [h]) \
+                             .add(0x0102, SHORT, [8, 8, 8]).add(0x0103, SHORT, [1]) \
+                             .add(0x0106, SHORT, [2]).add(0x0111, LONG, [0] * len(strips)) \
+                             .add(0x0115, SHORT, [3]).add(0x0116, SHORT, [rows]) \
+                             .add(0x0117, LONG, [len(s) for s in strips])
+
+    b = TiffBuilder(endian)
+    if isinstance(note, IFD):
+        # build once with a placeholder to find where the MakerNote lands,
+        # then lay its IFD out for that offset
+        body_len = len(TiffBuilder(endian).build(note)) - 8
+        placeholder = label + '\xA5' * body_len
+        exif.set(0x927C, UNDEFINED, placeholder)
+        tiff = bytearray(b.build(ifd0))
+        ifd_off = str(tiff).find(placeholder) + len(label)
+        body = build_at(endian, note, ifd_off)
+        tiff[ifd_off:ifd_off + len(body)] = body
+        tiff = str(tiff)
+    else:
+        if note is not None:
+            exif.add(0x927C, UNDEFINED, note)
+        tiff = b.build(ifd0)
+
+    if strips:
+        tiff = bytearray(tiff)
+        offsets = []
+        for strip in strips:
+            offsets.append(len(tiff))
+            tiff += strip
+        p = b.prefix
+        pos = find_entry(tiff, p, 0x0111)
+        data_off = struct.unpack_from(p + 'L', tiff, pos + 8)[0]
+        struct.pack_into(p + '%dL' % len(offsets), tiff, data_off, *offsets)
+        tiff = str(tiff)
+    return tiff
+
+
+def jpeg_wrap(tiff, jfif=True, icc=0, xmp=False):
+    """Return a JPEG file with tiff in its EXIF segment."""
+    out = '\xFF\xD8'
+    if jfif:
+        app0 = 'JFIF\x00\x01\x01\x00\x00\x48\x00\x48\x00\x00'
+        out += '\xFF\xE0' + struct.pack('>H', len(app0) + 2) + app0
+    if xmp:
+        x = 'http://ns.adobe.com/xap/1.0/\x00<x:xmpmeta/>'
+        out += '\xFF\xE1' + struct.pack('>H', len(x) + 2) + x
+    remaining = icc
+    while remaining > 0:
+        chunk = min(remaining, 65000)
+        data = 'ICC_PROFILE\x00\x01\x01' + '\x11' * chunk
+        out += '\xFF\xE2' + struct.pack('>H', len(data) + 2) + data
+        remaining -= chunk
+    app1 = 'Exif\x00\x00' + tiff
+    out += '\xFF\xE1' + struct.pack('>H', len(app1) + 2) + app1
+    dqt = '\x00' + '\x01' * 64
+    out += '\xFF\xDB' + struct.pack('>H', len(dqt) + 2) + dqt
+    out += '\xFF\xDA\x00\x08\x01\x01\x00\x00\x3f\x00' + '\x55' * 4000 + '\xFF\xD9'
+    return out
+
+# -----------------------------------------------------------------------------
+# Corpus
+# -----------------------------------------------------------------------------
+VARIANTS = [(endian, make, thumb)
+            for endian in ('I', 'M')
+            for make in MAKES
+            for thumb in ('jpeg', 'tiff', None)]
+
+def generate(outdir):
+    """Write the corpus to outdir and return the file paths."""
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    paths = []
+    for i, (endian, make, thumb) in enumerate(VARIANTS):
+        tiff = build_exif(endian, make, thumb, filler_tags=i % 5 * 10)
+        icc = 70000 if i % 7 == 0 else 0
+        name = '%s_%s_%s%s' % (endian, make, thumb, '_icc' if icc else '')
+        path = os.path.join(outdir, name + '.jpg')
+        with open(path, 'wb') as f:
+            f.write(jpeg_wrap(tiff, jfif=bool(i % 2), icc=icc,
+                              xmp=bool(i % 3 == 0)))
+        paths.append(path)
+        path = os.path.join(outdir, name + '.tif')
+        with open(path, 'wb') as f:
+            f.write(tiff)
+        paths.append(path)
+    return paths
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) != 2:
+        print __doc__.strip()
+        sys.exit(2)
+    for path in generate(sys.argv[1]):
+        print path
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Stress test of EXIF.process_file from many threads at once, the way the
+importer's parse pool calls it.  Every file of the corpus is parsed with
+each set of options serially first, then the same parses are run again from
+a ThreadPool in a shuffled order and their tags compared with the serial
+ones.  After that the threads share tags: each file is parsed once and all
+the threads look at the same tags together, which is when a MakerNote that
+was left to decode later gets decoded.
+
+The interpreter switches threads far more often than usual while it runs,
+so races show up in a few seconds.  The exit status is 1 if any parse
+differed.
+
+Usage: python stress_threads.py [OPTIONS]
+
+Options:
+-c DIR --corpus DIR     Use (or create) the corpus in DIR instead of a
+                        temporary one.
+-t N --threads N        Threads in the pool (default 16).
+-r N --repeat N         Parses of each file and option set (default 4).
+"""
+
+import getopt
+import os
+import random
+import shutil
+import sys
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'pic_timeline'))
+
+import EXIF
+from exif_corpus import generate
+
+OPTIONS = [{},
+           {'details': False},
+           {'tags': 'timestamp'},
+           {'use_mmap': False, 'thumbnail': True},
+           {'stop_tag': 'DateTimeOriginal'}]
+
+# -----------------------------------------------------------------------------
+# Parsing
+# -----------------------------------------------------------------------------
+def summary(tags):
+    """What's compared between runs: every tag and its printed value."""
+    return (sorted((name, str(value)) for name, value in tags.items()),
+            getattr(tags, 'truncated', False))
+
+def parse(job):
+    path, options = job
+    with open(path, 'rb') as f:
+        return summary(EXIF.process_file(f, **OPTIONS[options]))
+
+def look(tags):
+    # MakerNote tags first, so some threads decode it and others wait
+    tags.get('MakerNote Tag 0x0001')
+    return summary(tags)
+
+# -----------------------------------------------------------------------------
+# Stress
+# -----------------------------------------------------------------------------
+def run(paths, threads, repeat):
+    """Return the number of parses and a list of the ones that differ."""
+    jobs = [(path, options) for path in paths for options in range(len(OPTIONS))]
+    serial = dict((job, parse(job)) for job in jobs)
+    pool = ThreadPool(threads)
+    try:
+        shuffled = jobs * repeat
+        random.Random(1).shuffle(shuffled)
+        differ = [job for job, result in zip(shuffled, pool.map(parse, shuffled, 1))
+                  if result != serial[job]]
+        count = len(shuffled)
+
+        for path in paths:
+            for i in range(repeat):
+                with open(path, 'rb') as f:
+                    tags = EXIF.process_file(f)
+                for result in pool.map(look, [tags] * threads, 1):
+                    count += 1
+                    if result != serial[path, 0]:
+                        differ.append((path, 'shared'))
+    finally:
+        pool.close()
+        pool.join()
+    return count, differ
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, 'hc:t:r:',
+                                   ['help', 'corpus=', 'threads=', 'repeat='])
+    except getopt.GetoptError:
+        print __doc__.strip()
+        return 2
+    corpus = None
+    threads = 16
+    repeat = 4
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            print __doc__.strip()
+            return 0
+        if o in ('-c', '--corpus'):
+            corpus = a
+        if o in ('-t', '--threads'):
+            threads = int(a)
+        if o in ('-r', '--repeat'):
+            repeat = int(a)
+
+    temp_dir = None
+    if corpus is None:
+        corpus = temp_dir = tempfile.mkdtemp()
+    sys.setcheckinterval(10)
+    try:
+        count, differ = run(sorted(generate(corpus)), threads, repeat)
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir)
+
+    print '%d parses, %d differ from serial' % (count, len(differ))
+    for job in sorted(set(differ)):
+        print '  %s %s' % (os.path.basename(job[0]), job[1])
+    if differ:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
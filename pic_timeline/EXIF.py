@@ -24,18 +24,54 @@
 #
 # These 2 are useful when you are retrieving a large list of images
 #
+# To only retrieve some tags, pass their names as
+#    tags = EXIF.process_file(f, tags=['Image DateTime', 'Image Model'])
+#
+# Only the IFDs holding those tags are read and nothing else is decoded.
+# Some ready-made sets of tags are also available by name, for example
+#    tags = EXIF.process_file(f, tags='timestamp')
+#
+# returns the capture time tags already parsed into integers (see
+# TAG_PROFILES below)
+#
+# TIFF based files (including TIFF based RAW files) are memory mapped when
+# possible, to read them with plain file reads instead use
+#    tags = EXIF.process_file(f, use_mmap=False)
+#
+# Besides JPEG and TIFF based files, the EXIF chunks of PNG and WebP files
+# are read too.
+#
+# Streams that can't seek (pipes, decompressors, sockets...) are read with
+#    tags = EXIF.process_stream(stream)
+#
+# which takes the same options as process_file and only reads as far into
+# the stream as the tags it is after.
+#
 # To return an error on invalid tags,
 # pass the -s or --strict argument, or as
 #    tags = EXIF.process_file(f, strict=True)
 #
 # Otherwise these tags will be ignored
 #
+# Parsing a file is limited to a budget of work (see PARSE_BUDGET), a file
+# that goes over it returns the tags found so far with
+#    tags.truncated
+# set to True.
+#
+# Embedded thumbnails are not read by default, instead
+#    tags['ThumbnailLocator']
+# says where the thumbnail is (see Thumbnail_Locator) and its view() and
+# write_to() methods fetch the data when it is actually wanted (raising
+# ValueError for a thumbnail too big for the file's budget).  To get the
+# thumbnail data in 'JPEGThumbnail' or 'TIFFThumbnail' right away, call
+#    tags = EXIF.process_file(f, thumbnail=True)
+#
 # Returned tags will be a dictionary mapping names of EXIF tags to their
 # values in the file named by path_name.  You can process the tags
 # as you wish.  In particular, you can iterate through all the tags with:
 #     for tag in tags.keys():
-#         if tag not in ('JPEGThumbnail', 'TIFFThumbnail', 'Filename',
-#                        'EXIF MakerNote'):
+#         if tag not in ('JPEGThumbnail', 'TIFFThumbnail', 'ThumbnailLocator',
+#                        'Filename', 'EXIF MakerNote'):
 #             print "Key: %s, value %s" % (tag, tags[tag])
 # (This code uses the if statement to avoid printing out a few of the
 # tags that tend to be long or boring.)
@@ -44,6 +80,10 @@
 # tags, and will also include keys for Makernotes used by some
 # cameras, for which we have a good specification.
 #
+# The MakerNote is only decoded the first time one of its tags is looked up
+# or the whole dictionary is looked at (keys(), items(), iterating...), see
+# EXIF_Tags.
+#
 # Note that the dictionary keys are the IFD name followed by the
 # tag name. For example:
 # 'EXIF DateTimeOriginal', 'Image Orientation', 'MakerNote FocusMode'
@@ -83,6 +123,16 @@
 # ----- See 'changes.txt' file for all contributors and changes ----- #
 #
 
+import array
+import copy
+import errno
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
 
 # Don't throw an exception when given an out of range character.
 def make_string(seq):
@@ -120,6 +170,28 @@ FIELD_TYPES = (
     (8, 'SR', 'Signed Ratio'),
     )
 
+# struct format codes for decoding values of each field type (the ASCII and
+# Proprietary types are handled separately)
+FIELD_CODES = {1: 'B', 3: 'H', 4: 'L', 5: 'L', 6: 'b', 7: 'B',
+               8: 'h', 9: 'l', 10: 'l'}
+
+# precompiled unpackers for single integers, keyed by
+# (intel byte order?, length in bytes, signed?)
+UNPACKERS = {}
+for _intel, _prefix in ((True, '<'), (False, '>')):
+    for _length, _codes in ((1, 'Bb'), (2, 'Hh'), (4, 'Ll'), (8, 'Qq')):
+        for _signed in (0, 1):
+            UNPACKERS[_intel, _length, _signed] = \
+                struct.Struct(_prefix + _codes[_signed]).unpack_from
+del _intel, _prefix, _length, _codes, _signed
+
+# array type codes for keeping the decoded values of each integer field type.
+# Unsigned longs go in a signed C long where that is big enough, since 'L'
+# arrays hand out Python longs.
+ARRAY_CODES = {1: 'B', 3: 'H', 4: 'L', 6: 'b', 7: 'B', 8: 'h', 9: 'i'}
+if array.array('l').itemsize >= 8:
+    ARRAY_CODES[4] = 'l'
+
 # dictionary of main EXIF tag names
 # first element of tuple is tag name, optional second element is
 # another dictionary giving names to values
@@ -231,6 +303,9 @@ EXIF_TAGS = {
     0x9000: ('ExifVersion', make_string),
     0x9003: ('DateTimeOriginal', ),
     0x9004: ('DateTimeDigitized', ),
+    0x9010: ('OffsetTime', ),
+    0x9011: ('OffsetTimeOriginal', ),
+    0x9012: ('OffsetTimeDigitized', ),
     0x9101: ('ComponentsConfiguration',
              {0: '',
               1: 'Y',
@@ -1187,6 +1262,42 @@ MAKERNOTE_CANON_TAG_0x004 = {
     19: ('SubjectDistance', ),
     }
 
+# tag dictionaries compiled into lookup tables for dump_IFD, keyed by id()
+COMPILED_TAGS = {}
+
+# return the lookup tables for a tag dictionary as (dict, table, numbers)
+# where table maps tag number -> (tag name, tag entry) and numbers maps tag
+# name -> tag number.  Each dictionary is only compiled once.
+def compile_tags(dict):
+    compiled = COMPILED_TAGS.get(id(dict))
+    if compiled is None:
+        table = {}
+        numbers = {}
+        for tag, tag_entry in dict.items():
+            table[tag] = (tag_entry[0], tag_entry)
+            numbers.setdefault(tag_entry[0], tag)
+        # keep dict itself so its id can't be reused
+        compiled = COMPILED_TAGS[id(dict)] = (dict, table, numbers)
+    return compiled
+
+for _dict in (EXIF_TAGS, INTR_TAGS, GPS_TAGS, MAKERNOTE_NIKON_NEWER_TAGS,
+              MAKERNOTE_NIKON_OLDER_TAGS, MAKERNOTE_OLYMPUS_TAGS,
+              MAKERNOTE_CASIO_TAGS, MAKERNOTE_FUJIFILM_TAGS,
+              MAKERNOTE_CANON_TAGS):
+    compile_tags(_dict)
+del _dict
+
+# return the tag number for a tag name from dump_IFD, or None
+def tag_number(tag_name, numbers):
+    if tag_name in numbers:
+        return numbers[tag_name]
+    if tag_name.startswith('Tag 0x'):
+        try:
+            return int(tag_name[6:], 16)
+        except ValueError:
+            pass
+    return None
+
 # extract multibyte integer in Motorola format (little endian)
 def s2n_motorola(str):
     x = 0
@@ -1203,37 +1314,90 @@ def s2n_intel(str):
         y = y + 8
     return x
 
+# biggest single read asked of a file.  file.read(n) allocates n bytes
+# before reading anything, so a length from a corrupt file is read in
+# pieces and costs no more memory than the file actually has.
+READ_CHUNK_SIZE = 1024 * 1024
+
+# read up to length bytes from f, '' for a length of 0 or less
+def read_at_most(f, length):
+    if length <= READ_CHUNK_SIZE:
+        return f.read(max(length, 0))
+    chunks = []
+    while length > 0:
+        chunk = f.read(min(length, READ_CHUNK_SIZE))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        length -= len(chunk)
+    return ''.join(chunks)
+
 # ratio object that eventually will be able to reduce itself to lowest
 # common denominator for printing
 def gcd(a, b):
-    if b == 0:
-        return a
-    else:
-        return gcd(b, a % b)
+    while b:
+        a, b = b, a % b
+    return a
+
+# ratios are only reduced when they are printed
+class Ratio(object):
+    __slots__ = ('num', 'den')
 
-class Ratio:
     def __init__(self, num, den):
         self.num = num
         self.den = den
 
+    # printed reduced, without reducing self: threads printing the same
+    # tags would see each other's half done reduce
     def __repr__(self):
-        self.reduce()
-        if self.den == 1:
-            return str(self.num)
-        return '%d/%d' % (self.num, self.den)
+        num, den = self.reduced()
+        if den == 1:
+            return str(num)
+        return '%d/%d' % (num, den)
+
+    def reduced(self):
+        num, den = self.num, self.den
+        div = gcd(num, den)
+        if div > 1:
+            return num / div, den / div
+        return num, den
 
     def reduce(self):
-        div = gcd(self.num, self.den)
-        if div > 1:
-            self.num = self.num / div
-            self.den = self.den / div
+        self.num, self.den = self.reduced()
+
+# decoded integer values of a tag, kept in a typed array rather than a list
+# of Python ints.  Slices are lists and it compares and prints like a list,
+# which is what the values used to be.
+class Values(array.array):
+    __slots__ = ()
+
+    def __getslice__(self, i, j):
+        return list(array.array.__getslice__(self, i, j))
+
+    def __eq__(self, other):
+        if isinstance(other, array.array):
+            other = list(other)
+        return list(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+    __str__ = __repr__
 
 # for ease of dealing with tags
-class IFD_Tag:
+#
+# Tags read by dump_IFD are given the header they came from and only record
+# where their data is.  values and printable are decoded the first time they
+# are looked at and then kept.
+class IFD_Tag(object):
+    __slots__ = ('tag', 'field_type', 'field_offset', 'field_length', 'count',
+                 'tag_entry', 'header', 'printable', 'values')
+
     def __init__(self, printable, tag, field_type, values, field_offset,
-                 field_length):
-        # printable version of data
-        self.printable = printable
+                 field_length, header=None, count=None, tag_entry=None):
         # tag ID number
         self.tag = tag
         # field type as index into FIELD_TYPES
@@ -1242,8 +1406,50 @@ class IFD_Tag:
         self.field_offset = field_offset
         # length of data field in bytes
         self.field_length = field_length
-        # either a string or array of data items
-        self.values = values
+        # number of data items
+        self.count = count
+        # entry from the tag dictionary, used to make printable
+        self.tag_entry = tag_entry
+        self.header = header
+        if header is None:
+            # printable version of data
+            self.printable = printable
+            # either a string or array of data items
+            self.values = values
+
+    def __getattr__(self, name):
+        if name == 'values':
+            self.values = self.header.decode_values(self)
+            return self.values
+        if name == 'printable':
+            self.printable = self.make_printable()
+            return self.printable
+        raise AttributeError(name)
+
+    # compute printable version of values
+    def make_printable(self):
+        values = self.values
+        tag_entry = self.tag_entry
+        # now 'values' is either a string or an array
+        if self.count == 1 and self.field_type != 2:
+            printable=str(values[0])
+        elif self.count > 50 and len(values) > 20 :
+            printable=str( values[0:20] )[0:-1] + ", ... ]"
+        else:
+            printable=str(values)
+
+        if tag_entry:
+            if len(tag_entry) != 1:
+                # optional 2nd tag element is present
+                if callable(tag_entry[1]):
+                    # call mapping function
+                    printable = tag_entry[1](values)
+                else:
+                    printable = ''
+                    for i in values:
+                        # use lookup table for this tag
+                        printable += tag_entry[1].get(i, repr(i))
+        return printable
 
     def __str__(self):
         return self.printable
@@ -1261,24 +1467,204 @@ class IFD_Tag:
                                         str(self.field_offset))
         return s
 
+# the most work parsing a single file may take, so a corrupt or hostile file
+# has a bounded cost: IFDs dumped, IFD entries looked at, bytes of tag
+# values and seeks in the file.  Override them per call with
+#    tags = EXIF.process_file(f, budget={'ifds': 8})
+PARSE_BUDGET = {
+    'ifds': 64,
+    'entries': 20000,
+    'value_bytes': 64 * 1024 * 1024,
+    'seeks': 20000,
+    }
+
+# raised when a file needs more work than its Parse_Budget allows
+class Budget_Exceeded(Exception):
+    pass
+
+# what is left of the PARSE_BUDGET for one file, shared by the header and
+# its copies
+class Parse_Budget:
+    def __init__(self, **limits):
+        for name, limit in PARSE_BUDGET.items():
+            setattr(self, name, limits.pop(name, limit))
+        if limits:
+            raise TypeError('unknown budget %s' % ', '.join(limits))
+        self.limits = dict((name, getattr(self, name)) for name in PARSE_BUDGET)
+        # file positions of the IFDs dumped so far
+        self.visited = set()
+
+    # a new budget with the same limits, for work done after process_file
+    def renewed(self):
+        return Parse_Budget(**self.limits)
+
+    def spend(self, what, amount=1):
+        left = getattr(self, what) - amount
+        setattr(self, what, left)
+        if left < 0:
+            raise Budget_Exceeded('too many %s' % what.replace('_', ' '))
+
+# dictionary of tags returned by process_file.  MakerNotes are often the
+# biggest IFD in a file and are rarely needed, so a MakerNote that is all in
+# memory is decoded the first time a 'MakerNote ...' tag is looked up or the
+# dictionary as a whole is looked at.  Note that dict(tags) bypasses this,
+# use tags.copy().  Threads looking at the same tags wait for one of them to
+# decode it.
+class EXIF_Tags(dict):
+    # header to decode the MakerNote with, None once it's done
+    maker_note_header = None
+    maker_note_lock = None
+    decoding = False
+    # set when the file went over its parse budget and not all tags are here
+    truncated = False
+
+    def defer_maker_note(self, hdr):
+        self.maker_note_lock = threading.RLock()
+        self.maker_note_header = hdr
+
+    def decode_maker_note(self):
+        if self.maker_note_header is None:
+            return
+        with self.maker_note_lock:
+            hdr = self.maker_note_header
+            # done by another thread meanwhile, or this is a lookup made by
+            # the decoding itself
+            if hdr is None or self.decoding:
+                return
+            self.decoding = True
+            try:
+                hdr.decode_maker_note()
+            except Budget_Exceeded, e:
+                if hdr.debug: print "Stopped decoding MakerNote:", e
+                self.truncated = True
+            except ValueError, e:
+                if getattr(hdr.file, 'closed', False):
+                    # some value was outside the block in memory and the
+                    # file is closed by now
+                    if hdr.debug: print "File closed before decoding MakerNote:", e
+                    self.truncated = True
+                elif hdr.strict:
+                    raise
+                elif hdr.debug:
+                    print "Can't decode MakerNote:", e
+            finally:
+                # only now, other threads see the tags when it's None
+                self.maker_note_header = None
+                self.decoding = False
+
+    def __getitem__(self, key):
+        if self.maker_note_header is not None and str(key).startswith('MakerNote '):
+            self.decode_maker_note()
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        if self.maker_note_header is not None and str(key).startswith('MakerNote '):
+            self.decode_maker_note()
+        return dict.__contains__(self, key)
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __iter__(self):
+        self.decode_maker_note()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self.decode_maker_note()
+        return dict.__len__(self)
+
+    def __repr__(self):
+        self.decode_maker_note()
+        return dict.__repr__(self)
+
+    def copy(self):
+        self.decode_maker_note()
+        return dict.copy(self)
+
+for _name in ('keys', 'values', 'items', 'iterkeys', 'itervalues',
+              'iteritems'):
+    def _decoded(self, _method=getattr(dict, _name)):
+        self.decode_maker_note()
+        return _method(self)
+    _decoded.__name__ = _name
+    setattr(EXIF_Tags, _name, _decoded)
+del _name, _decoded
+
 # class that handles an EXIF header
+#
+# If data is given it is an in-memory copy of the EXIF block (usually the
+# whole APP1 segment) or a memoryview of the whole mapped file (see
+# map_file), that starts at file position data_offset.  Values are decoded
+# straight out of it, and only reads that fall outside it go back to the
+# file.  If whole_file is set data is all of the file, so the file is never
+# read again (and may be closed).
 class EXIF_header:
-    def __init__(self, file, endian, offset, fake_exif, strict, debug=0):
+    def __init__(self, file, endian, offset, fake_exif, strict, debug=0,
+                 data=None, data_offset=0, details=True, budget=None,
+                 whole_file=False):
         self.file = file
         self.endian = endian
         self.offset = offset
         self.fake_exif = fake_exif
         self.strict = strict
         self.debug = debug
-        self.tags = {}
+        self.details = details
+        if budget is None:
+            budget = Parse_Budget()
+        self.budget = budget
+        self.tags = EXIF_Tags()
+        if data is not None and not isinstance(data, memoryview):
+            data = memoryview(data)
+        self.data = data
+        self.data_offset = data_offset
+        self.whole_file = whole_file and data is not None
+
+    # return position of offset in self.data, or -1 if the length bytes
+    # there are not all in memory
+    def data_pos(self, offset, length):
+        if self.data is None:
+            return -1
+        pos = self.offset + offset - self.data_offset
+        if pos < 0 or pos + length > len(self.data):
+            return -1
+        return pos
+
+    # read length bytes at offset
+    def read(self, offset, length):
+        pos = self.data_pos(offset, length)
+        if pos >= 0:
+            return self.data[pos:pos+length].tobytes()
+        if self.whole_file:
+            # past the end of the file, only what's left of it
+            pos = self.offset + offset - self.data_offset
+            if pos >= 0:
+                return self.data[pos:pos+length].tobytes()
+        self.budget.spend('seeks')
+        self.file.seek(self.offset+offset)
+        return read_at_most(self.file, length)
+
+    # like read but returns a memoryview, which doesn't copy anything if the
+    # bytes are in memory
+    def view(self, offset, length):
+        pos = self.data_pos(offset, length)
+        if pos >= 0:
+            return self.data[pos:pos+length]
+        return memoryview(self.read(offset, length))
 
     # convert slice to integer, based on sign and endian flags
     # usually this offset is assumed to be relative to the beginning of the
     # start of the EXIF information.  For some cameras that use relative tags,
     # this offset may be relative to some other starting point.
     def s2n(self, offset, length, signed=0):
-        self.file.seek(self.offset+offset)
-        slice=self.file.read(length)
+        pos = self.data_pos(offset, length)
+        if pos >= 0 and length in (1, 2, 4, 8):
+            unpack = UNPACKERS[self.endian == 'I', length, signed]
+            return unpack(self.data, pos)[0]
+        slice=self.read(offset, length)
         if self.endian == 'I':
             val=s2n_intel(slice)
         else:
@@ -1290,6 +1676,66 @@ class EXIF_header:
                 val=val-(msb << 1)
         return val
 
+    # decode an array of count values of field_type at offset in one go
+    def s2n_array(self, offset, field_type, count):
+        typelen = FIELD_TYPES[field_type][0]
+        signed = (field_type in [6, 8, 9, 10])
+        ratio = field_type in (5, 10)
+        if ratio:
+            count = count * 2
+            typelen = 4
+        if self.endian == 'I':
+            fmt = '<%d%s' % (count, FIELD_CODES[field_type])
+        else:
+            fmt = '>%d%s' % (count, FIELD_CODES[field_type])
+        pos = self.data_pos(offset, count * typelen)
+        if pos >= 0:
+            values = struct.unpack_from(fmt, self.data, pos)
+        else:
+            raw = self.read(offset, count * typelen)
+            if len(raw) == count * typelen:
+                values = struct.unpack(fmt, raw)
+            else:
+                # truncated file, decode whatever s2n makes of it
+                values = [self.s2n(offset + i * typelen, typelen, signed)
+                          for i in range(count)]
+        if ratio:
+            return [Ratio(values[i], values[i+1])
+                    for i in range(0, count, 2)]
+        return Values(ARRAY_CODES[field_type], values)
+
+    # decode the values of a tag read by dump_IFD, either a string or an
+    # array of data items
+    def decode_values(self, tag):
+        field_type = tag.field_type
+        count = tag.count
+        offset = tag.field_offset
+        if field_type == 2:
+            # special case: null-terminated ASCII string
+            # XXX investigate
+            # sometimes gets too big to fit in int value
+            if count == 0: # and count < (2**31):  # 2E31 is hardware dependant. --gd
+                return ''
+            try:
+                values = self.read(offset, count)
+                #print values
+                # Drop any garbage after a null.
+                return values.split('\x00', 1)[0]
+            except OverflowError:
+                return ''
+
+        # XXX investigate
+        # some entries get too big to handle could be malformed
+        # file or problem with self.s2n
+        if count < 1000:
+            return self.s2n_array(offset, field_type, count)
+        # The test above causes problems with tags that are 
+        # supposed to have long values!  Fix up one important case.
+        if tag.tag_entry and tag.tag_entry[0] == 'MakerNote':
+            return self.s2n_array(offset, field_type, count)
+        #print "Warning: dropping large tag:", tag.tag
+        return []
+
     # convert offset to string
     def n2s(self, offset, length):
         s = ''
@@ -1314,192 +1760,214 @@ class EXIF_header:
         else:
             return next_ifd
 
-    # return list of IFDs in header
-    def list_IFDs(self):
+    # return list of IFDs in header, or only the first limit of them.  The
+    # chain ends early if it loops back or is longer than the IFD budget.
+    def list_IFDs(self, limit=None):
         i=self.first_IFD()
         a=[]
-        while i:
+        while i and len(a) != limit:
+            if i in a:
+                if self.debug: print "IFD chain loops back to", i
+                break
+            if len(a) > self.budget.ifds:
+                # dump_IFD runs out of budget before getting here
+                break
             a.append(i)
             i=self.next_IFD(i)
         return a
 
-    # return list of entries in this IFD
-    def dump_IFD(self, ifd, ifd_name, dict=EXIF_TAGS, relative=0, stop_tag='UNDEF'):
-        entries=self.s2n(ifd, 2)
-        for i in range(entries):
-            # entry is index of start of this IFD in the file
-            entry = ifd + 2 + 12 * i
-            tag = self.s2n(entry, 2)
-
-            # get tag name early to avoid errors, help debug
-            tag_entry = dict.get(tag)
-            if tag_entry:
-                tag_name = tag_entry[0]
-            else:
-                tag_name = 'Tag 0x%04X' % tag
-
-            # ignore certain tags for faster processing
-            if not (not detailed and tag in IGNORE_TAGS):
-                field_type = self.s2n(entry + 2, 2)
-                
-                # unknown field type
-                if not 0 < field_type < len(FIELD_TYPES):
-                    if not self.strict:
-                        continue
-                    else:
-                        raise ValueError('unknown type %d in tag 0x%04X' % (field_type, tag))
+    # unpack a table of 12-byte IFD entries at offset in one go, returns a
+    # flat tuple of (tag, type, count, value/offset) fields.  If the file is
+    # cut short only the complete entries are returned.
+    def unpack_entries(self, offset, entries):
+        if self.endian == 'I':
+            prefix = '<'
+        else:
+            prefix = '>'
+        pos = self.data_pos(offset, entries * 12)
+        if pos >= 0:
+            return struct.unpack_from(prefix + 'HHLL' * entries, self.data, pos)
+        raw = self.read(offset, entries * 12)
+        entries = len(raw) // 12
+        return struct.unpack(prefix + 'HHLL' * entries, raw[:entries * 12])
 
-                typelen = FIELD_TYPES[field_type][0]
-                count = self.s2n(entry + 4, 4)
-                # Adjust for tag id/type/count (2+2+4 bytes)
-                # Now we point at either the data or the 2nd level offset
-                offset = entry + 8
-
-                # If the value fits in 4 bytes, it is inlined, else we
-                # need to jump ahead again.
-                if count * typelen > 4:
-                    # offset is not the value; it's a pointer to the value
-                    # if relative we set things up so s2n will seek to the right
-                    # place when it adds self.offset.  Note that this 'relative'
-                    # is for the Nikon type 3 makernote.  Other cameras may use
-                    # other relative offsets, which would have to be computed here
-                    # slightly differently.
-                    if relative:
-                        tmp_offset = self.s2n(offset, 4)
-                        offset = tmp_offset + ifd - 8
-                        if self.fake_exif:
-                            offset = offset + 18
-                    else:
-                        offset = self.s2n(offset, 4)
-
-                field_offset = offset
-                if field_type == 2:
-                    # special case: null-terminated ASCII string
-                    # XXX investigate
-                    # sometimes gets too big to fit in int value
-                    if count != 0: # and count < (2**31):  # 2E31 is hardware dependant. --gd
-                        try:
-                            self.file.seek(self.offset + offset)
-                            values = self.file.read(count)
-                            #print values
-                            # Drop any garbage after a null.
-                            values = values.split('\x00', 1)[0]
-                        except OverflowError:
-                            values = ''
-                else:
-                    values = []
-                    signed = (field_type in [6, 8, 9, 10])
-                    
-                    # XXX investigate
-                    # some entries get too big to handle could be malformed
-                    # file or problem with self.s2n
-                    if count < 1000:
-                        for dummy in range(count):
-                            if field_type in (5, 10):
-                                # a ratio
-                                value = Ratio(self.s2n(offset, 4, signed),
-                                              self.s2n(offset + 4, 4, signed))
-                            else:
-                                value = self.s2n(offset, typelen, signed)
-                            values.append(value)
-                            offset = offset + typelen
-                    # The test above causes problems with tags that are 
-                    # supposed to have long values!  Fix up one important case.
-                    elif tag_name == 'MakerNote' :
-                        for dummy in range(count):
-                            value = self.s2n(offset, typelen, signed)
-                            values.append(value)
-                            offset = offset + typelen
-                    #else :
-                    #    print "Warning: dropping large tag:", tag, tag_name
-                
-                # now 'values' is either a string or an array
-                if count == 1 and field_type != 2:
-                    printable=str(values[0])
-                elif count > 50 and len(values) > 20 :
-                    printable=str( values[0:20] )[0:-1] + ", ... ]"
+    # return list of entries in this IFD
+    # if wanted is given only tags whose full name is in it are decoded
+    def dump_IFD(self, ifd, ifd_name, dict=EXIF_TAGS, relative=0, stop_tag='UNDEF',
+                 wanted=None):
+        # don't dump the same IFD twice, whatever points to it
+        if self.offset + ifd in self.budget.visited:
+            if self.debug: print "IFD at", ifd, "already dumped"
+            return
+        self.budget.visited.add(self.offset + ifd)
+        self.budget.spend('ifds')
+        dict, table, numbers = compile_tags(dict)
+        entries = self.s2n(ifd, 2)
+        self.budget.spend('entries', entries)
+        fields = self.unpack_entries(ifd + 2, entries)
+        # split into parallel arrays
+        tags = fields[0::4]
+        types = fields[1::4]
+        counts = fields[2::4]
+        pointers = fields[3::4]
+        entries = len(tags)
+
+        # nothing after the stop tag is processed
+        if stop_tag != 'UNDEF':
+            stop = tag_number(stop_tag, numbers)
+            if stop in tags:
+                entries = tags.index(stop) + 1
+
+        # pick the entries to decode
+        indexes = range(entries)
+        if wanted is not None:
+            prefix = ifd_name + ' '
+            wanted_tags = set()
+            for name in wanted:
+                if name.startswith(prefix):
+                    wanted_tags.add(tag_number(name[len(prefix):], numbers))
+            indexes = [i for i in indexes if tags[i] in wanted_tags]
+        # ignore certain tags for faster processing
+        if not self.details:
+            indexes = [i for i in indexes if tags[i] not in IGNORE_TAGS]
+
+        # bytes of values that can be decoded straight from memory
+        value_bytes = 0
+        for i in indexes:
+            tag = tags[i]
+            field_type = types[i]
+            # unknown field type
+            if not 0 < field_type < len(FIELD_TYPES):
+                if not self.strict:
+                    continue
                 else:
-                    printable=str(values)
-
-                # compute printable version of values
-                if tag_entry:
-                    if len(tag_entry) != 1:
-                        # optional 2nd tag element is present
-                        if callable(tag_entry[1]):
-                            # call mapping function
-                            printable = tag_entry[1](values)
-                        else:
-                            printable = ''
-                            for i in values:
-                                # use lookup table for this tag
-                                printable += tag_entry[1].get(i, repr(i))
-
-                self.tags[ifd_name + ' ' + tag_name] = IFD_Tag(printable, tag,
-                                                          field_type,
-                                                          values, field_offset,
-                                                          count * typelen)
-                if self.debug:
-                    print ' debug:   %s: %s' % (tag_name,
-                                                repr(self.tags[ifd_name + ' ' + tag_name]))
+                    raise ValueError('unknown type %d in tag 0x%04X' % (field_type, tag))
+
+            length = counts[i] * FIELD_TYPES[field_type][0]
+            # If the value fits in 4 bytes, it is inlined (after the
+            # tag id/type/count, 2+2+4 bytes), else we need to jump ahead
+            # again.
+            if length > 4:
+                # offset is not the value; it's a pointer to the value
+                # if relative we set things up so s2n will seek to the right
+                # place when it adds self.offset.  Note that this 'relative'
+                # is for the Nikon type 3 makernote.  Other cameras may use
+                # other relative offsets, which would have to be computed here
+                # slightly differently.
+                offset = pointers[i]
+                if relative:
+                    offset = offset + ifd - 8
+                    if self.fake_exif:
+                        offset = offset + 18
+            else:
+                offset = ifd + 2 + 12 * i + 8
 
-            if tag_name == stop_tag:
-                break
+            # get tag name
+            if tag in table:
+                tag_name, tag_entry = table[tag]
+            else:
+                tag_name, tag_entry = 'Tag 0x%04X' % tag, None
+            tag_obj = IFD_Tag(None, tag, field_type, None, offset, length,
+                              header=self, count=counts[i],
+                              tag_entry=tag_entry)
+            # values are decoded on first use, unless they are not in
+            # memory and the file might be gone by then.  decode_values
+            # drops big arrays, so those cost nothing.
+            if field_type == 2 or counts[i] < 1000 or tag_name == 'MakerNote':
+                decoded = length
+            else:
+                decoded = 0
+            if self.data_pos(offset, length) < 0:
+                self.budget.spend('value_bytes', decoded)
+                tag_obj.values
+            else:
+                value_bytes += decoded
+            self.tags[ifd_name + ' ' + tag_name] = tag_obj
+            if self.debug:
+                print ' debug:   %s: %s' % (tag_name, repr(tag_obj))
+        self.budget.spend('value_bytes', value_bytes)
 
     # extract uncompressed TIFF thumbnail (like pulling teeth)
     # we take advantage of the pre-existing layout in the thumbnail IFD as
-    # much as possible
+    # much as possible.  The new file is built in a buffer of exactly the
+    # right size: header, the thumbnail IFD, the data of its large values
+    # and then the pixel strips, with the pointers patched in place.
     def extract_TIFF_thumbnail(self, thumb_ifd):
         entries = self.s2n(thumb_ifd, 2)
-        # this is header plus offset to IFD ...
         if self.endian == 'M':
-            tiff = 'MM\x00*\x00\x00\x00\x08'
+            prefix = '>'
+            header = 'MM\x00*\x00\x00\x00\x08'
         else:
-            tiff = 'II*\x00\x08\x00\x00\x00'
-        # ... plus thumbnail IFD data plus a null "next IFD" pointer
-        self.file.seek(self.offset+thumb_ifd)
-        tiff += self.file.read(entries*12+2)+'\x00\x00\x00\x00'
-
-        # fix up large value offset pointers into data area
+            prefix = '<'
+            header = 'II*\x00\x08\x00\x00\x00'
+        table = self.read(thumb_ifd + 2, entries*12)
+        entries = len(table) // 12
+        fields = struct.unpack(prefix + 'HHLL' * entries, table[:entries*12])
+
+        # work out where the large values go
+        ifd_end = 8 + 2 + entries*12 + 4
+        moved = []
+        data_end = ifd_end
+        strip_ptr = strip_len = None
         for i in range(entries):
-            entry = thumb_ifd + 2 + 12 * i
-            tag = self.s2n(entry, 2)
-            field_type = self.s2n(entry+2, 2)
-            typelen = FIELD_TYPES[field_type][0]
-            count = self.s2n(entry+4, 4)
-            oldoff = self.s2n(entry+8, 4)
+            tag, field_type, count, oldoff = fields[i*4:i*4+4]
+            if 0 < field_type < len(FIELD_TYPES):
+                typelen = FIELD_TYPES[field_type][0]
+            else:
+                typelen = 0
             # start of the 4-byte pointer area in entry
-            ptr = i * 12 + 18
-            # remember strip offsets location
-            if tag == 0x0111:
-                strip_off = ptr
-                strip_len = count * typelen
+            ptr = 8 + 2 + i*12 + 8
             # is it in the data area?
             if count * typelen > 4:
-                # update offset pointer (nasty "strings are immutable" crap)
-                # should be able to say "tiff[ptr:ptr+4]=newoff"
-                newoff = len(tiff)
-                tiff = tiff[:ptr] + self.n2s(newoff, 4) + tiff[ptr+4:]
-                # remember strip offsets location
+                moved.append((ptr, oldoff, count * typelen, data_end))
                 if tag == 0x0111:
-                    strip_off = newoff
-                    strip_len = 4
-                # get original data and store it
-                self.file.seek(self.offset + oldoff)
-                tiff += self.file.read(count * typelen)
+                    strip_ptr = data_end
+                data_end += count * typelen
+            elif tag == 0x0111:
+                strip_ptr = ptr
+            # remember strip offsets location and size
+            if tag == 0x0111:
+                strip_len = typelen
 
-        # add pixel strips and update strip offset info
         old_offsets = self.tags['Thumbnail StripOffsets'].values
         old_counts = self.tags['Thumbnail StripByteCounts'].values
-        for i in range(len(old_offsets)):
-            # update offset pointer (more nasty "strings are immutable" crap)
-            offset = self.n2s(len(tiff), strip_len)
-            tiff = tiff[:strip_off] + offset + tiff[strip_off + strip_len:]
-            strip_off += strip_len
-            # add pixel strip to end
-            self.file.seek(self.offset + old_offsets[i])
-            tiff += self.file.read(old_counts[i])
-
-        self.tags['TIFFThumbnail'] = tiff
+        strips = min(len(old_offsets), len(old_counts))
+        # the sizes come from the file, don't trust them with memory
+        self.budget.spend('value_bytes', data_end + sum(old_counts[:strips]))
+        tiff = bytearray(data_end + sum(old_counts[:strips]))
+        tiff[0:8] = header
+        tiff[10:ifd_end-4] = table
+        struct.pack_into(prefix + 'H', tiff, 8, entries)
+
+        # copy large values and point the entries at them
+        for ptr, oldoff, length, newoff in moved:
+            struct.pack_into(prefix + 'L', tiff, ptr, newoff)
+            data = self.view(oldoff, length)
+            tiff[newoff:newoff+len(data)] = data
+
+        # add pixel strips, strips that follow each other in the file are
+        # copied in one go, and update strip offset info
+        if strip_len not in (2, 4):
+            strip_ptr = None
+        offset_format = prefix + {2: 'H', 4: 'L'}.get(strip_len, 'L')
+        pos = data_end
+        i = 0
+        while i < strips:
+            start = old_offsets[i]
+            length = 0
+            j = i
+            while j < strips and old_offsets[j] == start + length:
+                if strip_ptr is not None:
+                    struct.pack_into(offset_format, tiff,
+                                     strip_ptr + j*strip_len, pos + length)
+                length += old_counts[j]
+                j += 1
+            data = self.view(start, length)
+            tiff[pos:pos+len(data)] = data
+            pos += length
+            i = j
+
+        return tiff
 
     # decode all the camera-specific MakerNote formats
 
@@ -1576,19 +2044,17 @@ class EXIF_header:
 
         # Fujifilm
         if make == 'FUJIFILM':
+            # the tags keep the header they were read with, so use a copy
+            # of this one (sharing the same tags) with the right settings
+            note_hdr = copy.copy(self)
             # bug: everything else is "Motorola" endian, but the MakerNote
             # is "Intel" endian
-            endian = self.endian
-            self.endian = 'I'
+            note_hdr.endian = 'I'
             # bug: IFD offsets are from beginning of MakerNote, not
             # beginning of file header
-            offset = self.offset
-            self.offset += note.field_offset
+            note_hdr.offset += note.field_offset
             # process note with bogus values (note is actually at offset 12)
-            self.dump_IFD(12, 'MakerNote', dict=MAKERNOTE_FUJIFILM_TAGS)
-            # reset to correct values
-            self.endian = endian
-            self.offset = offset
+            note_hdr.dump_IFD(12, 'MakerNote', dict=MAKERNOTE_FUJIFILM_TAGS)
             return
 
         # Canon
@@ -1623,208 +2089,625 @@ class EXIF_header:
             self.tags['MakerNote '+name]=IFD_Tag(str(val), None, 0, None,
                                                  None, None)
 
+# where to find an embedded thumbnail.  format is 'jpeg' or 'tiff', offset is
+# the file position of the JPEG data or of the thumbnail IFD of an
+# uncompressed TIFF thumbnail, and length is the size of the JPEG data or of
+# the TIFF strips.
+class Thumbnail_Locator:
+    # file to read the thumbnail from when the header no longer has it in
+    # memory, see unmap_tags
+    path = None
+
+    def __init__(self, header, format, offset, length):
+        self.header = header
+        self.format = format
+        # offset relative to the EXIF header
+        self.header_offset = offset
+        self.offset = header.offset + offset
+        self.length = length
+
+    def __repr__(self):
+        return '<%s thumbnail, %d bytes @ %d>' % (self.format.upper(),
+                                                  self.length, self.offset)
+
+    # return the thumbnail as a memoryview.  For a JPEG thumbnail this is a
+    # slice of the in-memory (or mapped) data, for a TIFF thumbnail a new
+    # TIFF file is put together around the strips.  This is done with a
+    # budget of its own, the file's may be spent by now, and going over it
+    # raises ValueError.
+    def view(self):
+        hdr = copy.copy(self.header)
+        hdr.budget = self.header.budget.renewed()
+        f = None
+        if self.path is not None:
+            f = hdr.file = open(self.path, 'rb')
+        try:
+            return self.extract(hdr)
+        except Budget_Exceeded, e:
+            raise ValueError('thumbnail needs %s' % e)
+        finally:
+            if f is not None:
+                f.close()
+
+    # like view, spending hdr's budget
+    def extract(self, hdr):
+        if self.format == 'jpeg':
+            return hdr.view(self.header_offset, self.length)
+        return memoryview(hdr.extract_TIFF_thumbnail(self.header_offset))
+
+    # write the thumbnail to target, which is a file name or a file object
+    def write_to(self, target):
+        data = self.view()
+        if hasattr(target, 'write'):
+            target.write(data)
+        else:
+            with open(target, 'wb') as f:
+                f.write(data)
+
+# how much of a TIFF file to read up front when it can't be mapped, anything
+# past it is read on demand
+TIFF_BLOCK_SIZE = 65536
+
+# map a real file read-only into memory and return a memoryview of it, or
+# None if f isn't something that can be mapped (or is empty).  Slicing the
+# view doesn't copy anything and the mapping stays valid after f is closed,
+# it holds a file descriptor of its own until the view is gone (see
+# unmap_tags).
+def map_file(f):
+    try:
+        fileno = f.fileno()
+    except (AttributeError, EnvironmentError, ValueError):
+        return None
+    try:
+        mapping = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError, OverflowError):
+        return None
+    return memoryview(buffer(mapping))
+
+# the most of a mapped file unmap_tags copies for the tags that decode
+# their values later, if they need more they are decoded right away
+UNMAP_COPY_MAX = 1024 * 1024
+
+# tags are often kept long after their file is closed (a whole catalog of
+# them), so they mustn't keep the mapping of a file, and its file
+# descriptor, alive.  The headers of the tags (those process_file returns,
+# and through hdr all it found) get a copy of just the part of the file
+# that the returned tags still decode their values from.  Anything else is
+# read from the file, which the thumbnail locator opens again from path.
+def unmap_tags(tags, hdr, mapping, path):
+    # what the locator needs of the tags process_file didn't return
+    for name in ('Thumbnail StripOffsets', 'Thumbnail StripByteCounts'):
+        if name in hdr.tags:
+            hdr.tags[name].values
+    headers = {id(hdr): hdr}
+    for tag in dict.values(hdr.tags) + dict.values(tags):
+        if getattr(tag, 'header', None) is not None:
+            headers[id(tag.header)] = tag.header
+        if isinstance(tag, Thumbnail_Locator):
+            tag.path = path
+    lo = hi = None
+    for tag in dict.values(tags):
+        if not isinstance(tag, IFD_Tag) or tag.header is None or \
+                tag.header.data is not mapping:
+            continue
+        # decode_values doesn't read big arrays, see dump_IFD
+        if not (tag.field_type == 2 or tag.count < 1000 or
+                (tag.tag_entry and tag.tag_entry[0] == 'MakerNote')):
+            continue
+        start = tag.header.offset + tag.field_offset
+        end = start + tag.field_length
+        if tag.header.data_pos(tag.field_offset, tag.field_length) < 0:
+            continue
+        if lo is None or start < lo:
+            lo = start
+        if hi is None or end > hi:
+            hi = end
+    if lo is not None and hi - lo > UNMAP_COPY_MAX:
+        # spread all over the file
+        for tag in dict.values(tags):
+            if isinstance(tag, IFD_Tag) and tag.header is not None:
+                tag.values
+                tag.printable
+                tag.header = None
+        lo = None
+    if lo is None:
+        data, data_offset = None, 0
+    else:
+        data_offset = hdr.data_offset
+        data = memoryview(mapping[lo - data_offset:hi - data_offset].tobytes())
+        data_offset = lo
+    for header in headers.values():
+        if header.data is not mapping:
+            continue
+        header.data = data
+        header.data_offset = data_offset
+        header.whole_file = False
+
+# limits for walking the segments of a JPEG file looking for EXIF, so a
+# corrupt file gives up instead of spinning
+JPEG_MAX_SEGMENTS = 256
+JPEG_MAX_SCAN = 16 * 1024 * 1024
+
+# segment identifiers that make process_file fake an EXIF beginning when
+# they come first
+JPEG_FAKE_EXIF_IDS = ('JFIF', 'JFXX', 'OLYM', 'Phot')
+
+# walk the segments of a JPEG file looking for the EXIF APP1 segment.  Only
+# the 4 byte marker/length header of each segment is read (plus the
+# identifier of APPn segments), everything else is skipped with a seek.
+# Returns (offset, length, fake_exif) where offset and length are those of
+# the TIFF data in the APP1 segment, or None if there is no EXIF.  The walk
+# stops at the start of the image data, at JPEG_MAX_SEGMENTS segments or
+# JPEG_MAX_SCAN bytes, or at the first thing that isn't a segment.
+def find_jpeg_exif(f, debug=False):
+    fake_exif = 0
+    base = 2
+    for step in xrange(JPEG_MAX_SEGMENTS):
+        if base > JPEG_MAX_SCAN:
+            if debug: print "Gave up looking for EXIF at", hex(base)
+            return None
+        f.seek(base)
+        header = f.read(4)
+        if len(header) < 2 or header[0] != '\xFF':
+            if debug: print "No segment at base", hex(base)
+            return None
+        marker = ord(header[1])
+        if marker == 0xFF:
+            # fill byte
+            base = base + 1
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            # standalone marker, no length
+            base = base + 2
+            continue
+        if marker in (0xD9, 0xDA) or (0xC0 <= marker <= 0xCF and
+                                      marker not in (0xC4, 0xC8, 0xCC)):
+            # EOI, SOS or SOFn: no more metadata segments
+            if debug: print "Image data at base", hex(base)
+            return None
+        if len(header) < 4:
+            return None
+        length = ord(header[2])*256+ord(header[3])
+        if length < 2:
+            if debug: print "Bad segment length", length, "at base", hex(base)
+            return None
+        if 0xE0 <= marker <= 0xEF:
+            ident = f.read(6)
+            if debug: print "APP%d at base" % (marker - 0xE0), hex(base), "code", repr(ident)
+            if step == 0 and ident[:4] in JPEG_FAKE_EXIF_IDS:
+                # fake an EXIF beginning of file
+                # I don't think this is used. --gd
+                fake_exif = 1
+            if marker == 0xE1 and ident[:4] == 'Exif' and length > 8:
+                return base + 10, length - 8, fake_exif
+        elif debug:
+            print "Segment 0x%02X at base" % marker, hex(base)
+        base = base + length + 2
+    if debug: print "Too many segments, gave up looking for EXIF"
+    return None
+
+# first bytes of TIFF based files: TIFF itself (and most RAW formats built
+# on it), Olympus ORF and Panasonic RW2
+TIFF_MAGIC = ('II*\x00', 'MM\x00*', 'IIRO', 'IIRS', 'MMOR', 'IIU\x00')
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+# most chunks to look at in a PNG or WebP file
+CHUNK_MAX_COUNT = 1024
+
+# return where the TIFF data of an EXIF chunk starts in it and how long it
+# is, given the chunk data position and size.  Some writers keep the
+# 'Exif\0\0' of the JPEG APP1 segment.
+def exif_chunk(f, pos, size):
+    f.seek(pos)
+    if f.read(6) == 'Exif\x00\x00':
+        return pos + 6, size - 6, 0
+    return pos, size, 0
+
+# walk the chunks of a PNG file looking for an eXIf chunk, like
+# find_jpeg_exif only the chunk headers are read.  eXIf has to come before
+# the image data, so the walk stops at the first IDAT.
+def find_png_exif(f, debug=False):
+    pos = 8
+    for step in xrange(CHUNK_MAX_COUNT):
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            return None
+        size, kind = struct.unpack('>L4s', header)
+        if debug: print "PNG chunk %r at" % kind, pos, "size", size
+        if kind == 'eXIf':
+            return exif_chunk(f, pos + 8, size)
+        if kind in ('IDAT', 'IEND'):
+            return None
+        # length, type, data and CRC
+        pos = pos + 12 + size
+    return None
+
+# walk the chunks of a WebP (RIFF) file looking for an EXIF chunk.  It
+# comes after the image data, which is skipped with a seek.
+def find_webp_exif(f, debug=False):
+    f.seek(4)
+    end = struct.unpack('<L', f.read(4))[0] + 8
+    pos = 12
+    for step in xrange(CHUNK_MAX_COUNT):
+        if pos + 8 > end:
+            return None
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            return None
+        kind, size = struct.unpack('<4sL', header)
+        if debug: print "WebP chunk %r at" % kind, pos, "size", size
+        if kind == 'EXIF':
+            return exif_chunk(f, pos + 8, size)
+        if kind == 'VP8X':
+            # the flags say whether there is an EXIF chunk at all
+            if not ord(f.read(1) or '\x00') & 0x08:
+                return None
+        elif step == 0:
+            # simple (lossy or lossless) file, nothing but the image
+            return None
+        # chunks are padded to an even size
+        pos = pos + 8 + size + (size & 1)
+    return None
+
+# convert an EXIF date/time string to seconds since the epoch (local time)
+def exif_time_to_epoch(value):
+    return int(time.mktime(time.strptime(value, '%Y:%m:%d %H:%M:%S')))
+
+# convert a SubSecTime string (the digits of a fraction) to microseconds
+def subsec_to_microseconds(value):
+    value = value.strip()
+    if not value.isdigit():
+        raise ValueError('bad SubSecTime %r' % value)
+    return int(value[:6].ljust(6, '0'))
+
+# convert an OffsetTime string like '+09:00' to seconds east of UTC
+def offset_to_seconds(value):
+    value = value.strip()
+    if value[:1] not in ('+', '-'):
+        raise ValueError('bad OffsetTime %r' % value)
+    hours, minutes = value[1:].split(':')
+    seconds = int(hours) * 3600 + int(minutes) * 60
+    if value[0] == '-':
+        return -seconds
+    return seconds
+
+# named sets of tags for process_file(f, tags=NAME).  Each maps the wanted
+# tag names to a function that converts the tag's printable value; values it
+# rejects with a ValueError are left out of the result
+TAG_PROFILES = {
+    'timestamp': {'Image DateTime': exif_time_to_epoch,
+                  'EXIF DateTimeOriginal': exif_time_to_epoch,
+                  'EXIF SubSecTimeOriginal': subsec_to_microseconds,
+                  'EXIF OffsetTime': offset_to_seconds},
+    }
+
 # process an image file (expects an open file object)
 # this is the function that has to deal with all the arbitrary nasty bits
 # of the EXIF standard
-def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
-    # yah it's cheesy...
-    global detailed
-    detailed = details
+# Everything about a call is kept on its EXIF_header, so several threads can
+# process files at once.
+def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False,
+                 tags=None, use_mmap=True, thumbnail=False, budget=None):
+    # work out which tags we are after, None means all of them
+    profile = None
+    if isinstance(tags, basestring):
+        profile = TAG_PROFILES[tags]
+        wanted = set(profile)
+    elif tags is not None:
+        wanted = set(tags)
+    else:
+        wanted = None
+
+    # is any wanted tag in the IFD with this name?
+    def want(ifd_name):
+        if wanted is None:
+            return True
+        for name in wanted:
+            if name.startswith(ifd_name + ' '):
+                return True
+        return False
+
+    thumbnails = (wanted is None or 'ThumbnailLocator' in wanted or
+                  'JPEGThumbnail' in wanted or 'TIFFThumbnail' in wanted)
+    if wanted is not None and ('JPEGThumbnail' in wanted or
+                               'TIFFThumbnail' in wanted):
+        thumbnail = True
+    # the wanted tags plus whatever else has to be decoded to find them
+    needed = None
+    if wanted is not None:
+        needed = set(wanted)
+        if want('MakerNote') or thumbnails:
+            needed.update(('EXIF MakerNote', 'Image Make',
+                           'MakerNote JPEGThumbnail'))
+        if thumbnails:
+            needed.update('Thumbnail ' + name for name in
+                          ('Compression', 'JPEGInterchangeFormat',
+                           'JPEGInterchangeFormatLength', 'StripOffsets',
+                           'StripByteCounts'))
 
     # by default do not fake an EXIF beginning
     fake_exif = 0
 
     # determine whether it's a JPEG or TIFF
     data = f.read(12)
-    if data[0:4] in ['II*\x00', 'MM\x00*']:
-        # it's a TIFF file
-        f.seek(0)
-        endian = f.read(1)
-        f.read(1)
+    if data[0:4] in TIFF_MAGIC:
+        # it's a TIFF file (or a TIFF based RAW file).  These can be huge
+        # with IFDs, MakerNotes and strips all over the place, so map the
+        # whole thing and let the OS page in what we touch.  Otherwise the
+        # IFDs are usually near the start so keep the first chunk in memory.
+        block = None
+        if use_mmap:
+            block = map_file(f)
+        mapping = block
+        whole_file = block is not None
+        if block is None:
+            f.seek(0)
+            block = f.read(TIFF_BLOCK_SIZE)
+            whole_file = len(block) < TIFF_BLOCK_SIZE
+        endian = data[0]
         offset = 0
-    elif data[0:2] == '\xFF\xD8':
-        # it's a JPEG file
-        if debug: print "JPEG format recognized data[0:2] == '0xFFD8'."
-        base = 2
-        while data[2] == '\xFF' and data[6:10] in ('JFIF', 'JFXX', 'OLYM', 'Phot'):
-            if debug: print "data[2] == 0xxFF data[3]==%x and data[6:10] = %s"%(ord(data[3]),data[6:10])
-            length = ord(data[4])*256+ord(data[5])
-            if debug: print "Length offset is",length
-            f.read(length-8)
-            # fake an EXIF beginning of file
-            # I don't think this is used. --gd
-            data = '\xFF\x00'+f.read(10)
-            fake_exif = 1
-            if base>2: 
-                if debug: print "added to base "
-                base = base + length + 4 -2
-            else: 
-                if debug: print "added to zero "
-                base = length + 4
-            if debug: print "Set segment base to",base
-
-        # Big ugly patch to deal with APP2 (or other) data coming before APP1
-        f.seek(0)
-        data = f.read(base+4000) # in theory, this could be insufficient since 64K is the maximum size--gd
-        # base = 2
-        while 1:
-            if debug: print "Segment base 0x%X" % base
-            if data[base:base+2]=='\xFF\xE1':
-                # APP1
-                if debug: print "APP1 at base",hex(base)
-                if debug: print "Length",hex(ord(data[base+2])), hex(ord(data[base+3]))
-                if debug: print "Code",data[base+4:base+8]
-                if data[base+4:base+8] == "Exif":
-                    if debug: print "Decrement base by",2,"to get to pre-segment header (for compatibility with later code)"
-                    base = base-2
-                    break
-                if debug: print "Increment base by",ord(data[base+2])*256+ord(data[base+3])+2
-                base=base+ord(data[base+2])*256+ord(data[base+3])+2
-            elif data[base:base+2]=='\xFF\xE0':
-                # APP0
-                if debug: print "APP0 at base",hex(base)
-                if debug: print "Length",hex(ord(data[base+2])), hex(ord(data[base+3]))
-                if debug: print "Code",data[base+4:base+8]
-                if debug: print "Increment base by",ord(data[base+2])*256+ord(data[base+3])+2
-                base=base+ord(data[base+2])*256+ord(data[base+3])+2
-            elif data[base:base+2]=='\xFF\xE2':
-                # APP2
-                if debug: print "APP2 at base",hex(base)
-                if debug: print "Length",hex(ord(data[base+2])), hex(ord(data[base+3]))
-                if debug: print "Code",data[base+4:base+8]
-                if debug: print "Increment base by",ord(data[base+2])*256+ord(data[base+3])+2
-                base=base+ord(data[base+2])*256+ord(data[base+3])+2
-            elif data[base:base+2]=='\xFF\xEE':
-                # APP14
-                if debug: print "APP14 Adobe segment at base",hex(base)
-                if debug: print "Length",hex(ord(data[base+2])), hex(ord(data[base+3]))
-                if debug: print "Code",data[base+4:base+8]
-                if debug: print "Increment base by",ord(data[base+2])*256+ord(data[base+3])+2
-                print "There is useful EXIF-like data here, but we have no parser for it."
-                base=base+ord(data[base+2])*256+ord(data[base+3])+2
-            elif data[base:base+2]=='\xFF\xDB':
-                if debug: print "JPEG image data at base",hex(base),"No more segments are expected."
-                # sys.exit(0)
-                break
-            elif data[base:base+2]=='\xFF\xD8':
-                # APP12
-                if debug: print "FFD8 segment at base",hex(base)
-                if debug: print "Got",hex(ord(data[base])), hex(ord(data[base+1])),"and", data[4+base:10+base], "instead."
-                if debug: print "Length",hex(ord(data[base+2])), hex(ord(data[base+3]))
-                if debug: print "Code",data[base+4:base+8]
-                if debug: print "Increment base by",ord(data[base+2])*256+ord(data[base+3])+2
-                base=base+ord(data[base+2])*256+ord(data[base+3])+2
-            elif data[base:base+2]=='\xFF\xEC':
-                # APP12
-                if debug: print "APP12 XMP (Ducky) or Pictureinfo segment at base",hex(base)
-                if debug: print "Got",hex(ord(data[base])), hex(ord(data[base+1])),"and", data[4+base:10+base], "instead."
-                if debug: print "Length",hex(ord(data[base+2])), hex(ord(data[base+3]))
-                if debug: print "Code",data[base+4:base+8]
-                if debug: print "Increment base by",ord(data[base+2])*256+ord(data[base+3])+2
-                print "There is useful EXIF-like data here (quality, comment, copyright), but we have no parser for it."
-                base=base+ord(data[base+2])*256+ord(data[base+3])+2
-            else: 
-                try:
-                    if debug: print "Unexpected/unhandled segment type or file content."
-                    if debug: print "Got",hex(ord(data[base])), hex(ord(data[base+1])),"and", data[4+base:10+base], "instead."
-                    if debug: print "Increment base by",ord(data[base+2])*256+ord(data[base+3])+2
-                except: pass
-                try: base=base+ord(data[base+2])*256+ord(data[base+3])+2
-                except: pass
-
-        f.seek(base+12)
-        if data[2+base] == '\xFF' and data[6+base:10+base] == 'Exif':
-            # detected EXIF header
-            offset = f.tell()
-            endian = f.read(1)
-            #HACK TEST:  endian = 'M'
-        elif data[2+base] == '\xFF' and data[6+base:10+base+1] == 'Ducky':
-            # detected Ducky header.
-            if debug: print "EXIF-like header (normally 0xFF and code):",hex(ord(data[2+base])) , "and", data[6+base:10+base+1]
-            offset = f.tell()
-            endian = f.read(1)
-        elif data[2+base] == '\xFF' and data[6+base:10+base+1] == 'Adobe':
-            # detected APP14 (Adobe)
-            if debug: print "EXIF-like header (normally 0xFF and code):",hex(ord(data[2+base])) , "and", data[6+base:10+base+1]
-            offset = f.tell()
-            endian = f.read(1)
+    else:
+        if data[0:2] == '\xFF\xD8':
+            # it's a JPEG file
+            if debug: print "JPEG format recognized data[0:2] == '0xFFD8'."
+            found = find_jpeg_exif(f, debug)
+        elif data[0:8] == PNG_SIGNATURE:
+            if debug: print "PNG format recognized."
+            found = find_png_exif(f, debug)
+        elif data[0:4] == 'RIFF' and data[8:12] == 'WEBP':
+            if debug: print "WebP format recognized."
+            found = find_webp_exif(f, debug)
         else:
+            # file format not recognized
+            if debug: print "file format not recognized"
+            return {}
+        if found is None:
             # no EXIF information
-            if debug: print "No EXIF header expected data[2+base]==0xFF and data[6+base:10+base]===Exif (or Duck)"
-            if debug: print " but got",hex(ord(data[2+base])) , "and", data[6+base:10+base+1]
+            if debug: print "No EXIF header found"
             return {}
-    else:
-        # file format not recognized
-        if debug: print "file format not recognized"
-        return {}
+        # read the rest of the APP1 segment (or EXIF chunk) in one go
+        offset, length, fake_exif = found
+        f.seek(offset)
+        block = read_at_most(f, length)
+        endian = block[0:1]
+        whole_file = False
+        mapping = None
 
     # deal with the EXIF info we found
     if debug:
         print "Endian format is ",endian
-        print {'I': 'Intel', 'M': 'Motorola', '\x01':'Adobe Ducky', 'd':'XMP/Adobe unknown' }[endian], 'format'
-    hdr = EXIF_header(f, endian, offset, fake_exif, strict, debug)
-    ifd_list = hdr.list_IFDs()
-    ctr = 0
-    for i in ifd_list:
-        if ctr == 0:
-            IFD_name = 'Image'
-        elif ctr == 1:
-            IFD_name = 'Thumbnail'
-            thumb_ifd = i
+        print {'I': 'Intel', 'M': 'Motorola'}.get(endian, 'unknown'), 'format'
+    hdr = EXIF_header(f, endian, offset, fake_exif, strict, debug,
+                      data=block, data_offset=offset, details=details,
+                      budget=Parse_Budget(**(budget or {})),
+                      whole_file=whole_file)
+    # stop where we are, with whatever tags we have, if the file goes over
+    # its budget
+    thumb_ifd = None
+    try:
+        # don't walk the IFD chain further than needed
+        if want('IFD'):
+            ifd_list = hdr.list_IFDs()
+        elif want('Thumbnail') or thumbnails:
+            ifd_list = hdr.list_IFDs(2)
         else:
-            IFD_name = 'IFD %d' % ctr
-        if debug:
-            print ' IFD %d (%s) at offset %d:' % (ctr, IFD_name, i)
-        hdr.dump_IFD(i, IFD_name, stop_tag=stop_tag)
-        # EXIF IFD
-        exif_off = hdr.tags.get(IFD_name+' ExifOffset')
-        if exif_off:
+            ifd_list = hdr.list_IFDs(1)
+        ctr = 0
+        for i in ifd_list:
+            if ctr == 0:
+                IFD_name = 'Image'
+            elif ctr == 1:
+                IFD_name = 'Thumbnail'
+                thumb_ifd = i
+            else:
+                IFD_name = 'IFD %d' % ctr
+            if needed is not None:
+                # only follow the sub-IFD pointers we need
+                if want('EXIF') or 'EXIF MakerNote' in needed:
+                    needed.add(IFD_name+' ExifOffset')
+                    needed.add('EXIF SubIFD InteroperabilityOffset')
+                if want('GPS'):
+                    needed.add(IFD_name+' GPSInfo')
             if debug:
-                print ' EXIF SubIFD at offset %d:' % exif_off.values[0]
-            hdr.dump_IFD(exif_off.values[0], 'EXIF', stop_tag=stop_tag)
-            # Interoperability IFD contained in EXIF IFD
-            intr_off = hdr.tags.get('EXIF SubIFD InteroperabilityOffset')
-            if intr_off:
+                print ' IFD %d (%s) at offset %d:' % (ctr, IFD_name, i)
+            hdr.dump_IFD(i, IFD_name, stop_tag=stop_tag, wanted=needed)
+            # EXIF IFD
+            exif_off = hdr.tags.get(IFD_name+' ExifOffset')
+            if exif_off:
                 if debug:
-                    print ' EXIF Interoperability SubSubIFD at offset %d:' \
-                          % intr_off.values[0]
-                hdr.dump_IFD(intr_off.values[0], 'EXIF Interoperability',
-                             dict=INTR_TAGS, stop_tag=stop_tag)
-        # GPS IFD
-        gps_off = hdr.tags.get(IFD_name+' GPSInfo')
-        if gps_off:
-            if debug:
-                print ' GPS SubIFD at offset %d:' % gps_off.values[0]
-            hdr.dump_IFD(gps_off.values[0], 'GPS', dict=GPS_TAGS, stop_tag=stop_tag)
-        ctr += 1
-
-    # extract uncompressed TIFF thumbnail
+                    print ' EXIF SubIFD at offset %d:' % exif_off.values[0]
+                hdr.dump_IFD(exif_off.values[0], 'EXIF', stop_tag=stop_tag,
+                             wanted=needed)
+                # Interoperability IFD contained in EXIF IFD
+                intr_off = hdr.tags.get('EXIF SubIFD InteroperabilityOffset')
+                if intr_off:
+                    if debug:
+                        print ' EXIF Interoperability SubSubIFD at offset %d:' \
+                              % intr_off.values[0]
+                    hdr.dump_IFD(intr_off.values[0], 'EXIF Interoperability',
+                                 dict=INTR_TAGS, stop_tag=stop_tag, wanted=needed)
+            # GPS IFD
+            gps_off = hdr.tags.get(IFD_name+' GPSInfo')
+            if gps_off:
+                if debug:
+                    print ' GPS SubIFD at offset %d:' % gps_off.values[0]
+                hdr.dump_IFD(gps_off.values[0], 'GPS', dict=GPS_TAGS, stop_tag=stop_tag,
+                             wanted=needed)
+            ctr += 1
+    except Budget_Exceeded, e:
+        if debug: print "Stopped parsing:", e
+        hdr.tags.truncated = True
+
+    # find the thumbnail, its data is only read when somebody asks for it
+    locator = None
     thumb = hdr.tags.get('Thumbnail Compression')
-    if thumb and thumb.printable == 'Uncompressed TIFF':
-        hdr.extract_TIFF_thumbnail(thumb_ifd)
-
-    # JPEG thumbnail (thankfully the JPEG data is stored as a unit)
     thumb_off = hdr.tags.get('Thumbnail JPEGInterchangeFormat')
-    if thumb_off:
-        f.seek(offset+thumb_off.values[0])
+    if not thumbnails:
+        pass
+    elif thumb_off and 'Thumbnail JPEGInterchangeFormatLength' in hdr.tags:
+        # JPEG thumbnail (thankfully the JPEG data is stored as a unit)
         size = hdr.tags['Thumbnail JPEGInterchangeFormatLength'].values[0]
-        hdr.tags['JPEGThumbnail'] = f.read(size)
-
-    # deal with MakerNote contained in EXIF IFD
+        locator = Thumbnail_Locator(hdr, 'jpeg', thumb_off.values[0], size)
+    elif (thumb and thumb.values[0] == 1 and thumb_ifd is not None and
+          'Thumbnail StripOffsets' in hdr.tags and
+          'Thumbnail StripByteCounts' in hdr.tags):
+        # uncompressed TIFF thumbnail
+        size = sum(hdr.tags['Thumbnail StripByteCounts'].values)
+        locator = Thumbnail_Locator(hdr, 'tiff', thumb_ifd, size)
+
+    # deal with MakerNote contained in EXIF IFD when a MakerNote tag is
+    # first asked for, if the whole file is in memory (and not mapped, see
+    # unmap_tags).  Otherwise now, its values can be anywhere in the file
+    # and it may be closed by the time the MakerNote is asked for.
     # (Some apps use MakerNote tags but do not use a format for which we
     # have a description, do not process these).
-    if 'EXIF MakerNote' in hdr.tags and 'Image Make' in hdr.tags and detailed:
-        hdr.decode_maker_note()
+    maker_note_thumbnail = thumbnail or (wanted is not None and want('MakerNote'))
+    if ('EXIF MakerNote' in hdr.tags and 'Image Make' in hdr.tags and details
+            and (wanted is None or maker_note_thumbnail)):
+        hdr.tags.defer_maker_note(hdr)
+        if not hdr.whole_file or mapping is not None:
+            hdr.tags.decode_maker_note()
 
     # Sometimes in a TIFF file, a JPEG thumbnail is hidden in the MakerNote
-    # since it's not allowed in a uncompressed TIFF IFD
-    if 'JPEGThumbnail' not in hdr.tags:
+    # since it's not allowed in a uncompressed TIFF IFD (looking for it
+    # decodes the MakerNote, so only when the thumbnail itself or MakerNote
+    # tags were asked for)
+    if (thumbnails and maker_note_thumbnail and
+            (locator is None or locator.format != 'jpeg')):
         thumb_off=hdr.tags.get('MakerNote JPEGThumbnail')
         if thumb_off:
-            f.seek(offset+thumb_off.values[0])
-            hdr.tags['JPEGThumbnail']=file.read(thumb_off.field_length)
+            locator = Thumbnail_Locator(hdr, 'jpeg', thumb_off.values[0],
+                                        thumb_off.field_length)
 
-    return hdr.tags
+    if locator is not None:
+        hdr.tags['ThumbnailLocator'] = locator
+        if thumbnail:
+            try:
+                if locator.format == 'jpeg':
+                    hdr.tags['JPEGThumbnail'] = locator.extract(hdr).tobytes()
+                else:
+                    hdr.tags['TIFFThumbnail'] = locator.extract(hdr).tobytes()
+            except Budget_Exceeded, e:
+                if debug: print "Stopped reading thumbnail:", e
+                hdr.tags.truncated = True
+
+    if wanted is None:
+        result = hdr.tags
+    else:
+        result = pick_tags(hdr, wanted, profile, debug)
+    if mapping is not None:
+        path = getattr(f, 'name', None)
+        if not isinstance(path, basestring) or not os.path.isfile(path):
+            path = None
+        unmap_tags(result, hdr, mapping, path)
+    return result
+
+# the wanted tags of hdr, converted with profile if given
+def pick_tags(hdr, wanted, profile, debug):
+    # drop the tags that were only needed along the way
+    result = EXIF_Tags()
+    result.truncated = hdr.tags.truncated
+    for name in wanted:
+        if name not in hdr.tags:
+            continue
+        if profile is None:
+            result[name] = hdr.tags[name]
+        else:
+            try:
+                result[name] = profile[name](str(hdr.tags[name]))
+            except ValueError:
+                if debug: print "Can't convert %s: %r" % (name, str(hdr.tags[name]))
+    return result
+
+# file-like wrapper around a stream that can only be read forwards, which
+# lets process_file seek around in it.  Bytes read from the stream are kept
+# from the last forward seek past them on, or all of them if keep_all is
+# set, and seeking back before what's kept raises IOError.
+class Stream_Reader:
+    # how much to read from the stream at a time
+    chunk_size = 8192
+
+    def __init__(self, stream, keep_all=False, max_kept=64 * 1024 * 1024):
+        self.stream = stream
+        self.keep_all = keep_all
+        self.max_kept = max_kept
+        # stream position of data[0]
+        self.start = 0
+        self.data = bytearray()
+        self.pos = 0
+        # bytes read from the stream so far
+        self.bytes_read = 0
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset = self.pos + offset
+        elif whence != 0:
+            raise IOError("can't seek from the end of a stream")
+        if offset < self.start:
+            raise IOError("can't seek back to %d in a stream" % offset)
+        self.pos = offset
+
+    # read up to length more bytes from the stream, '' at the end
+    def fill(self, length):
+        chunk = read_at_most(self.stream, max(length, self.chunk_size))
+        self.bytes_read += len(chunk)
+        return chunk
+
+    def read(self, length=-1):
+        end = self.start + len(self.data)
+        if self.pos > end and not self.keep_all:
+            # skip ahead, dropping what we have
+            while end < self.pos:
+                chunk = self.fill(self.pos - end)
+                if not chunk:
+                    break
+                end += len(chunk)
+            self.data = bytearray(chunk[len(chunk) - (end - self.pos):])
+            self.start = self.pos
+        if length < 0:
+            want = None
+        else:
+            want = self.pos + length
+        while want is None or self.start + len(self.data) < want:
+            if len(self.data) > self.max_kept:
+                raise IOError('more than %d bytes of stream kept' % self.max_kept)
+            if want is None:
+                chunk = self.fill(self.chunk_size)
+            else:
+                chunk = self.fill(want - self.start - len(self.data))
+            if not chunk:
+                break
+            self.data.extend(chunk)
+        pos = self.pos - self.start
+        if want is None:
+            result = str(self.data[pos:])
+        else:
+            result = str(self.data[pos:pos + length])
+        self.pos += len(result)
+        return result
+
+# process an image in a stream that can't seek, see process_file for the
+# options.  A JPEG stream is read up to the end of its EXIF segment, a TIFF
+# based one as far as the last IFD or value looked at.  The MakerNote is
+# decoded right away and the Stream_Reader used is left in tags.reader.
+def process_stream(stream, **kwargs):
+    reader = Stream_Reader(stream)
+    # TIFF offsets can point anywhere, so keep it all
+    reader.keep_all = reader.read(4) in TIFF_MAGIC
+    reader.seek(0)
+    kwargs['use_mmap'] = False
+    tags = process_file(reader, **kwargs)
+    if isinstance(tags, EXIF_Tags):
+        # the stream may be gone by the time somebody looks at the MakerNote
+        tags.decode_maker_note()
+        tags.reader = reader
+    return tags
 
 
 # show command line usage
@@ -1835,17 +2718,93 @@ def usage(exit_status):
     msg += '-t TAG --stop-tag TAG   Stop processing when this tag is retrieved.\n'
     msg += '-s --strict   Run in strict mode (stop on errors).\n'
     msg += '-d --debug   Run in debug mode (display extra info).\n'
+    msg += '-b --batch   Print one JSON object per file, files can be directories.\n'
+    msg += '-j N --jobs N   Number of processes for batch mode (default: all CPUs).\n'
+    msg += '-T TAGS --tags TAGS   Only these comma separated tags, or a set of\n'
+    msg += '                      tags like "timestamp".\n'
     print msg
     sys.exit(exit_status)
 
+# list the files named by paths for batch mode, going into directories
+def batch_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    yield os.path.join(dirpath, filename)
+        else:
+            yield path
+
+# turn a tag value into something json can take
+def batch_value(value):
+    if isinstance(value, IFD_Tag):
+        value = value.printable
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, (int, long, float)):
+        return value
+    return str(value).decode('utf-8', 'replace')
+
+# process one file for batch mode, returns its JSON line
+def batch_process(job):
+    filename, options = job
+    result = {'file': filename}
+    try:
+        f = open(filename, 'rb')
+        try:
+            tags = process_file(f, **options)
+        finally:
+            f.close()
+        result['tags'] = dict((name, batch_value(value))
+                              for name, value in tags.items()
+                              if name not in ('JPEGThumbnail', 'TIFFThumbnail',
+                                              'ThumbnailLocator'))
+        if getattr(tags, 'truncated', False):
+            result['truncated'] = True
+    except Exception, e:
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+    return json.dumps(result, sort_keys=True)
+
+# print a JSON line for each of the files named by paths, using jobs
+# processes
+def batch(paths, options, jobs=None):
+    import itertools
+    import multiprocessing
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    work = ((filename, options) for filename in batch_files(paths))
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        lines = pool.imap_unordered(batch_process, work, 16)
+    else:
+        pool = None
+        lines = itertools.imap(batch_process, work)
+    try:
+        for line in lines:
+            sys.stdout.write(line + '\n')
+            sys.stdout.flush()
+    except IOError, e:
+        if e.errno != errno.EPIPE:
+            raise
+        # whatever reads the output (head, say) stopped, so stop too.
+        # Pool.terminate() hangs if it kills a worker in the middle of
+        # sending a result, so the workers are killed here and the process
+        # leaves without the pool's exit handler (or flushing stdout again)
+        for process in multiprocessing.active_children():
+            process.terminate()
+        os._exit(1)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
 # library test/debug function (dump given files)
 if __name__ == '__main__':
-    import sys
     import getopt
 
     # parse command line options/arguments
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hqsdt:v", ["help", "quick", "strict", "debug", "stop-tag="])
+        opts, args = getopt.getopt(sys.argv[1:], "hqsdt:vbj:T:", ["help", "quick", "strict", "debug", "stop-tag=", "batch", "jobs=", "tags="])
     except getopt.GetoptError:
         usage(2)
     if args == []:
@@ -1854,6 +2813,9 @@ if __name__ == '__main__':
     stop_tag = 'UNDEF'
     debug = False
     strict = False
+    batch_mode = False
+    jobs = None
+    tags = None
     for o, a in opts:
         if o in ("-h", "--help"):
             usage(0)
@@ -1865,6 +2827,23 @@ if __name__ == '__main__':
             strict = True
         if o in ("-d", "--debug"):
             debug = True
+        if o in ("-b", "--batch"):
+            batch_mode = True
+        if o in ("-j", "--jobs"):
+            try:
+                jobs = int(a)
+            except ValueError:
+                usage(2)
+        if o in ("-T", "--tags"):
+            if a in TAG_PROFILES:
+                tags = a
+            else:
+                tags = [tag.strip() for tag in a.split(',') if tag.strip()]
+
+    if batch_mode:
+        batch(args, {'stop_tag': stop_tag, 'details': detailed,
+                     'strict': strict, 'tags': tags}, jobs)
+        sys.exit(0)
 
     # output info for each file
     for filename in args:
@@ -1875,7 +2854,7 @@ if __name__ == '__main__':
             continue
         print filename + ':'
         # get the tags
-        data = process_file(file, stop_tag=stop_tag, details=detailed, strict=strict, debug=debug)
+        data = process_file(file, stop_tag=stop_tag, details=detailed, strict=strict, debug=debug, tags=tags)
         if not data:
             print 'No EXIF information found'
             continue
@@ -1883,14 +2862,20 @@ if __name__ == '__main__':
         x=data.keys()
         x.sort()
         for i in x:
-            if i in ('JPEGThumbnail', 'TIFFThumbnail'):
+            if i in ('JPEGThumbnail', 'TIFFThumbnail', 'ThumbnailLocator'):
+                continue
+            if not isinstance(data[i], IFD_Tag):
+                # converted by a tag profile
+                print '   %s: %s' % (i, data[i])
                 continue
             try:
                 print '   %s (%s): %s' % \
                       (i, FIELD_TYPES[data[i].field_type][2], data[i].printable)
             except:
                 print 'error', i, '"', data[i], '"'
-        if 'JPEGThumbnail' in data:
-            print 'File has JPEG thumbnail'
+        if 'ThumbnailLocator' in data:
+            print 'File has %s thumbnail' % data['ThumbnailLocator'].format.upper()
+        if data.truncated:
+            print 'File went over the parse budget, not all tags were read'
         print
 
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Kyle Kawamura
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Capture times of ISO base media files: HEIC/HEIF stills (from their EXIF
+item) and MP4/MOV videos (from the movie header).  Only box headers and the
+few boxes needed are read, everything else is skipped with a seek, so a 4 GB
+video costs a handful of small reads.
+"""
+
+import struct
+from StringIO import StringIO
+
+import EXIF
+
+# most boxes to look at on one level, so a corrupt file gives up
+MAX_BOXES = 1024
+
+# biggest box that is read into memory (meta, iinf, iloc, the EXIF item)
+MAX_READ = 4 * 1024 * 1024
+
+# seconds from 1904-01-01 (QuickTime/MP4 time) to 1970-01-01
+MP4_EPOCH_OFFSET = 2082844800
+
+# -----------------------------------------------------------------------------
+# Box walking
+# -----------------------------------------------------------------------------
+def is_bmff(f):
+    """True if f starts with an ftyp box."""
+    f.seek(4)
+    return f.read(4) == 'ftyp'
+
+def brands(f):
+    """Return the major and compatible brands of the ftyp box."""
+    f.seek(0)
+    size, kind = struct.unpack('>L4s', f.read(8))
+    data = f.read(max(min(size, 256) - 8, 0))
+    return [data[0:4]] + [data[i:i+4] for i in range(8, len(data) - 3, 4)]
+
+def walk_boxes(f, start, end):
+    """Yield (type, data position, data size) for the boxes from start to
+    end, reading only their headers.  end can be None for the end of the
+    file."""
+    pos = start
+    for step in xrange(MAX_BOXES):
+        if end is not None and pos + 8 > end:
+            return
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, kind = struct.unpack('>L4s', header)
+        header_size = 8
+        if size == 1:
+            # 64 bit size follows the type
+            large = f.read(8)
+            if len(large) < 8:
+                return
+            size = struct.unpack('>Q', large)[0]
+            header_size = 16
+        elif size == 0:
+            # box goes on to the end of the file (or of its parent)
+            if end is None:
+                f.seek(0, 2)
+                size = f.tell() - pos
+            else:
+                size = end - pos
+        if size < header_size:
+            return
+        yield kind, pos + header_size, size - header_size
+        pos = pos + size
+
+def find_box(f, kind, start, end):
+    """Return (data position, data size) of the first box of kind, or None."""
+    for box_kind, pos, size in walk_boxes(f, start, end):
+        if box_kind == kind:
+            return pos, size
+    return None
+
+def read_box(f, box):
+    """Read the data of a box found by find_box, None if it's too big."""
+    pos, size = box
+    if size > MAX_READ:
+        return None
+    f.seek(pos)
+    return f.read(size)
+
+def unpack_int(data, pos, size):
+    """Return the size byte big-endian unsigned integer at pos and the
+    position after it."""
+    if size == 0:
+        return 0, pos
+    code = {1: '>B', 2: '>H', 4: '>L', 8: '>Q'}[size]
+    return struct.unpack_from(code, data, pos)[0], pos + size
+
+# -----------------------------------------------------------------------------
+# HEIF
+# -----------------------------------------------------------------------------
+def exif_item_id(iinf):
+    """Return the item ID of the EXIF item in an iinf box, or None."""
+    version = ord(iinf[0])
+    if version == 0:
+        count, pos = unpack_int(iinf, 4, 2)
+    else:
+        count, pos = unpack_int(iinf, 4, 4)
+    for step in xrange(min(count, MAX_BOXES)):
+        if pos + 8 > len(iinf):
+            return None
+        size, kind = struct.unpack_from('>L4s', iinf, pos)
+        if size < 8:
+            return None
+        if kind == 'infe':
+            version = ord(iinf[pos+8])
+            if version == 2 and size >= 20:
+                item_id, item_type = struct.unpack_from('>H2x4s', iinf, pos + 12)
+            elif version == 3 and size >= 22:
+                item_id, item_type = struct.unpack_from('>L2x4s', iinf, pos + 12)
+            else:
+                item_id, item_type = None, None
+            if item_type == 'Exif':
+                return item_id
+        pos = pos + size
+    return None
+
+def item_extents(iloc, wanted_id):
+    """Return (construction method, [(offset, length), ...]) for an item in
+    an iloc box, or None."""
+    version = ord(iloc[0])
+    offset_size = ord(iloc[4]) >> 4
+    length_size = ord(iloc[4]) & 0x0F
+    base_offset_size = ord(iloc[5]) >> 4
+    if version in (1, 2):
+        index_size = ord(iloc[5]) & 0x0F
+    else:
+        index_size = 0
+    if version < 2:
+        count, pos = unpack_int(iloc, 6, 2)
+        id_size = 2
+    else:
+        count, pos = unpack_int(iloc, 6, 4)
+        id_size = 4
+    for step in xrange(min(count, MAX_BOXES)):
+        item_id, pos = unpack_int(iloc, pos, id_size)
+        method = 0
+        if version in (1, 2):
+            method, pos = unpack_int(iloc, pos, 2)
+            method = method & 0x0F
+        # data_reference_index
+        pos = pos + 2
+        base_offset, pos = unpack_int(iloc, pos, base_offset_size)
+        extent_count, pos = unpack_int(iloc, pos, 2)
+        extents = []
+        for extent in xrange(extent_count):
+            if index_size:
+                pos = pos + index_size
+            offset, pos = unpack_int(iloc, pos, offset_size)
+            length, pos = unpack_int(iloc, pos, length_size)
+            extents.append((base_offset + offset, length))
+        if item_id == wanted_id:
+            return method, extents
+    return None
+
+def read_exif(f, **kwargs):
+    """Return the EXIF tags of a HEIF file, like EXIF.process_file (which
+    gets kwargs), or {} if there are none."""
+    try:
+        meta = find_box(f, 'meta', 0, None)
+        if meta is None:
+            return {}
+        # meta is a full box, its children start after version and flags
+        start, end = meta[0] + 4, meta[0] + meta[1]
+        iinf = find_box(f, 'iinf', start, end)
+        iloc = find_box(f, 'iloc', start, end)
+        if iinf is None or iloc is None:
+            return {}
+        item_id = exif_item_id(read_box(f, iinf) or '\0' * 8)
+        if item_id is None:
+            return {}
+        found = item_extents(read_box(f, iloc) or '\0' * 8, item_id)
+        if found is None:
+            return {}
+        method, extents = found
+        if method == 0:
+            # offsets in the file
+            base = 0
+        elif method == 1:
+            # offsets in the idat box
+            idat = find_box(f, 'idat', start, end)
+            if idat is None:
+                return {}
+            base = idat[0]
+        else:
+            return {}
+        data = ''
+        for offset, length in extents:
+            if len(data) + length > MAX_READ:
+                return {}
+            f.seek(base + offset)
+            data += f.read(length)
+    except (struct.error, IndexError, KeyError):
+        return {}
+    # the item starts with the offset of the TIFF header past the offset
+    if len(data) < 4:
+        return {}
+    skip = struct.unpack('>L', data[0:4])[0]
+    return EXIF.process_file(StringIO(data[4+skip:]), **kwargs)
+
+# -----------------------------------------------------------------------------
+# MP4/MOV
+# -----------------------------------------------------------------------------
+def read_creation_time(f):
+    """Return the movie creation time (seconds since the epoch) from the
+    mvhd box, or None if it's missing or not set."""
+    moov = find_box(f, 'moov', 0, None)
+    if moov is None:
+        return None
+    mvhd = find_box(f, 'mvhd', moov[0], moov[0] + moov[1])
+    if mvhd is None:
+        return None
+    f.seek(mvhd[0])
+    data = f.read(12)
+    if len(data) < 12:
+        return None
+    if ord(data[0]) == 1:
+        # 64 bit times
+        creation = struct.unpack('>Q', data[4:12])[0]
+    else:
+        creation = struct.unpack('>L', data[4:8])[0]
+    if not creation:
+        return None
+    return creation - MP4_EPOCH_OFFSET
+
+# -----------------------------------------------------------------------------
+# Capture time
+# -----------------------------------------------------------------------------
+def capture_time(f):
+    """Return the capture time of a HEIF still or MP4/MOV video in seconds
+    since the epoch, or None if the file doesn't say.  HEIF files use the
+    same EXIF tags as the JPEG import, videos the movie creation time."""
+    if not is_bmff(f):
+        return None
+    if set(brands(f)) & set(['heic', 'heix', 'heim', 'heis', 'mif1', 'msf1', 'avif']):
+        tags = read_exif(f, tags='timestamp')
+        return tags.get('Image DateTime', tags.get('EXIF DateTimeOriginal'))
+    return read_creation_time(f)
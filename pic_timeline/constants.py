@@ -45,5 +45,17 @@ LEVELS = {'debug'   : DEBUG,
           'critical': CRITICAL
          }
 
+# image files that can be added from a source: JPEG, TIFF and the TIFF based
+# RAW formats, PNG, WebP, HEIF and videos
+IMAGE_EXTENSIONS = [".jpg", ".jpeg",
+                    ".tif", ".tiff", ".dng",
+                    ".cr2", ".nef", ".nrw", ".arw", ".srf", ".sr2", ".orf",
+                    ".rw2", ".pef", ".srw",
+                    ".png", ".webp",
+                    ".heic", ".heif", ".mov", ".mp4", ".m4v", ".3gp"]
+
+# the ones that are ISO base media files, see bmff.py
+BMFF_EXTENSIONS = [".heic", ".heif", ".mov", ".mp4", ".m4v", ".3gp"]
+
 # DateTimeDialog
 CLEAR_OVERRIDE = "clear"
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Kyle Kawamura
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Finding the image files of a source, including the ones in its sub
+directories (DCIM/100CANON, DCIM/101CANON...).  Directories are listed by a
+few threads at once and every file's stat result is kept, so the import
+doesn't have to stat it again.
+
+The scandir package is used when it's installed, it knows which entries
+are directories without a stat and on Windows has the stat results from
+the listing for free.  Without it os.listdir and os.stat do the same.
+"""
+
+import fnmatch
+import logging
+import os
+import Queue
+import re
+import stat
+import threading
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+from constants import IMAGE_EXTENSIONS
+
+IMAGE_EXTENSION_SET = frozenset(IMAGE_EXTENSIONS)
+
+# threads listing directories at once
+DEF_WALK_THREADS = 4
+
+# -----------------------------------------------------------------------------
+# Helpers
+# -----------------------------------------------------------------------------
+def compile_patterns(patterns):
+    """Return one regular expression matching any of the shell style
+    patterns (case insensitive, '/' separates directories), or None if
+    there are none."""
+    patterns = [p.strip().replace('\\', '/') for p in patterns if p.strip()]
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:%s)' % fnmatch.translate(p) for p in patterns),
+                      re.IGNORECASE)
+
+def split_patterns(value):
+    """Split a ';' separated list of patterns from the ini file."""
+    return [p for p in value.split(';') if p.strip()]
+
+def is_image(name):
+    return os.path.splitext(name)[1].lower() in IMAGE_EXTENSION_SET
+
+def list_dir(path):
+    """Return ([(name, stat result), ...] of the image files, [names of sub
+    directories]) of a directory.  Links to directories aren't followed,
+    they could go round in circles."""
+    files = []
+    dirs = []
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.name)
+            elif is_image(entry.name) and entry.is_file():
+                files.append((entry.name, entry.stat()))
+        return files, dirs
+    for name in os.listdir(path):
+        try:
+            st = os.stat(os.path.join(path, name))
+        except os.error:
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            if not os.path.islink(os.path.join(path, name)):
+                dirs.append(name)
+        elif stat.S_ISREG(st.st_mode) and is_image(name):
+            files.append((name, st))
+    return files, dirs
+
+# -----------------------------------------------------------------------------
+# class PathFilter
+#        Include and exclude patterns for paths inside a source
+# -----------------------------------------------------------------------------
+class PathFilter(object):
+    """Decides which files and directories of a source are looked at.  Paths
+    are relative to the source, with the platform's separator."""
+
+    def __init__(self, recursive=True, include=None, exclude=None):
+        self.recursive = recursive
+        self.include_re = compile_patterns(include or [])
+        self.exclude_re = compile_patterns(exclude or [])
+
+    def file(self, rel):
+        rel = rel.replace(os.sep, '/')
+        if self.include_re and not self.include_re.match(rel):
+            return False
+        return not (self.exclude_re and self.exclude_re.match(rel))
+
+    def dir(self, rel):
+        if not self.recursive:
+            return rel == ''
+        rel = rel.replace(os.sep, '/')
+        return not (rel and self.exclude_re and self.exclude_re.match(rel))
+
+# -----------------------------------------------------------------------------
+# Discovery
+# -----------------------------------------------------------------------------
+def find_images(root, recursive=True, include=None, exclude=None,
+                threads=DEF_WALK_THREADS, start='', dir_mtimes=None,
+                progress=None, stop=None):
+    """Return ([paths relative to root], {path: stat result}) for the image
+    files under root, sorted by path.  include and exclude are lists of
+    shell style patterns matched against the relative paths ('/' separated):
+    only files matching include (if given) are found, and files and whole
+    directories matching exclude are skipped (see PathFilter, which can be
+    passed as include instead).
+
+    Only the directory start (relative to root) and what's under it is
+    walked.  If dir_mtimes is a dict it gets the modified time of each
+    directory walked, from before it was listed.  progress is called with
+    the number of files found so far after each directory, from the walking
+    threads.  Once stop (a threading.Event) is set the directories not
+    listed yet are skipped and what was found so far is returned."""
+    if isinstance(include, PathFilter):
+        path_filter = include
+    else:
+        path_filter = PathFilter(recursive, include, exclude)
+    found = {}
+    lock = threading.Lock()
+    todo = Queue.Queue()
+
+    def walk():
+        while True:
+            rel_dir = todo.get()
+            if rel_dir is None:
+                return
+            try:
+                walk_dir(rel_dir)
+            except Exception:
+                logging.exception(u'Failed to list "{}"'.format(
+                    os.path.join(root, rel_dir)))
+            finally:
+                todo.task_done()
+
+    def walk_dir(rel_dir):
+        if stop is not None and stop.is_set():
+            return
+        path = os.path.join(root, rel_dir)
+        try:
+            if dir_mtimes is not None:
+                mtime = os.stat(path).st_mtime
+            files, dirs = list_dir(path)
+        except (IOError, OSError) as e:
+            logging.warn(u'Failed to list "{}": {}'.format(path, e))
+            return
+        keep = {}
+        for name, st in files:
+            rel = os.path.join(rel_dir, name)
+            if path_filter.file(rel):
+                keep[rel] = st
+        with lock:
+            found.update(keep)
+            if dir_mtimes is not None:
+                dir_mtimes[rel_dir] = mtime
+            if progress is not None:
+                progress(len(found))
+        for name in dirs:
+            rel = os.path.join(rel_dir, name)
+            if path_filter.dir(rel):
+                todo.put(rel)
+
+    todo.put(start)
+    workers = [threading.Thread(target=walk) for i in range(max(threads, 1))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    todo.join()
+    for worker in workers:
+        todo.put(None)
+    for worker in workers:
+        worker.join()
+    return sorted(found), found
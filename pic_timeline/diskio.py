@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Kyle Kawamura
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Reading lots of small pieces of files off spinning disks and card readers
+without seeking back and forth: the order files are laid out on disk,
+posix_fadvise hints and opening files without updating their access times.
+
+All of it is best effort.  Where the platform or file system can't do
+something (Windows, a network share without FIEMAP), the helpers do nothing
+or fall back to inode order.
+"""
+
+import array
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import sys
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# how disk_order sorts: by where the data starts if the file system says
+# (auto gives up on that if it doesn't), by inode number, or not at all
+ORDER_AUTO = 'auto'
+ORDER_EXTENT = 'extent'
+ORDER_INODE = 'inode'
+ORDER_NONE = 'none'
+READ_ORDERS = (ORDER_AUTO, ORDER_EXTENT, ORDER_INODE, ORDER_NONE)
+
+# files auto asks for extents before deciding the file system doesn't know
+AUTO_PROBE = 16
+
+# posix_fadvise advice (Linux values)
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+
+# FIEMAP ioctl (linux/fiemap.h): a struct fiemap header followed by extents
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_FORMAT = '=QQLLLL'       # start, length, flags, mapped, count, reserved
+FIEMAP_EXTENT_FORMAT = '=QQQQQLLLL' # logical, physical, length, 2 reserved, flags, 3 reserved
+FIEMAP_EXTENT_UNKNOWN = 0x2     # no physical location yet
+FIEMAP_EXTENT_DELALLOC = 0x4
+
+O_NOATIME = getattr(os, 'O_NOATIME', 0)
+O_BINARY = getattr(os, 'O_BINARY', 0)
+
+# -----------------------------------------------------------------------------
+# posix_fadvise
+# -----------------------------------------------------------------------------
+def load_fadvise():
+    """Return a posix_fadvise(fd, offset, length, advice) function, or None
+    where there isn't one."""
+    if hasattr(os, 'posix_fadvise'):
+        return os.posix_fadvise
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6')
+    except OSError:
+        return None
+    # the 64 bit offset version where off_t is 32 bits
+    for name, off_t in (('posix_fadvise64', ctypes.c_int64),
+                        ('posix_fadvise', ctypes.c_long)):
+        func = getattr(libc, name, None)
+        if func is not None:
+            func.argtypes = [ctypes.c_int, off_t, off_t, ctypes.c_int]
+            func.restype = ctypes.c_int
+            return func
+    return None
+
+posix_fadvise = load_fadvise()
+
+def fadvise(fd, offset, length, advice):
+    """Give the kernel a hint about how a file will be read, returns whether
+    it was taken."""
+    if posix_fadvise is None:
+        return False
+    try:
+        # the libc version returns the error number, os.posix_fadvise raises
+        return not posix_fadvise(fd, offset, length, advice)
+    except OSError:
+        return False
+
+# -----------------------------------------------------------------------------
+# Opening and reading
+# -----------------------------------------------------------------------------
+def open_for_reading(path, noatime=False):
+    """Return a file descriptor for reading path.  With noatime its access
+    time isn't updated (saves a write per file), if that's allowed: only
+    the owner of a file can."""
+    flags = os.O_RDONLY | O_BINARY
+    if noatime and O_NOATIME:
+        try:
+            return os.open(path, flags | O_NOATIME)
+        except OSError as e:
+            if e.errno != errno.EPERM:
+                raise
+    return os.open(path, flags)
+
+def read_fd(fd, size):
+    """Read size bytes from fd, fewer only at the end of the file."""
+    chunks = []
+    while size > 0:
+        data = os.read(fd, size)
+        if not data:
+            break
+        chunks.append(data)
+        size -= len(data)
+    return ''.join(chunks)
+
+# -----------------------------------------------------------------------------
+# Disk order
+# -----------------------------------------------------------------------------
+def physical_offset(fd):
+    """Return where the start of a file is on its device in bytes, or None
+    if the file system doesn't say (not Linux, no FIEMAP, not written out
+    yet)."""
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return None
+    # one extent, the one with the first byte in it
+    request = array.array('c', struct.pack(FIEMAP_FORMAT, 0, 1, 0, 0, 1, 0) +
+                          '\0' * struct.calcsize(FIEMAP_EXTENT_FORMAT))
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, request, True)
+    except (IOError, OSError):
+        return None
+    header_size = struct.calcsize(FIEMAP_FORMAT)
+    mapped = struct.unpack_from(FIEMAP_FORMAT, request)[3]
+    if not mapped:
+        return None
+    extent = struct.unpack_from(FIEMAP_EXTENT_FORMAT, request, header_size)
+    physical, flags = extent[1], extent[5]
+    if flags & (FIEMAP_EXTENT_UNKNOWN | FIEMAP_EXTENT_DELALLOC):
+        return None
+    return physical
+
+def disk_order(source_dir, names, stats=None, order=ORDER_AUTO, noatime=False):
+    """Return the files names of source_dir in the order to read them so
+    the disk goes one way across them: by where their data starts where the
+    file system reports it, otherwise by inode number, which mostly follows
+    the order the files were written in.  stats maps names to their os.stat
+    results, the ones missing are looked up.  Files that can't be stat'ed
+    go last, in the order they were given."""
+    if order not in READ_ORDERS:
+        raise ValueError("unknown read order: {}".format(order))
+    if order == ORDER_NONE or len(names) < 2:
+        return list(names)
+    stats = stats or {}
+    keys = {}
+    for name in names:
+        st = stats.get(name)
+        if st is None:
+            try:
+                st = os.stat(os.path.join(source_dir, name))
+            except os.error:
+                continue
+        keys[name] = (st.st_dev, 1, st.st_ino)
+
+    if order in (ORDER_AUTO, ORDER_EXTENT):
+        # asked in inode order, so the inodes are read in one sweep too
+        found = 0
+        for tried, name in enumerate(sorted(keys, key=keys.get)):
+            if order == ORDER_AUTO and tried == AUTO_PROBE and not found:
+                logging.info(u'No extents for "{}", reading in inode order'.format(source_dir))
+                break
+            try:
+                fd = open_for_reading(os.path.join(source_dir, name), noatime)
+            except os.error:
+                continue
+            try:
+                offset = physical_offset(fd)
+            finally:
+                os.close(fd)
+            if offset is not None:
+                # before the files without one on the same device
+                keys[name] = (keys[name][0], 0, offset)
+                found += 1
+
+    ordered = [name for name in names if name in keys]
+    ordered.sort(key=keys.get)
+    return ordered + [name for name in names if name not in keys]
@@ -0,0 +1,581 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Kyle Kawamura
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Reading the capture times of a source's files, either in this process or
+fanned out in chunks to a pool of worker processes.  Either way each file
+comes back as a small record, in the order the files were given, so the
+result doesn't depend on how the work was split up.
+
+Opening and reading files is slow on card readers and network mounts, so a
+few threads read the first HEADER_WINDOW bytes of each file ahead of the
+parser and hand them over in a bounded queue.  The parser only goes back to
+the file for what's past the window.  The reads go in disk order (see
+diskio) and each thread has the kernel fetch its next header while it reads
+the current one.
+
+The app runs each import as an ImportJob thread, which sends the results
+back in batches as they come in.
+"""
+
+import logging
+import multiprocessing
+import os
+import Queue
+import sqlite3
+import threading
+import time
+
+import EXIF
+import bmff
+from constants import BMFF_EXTENSIONS
+from diskio import (ORDER_AUTO, READ_ORDERS, POSIX_FADV_WILLNEED,
+                    POSIX_FADV_DONTNEED, disk_order, fadvise, open_for_reading,
+                    read_fd)
+from discover import DEF_WALK_THREADS, find_images
+from metacache import CacheEntry
+
+# EXIF tags read on import: the capture time and where the thumbnail is
+IMPORT_TAGS = ['Image DateTime', 'EXIF DateTimeOriginal', 'ThumbnailLocator']
+
+# files handed to a worker at a time, and the fewest files worth a pool
+DEF_CHUNK_SIZE = 64
+
+# chunks an import may have at the workers per worker, so imports running
+# together take turns
+CHUNKS_PER_WORKER = 2
+
+# bytes read ahead from the start of each file, the EXIF data of a JPEG
+# (and the IFDs of most TIFF files) are in there
+HEADER_WINDOW = 65536
+
+# I/O threads reading ahead and how many headers they may get ahead by
+DEF_PREFETCH_THREADS = 8
+DEF_PREFETCH_DEPTH = 64
+
+# an import job hands its results over every so many files or seconds,
+# whichever comes first
+BATCH_FILES = 500
+BATCH_SECONDS = 0.25
+
+# record flags
+FLAG_UNREADABLE = 1     # the file couldn't be opened or read
+FLAG_TRUNCATED  = 2     # the parse stopped early (see EXIF.PARSE_BUDGET)
+
+# -----------------------------------------------------------------------------
+# class PrefetchedFile
+#        Read only file object over a header read ahead of time
+# -----------------------------------------------------------------------------
+class PrefetchedFile(object):
+    """Serves reads from the prefetched first bytes of a file, the file
+    itself is only opened if a read goes past them."""
+
+    def __init__(self, path, header):
+        self.path = path
+        self.header = header
+        # a short header is the whole file
+        self.complete = len(header) < HEADER_WINDOW
+        self.pos = 0
+        self.file = None
+
+    def open_file(self):
+        if self.file is None:
+            self.file = open(self.path, 'rb')
+        return self.file
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset = self.pos + offset
+        elif whence == 2:
+            if self.complete:
+                offset = len(self.header) + offset
+            else:
+                f = self.open_file()
+                f.seek(0, 2)
+                offset = f.tell() + offset
+        if offset < 0:
+            raise IOError("can't seek to {}".format(offset))
+        self.pos = offset
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        if self.complete or (0 <= size and self.pos + size <= len(self.header)):
+            if size < 0:
+                data = self.header[self.pos:]
+            else:
+                data = self.header[self.pos:self.pos+size]
+        else:
+            f = self.open_file()
+            f.seek(self.pos)
+            if size < 0:
+                data = f.read()
+            else:
+                data = EXIF.read_at_most(f, size)
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# -----------------------------------------------------------------------------
+# Per file work, run in the workers
+# -----------------------------------------------------------------------------
+def read_metadata(f, full_path):
+    """Parse a file for its capture time (seconds since the epoch, or None)
+    and its thumbnail locator.  Returns a CacheEntry and the record flags."""
+    if os.path.splitext(full_path)[1].lower() in BMFF_EXTENSIONS:
+        # HEIF stills and videos
+        return CacheEntry(bmff.capture_time(f), None), 0
+    tags = EXIF.process_file(f, tags=IMPORT_TAGS)
+    flags = FLAG_TRUNCATED if getattr(tags, 'truncated', False) else 0
+    # convert the time the same way the 'timestamp' profile does
+    capture_time = None
+    to_epoch = EXIF.TAG_PROFILES['timestamp']
+    for name in ('Image DateTime', 'EXIF DateTimeOriginal'):
+        if name in tags:
+            try:
+                capture_time = to_epoch[name](str(tags[name]))
+                break
+            except ValueError:
+                pass
+    thumbnail = None
+    locator = tags.get('ThumbnailLocator')
+    if locator is not None:
+        thumbnail = (locator.format, locator.offset, locator.length)
+    return CacheEntry(capture_time, thumbnail), flags
+
+def import_file(args):
+    """Return the (filename, capture time, flags, thumbnail) record of one
+    file, args is (source dir, filename, prefetched header).  A header of
+    None means the file couldn't be read."""
+    source_dir, name, header = args
+    if header is None:
+        return (name, None, FLAG_UNREADABLE, None)
+    full_path = os.path.join(source_dir, name)
+    try:
+        with PrefetchedFile(full_path, header) as f:
+            entry, flags = read_metadata(f, full_path)
+    except (IOError, OSError):
+        return (name, None, FLAG_UNREADABLE, None)
+    except Exception:
+        # a file the parsers trip over doesn't stop the rest of the import
+        logging.exception(u'Failed to parse: "{}"'.format(full_path))
+        return (name, None, FLAG_UNREADABLE, None)
+    return (name, entry.capture_time, flags, entry.thumbnail)
+
+def import_chunk(jobs):
+    """Return the records of a list of import_file args."""
+    return map(import_file, jobs)
+
+def chunked(items, size):
+    """Yield lists of size items (the last one can be shorter)."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# -----------------------------------------------------------------------------
+# class Prefetcher
+#        Threads reading file headers ahead of the parser
+# -----------------------------------------------------------------------------
+class Prefetcher(object):
+    """Reads the first HEADER_WINDOW bytes of files with threads threads,
+    at most depth headers ahead of whoever consumes them.  The files are
+    read in order (one of diskio.READ_ORDERS).  With hints the kernel is
+    told to fetch a header before it's read and to drop it afterwards, and
+    with noatime reading doesn't update the files' access times."""
+
+    def __init__(self, threads=DEF_PREFETCH_THREADS, depth=DEF_PREFETCH_DEPTH,
+                 order=ORDER_AUTO, hints=True, noatime=True):
+        if order not in READ_ORDERS:
+            raise ValueError("unknown read order: {}".format(order))
+        self.threads = max(threads, 1)
+        self.depth = max(depth, 1)
+        self.order = order
+        self.hints = hints
+        self.noatime = noatime
+
+    def open_header(self, path):
+        """Return a file descriptor for path with its header on the way in,
+        or None if it can't be opened."""
+        try:
+            fd = open_for_reading(path, self.noatime)
+        except (IOError, OSError):
+            return None
+        if self.hints:
+            fadvise(fd, 0, HEADER_WINDOW, POSIX_FADV_WILLNEED)
+        return fd
+
+    def read_header(self, fd):
+        """Return the header of a file opened by open_header and close it,
+        None if it can't be read."""
+        if fd is None:
+            return None
+        try:
+            return read_fd(fd, HEADER_WINDOW)
+        except (IOError, OSError):
+            return None
+        finally:
+            if self.hints:
+                # the parser has its copy, the page cache is better used
+                # for the rest of the source
+                fadvise(fd, 0, HEADER_WINDOW, POSIX_FADV_DONTNEED)
+            os.close(fd)
+
+    def read_headers(self, source_dir, tasks, headers, stopped, stats, lock):
+        io_seconds = 0.0
+        read = 0
+
+        def opened():
+            while not stopped():
+                try:
+                    name = tasks.get_nowait()
+                except Queue.Empty:
+                    return
+                yield name, self.open_header(os.path.join(source_dir, name))
+
+        files = opened()
+        start = time.time()
+        pending = next(files, None)
+        while pending is not None:
+            # the next file is opened first, its header comes in while this
+            # one is read
+            upcoming = next(files, None)
+            name, fd = pending
+            header = self.read_header(fd)
+            if header is not None:
+                read += len(header)
+            io_seconds += time.time() - start
+            # don't block for good if the consumer went away
+            while not stopped():
+                try:
+                    headers.put((source_dir, name, header), timeout=0.1)
+                    break
+                except Queue.Full:
+                    pass
+            pending = upcoming
+            start = time.time()
+        with lock:
+            stats['io_seconds'] += io_seconds
+            stats['bytes'] += read
+
+    def prefetch(self, source_dir, names, stop=None, stats=None, file_stats=None):
+        """Yield (source dir, filename, header) for each of names, in the
+        order the reads finish, until stop (a threading.Event) is set.  The
+        stats dict gets the bytes read, io_seconds (spent opening and
+        reading, over all threads), order_seconds (spent working out the
+        read order) and wait_seconds (the consumer spent waiting for a
+        header, near zero when the reads keep up).  file_stats maps names to
+        os.stat results, if they're known."""
+        if stop is None:
+            stop = threading.Event()
+        if stats is None:
+            stats = {}
+        stats.update(bytes=0, io_seconds=0.0, order_seconds=0.0, wait_seconds=0.0)
+        start = time.time()
+        ordered = disk_order(source_dir, names, file_stats, self.order, self.noatime)
+        stats['order_seconds'] = time.time() - start
+        lock = threading.Lock()
+        tasks = Queue.Queue()
+        for name in ordered:
+            tasks.put(name)
+        headers = Queue.Queue(self.depth)
+        done = threading.Event()
+        stopped = lambda: stop.is_set() or done.is_set()
+        threads = []
+        for i in range(min(self.threads, len(names))):
+            thread = threading.Thread(target=self.read_headers,
+                                      args=(source_dir, tasks, headers,
+                                            stopped, stats, lock))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        try:
+            for i in xrange(len(names)):
+                start = time.time()
+                item = None
+                while item is None and not stop.is_set():
+                    try:
+                        item = headers.get(timeout=0.1)
+                    except Queue.Empty:
+                        pass
+                stats['wait_seconds'] += time.time() - start
+                if item is None:
+                    return
+                yield item
+            # all read, the threads are just adding up their stats
+            for thread in threads:
+                thread.join()
+        finally:
+            done.set()
+
+# -----------------------------------------------------------------------------
+# class Importer
+#        Runs import_file over a source, in a process pool when it pays
+# -----------------------------------------------------------------------------
+class Importer(object):
+    """Reads the records of many files.  workers is the number of worker
+    processes (0 for one per CPU, 1 to parse in this process) and chunk_size
+    the number of files sent to a worker at once.  prefetch_threads,
+    prefetch_depth, read_order, read_hints and noatime set up the Prefetcher
+    feeding them.  Several threads can import at once, they share the
+    pool."""
+
+    def __init__(self, workers=0, chunk_size=DEF_CHUNK_SIZE,
+                 prefetch_threads=DEF_PREFETCH_THREADS,
+                 prefetch_depth=DEF_PREFETCH_DEPTH, read_order=ORDER_AUTO,
+                 read_hints=True, noatime=True):
+        if workers <= 0:
+            try:
+                workers = multiprocessing.cpu_count()
+            except NotImplementedError:
+                workers = 1
+        self.workers = workers
+        self.chunk_size = max(chunk_size, 1)
+        self.prefetcher = Prefetcher(prefetch_threads, prefetch_depth,
+                                     read_order, read_hints, noatime)
+        self.pool = None
+        self.pool_lock = threading.Lock()
+
+    def get_pool(self):
+        with self.pool_lock:
+            if self.pool is None:
+                # started on first use, then kept for the session
+                logging.info('Starting {} import workers'.format(self.workers))
+                self.pool = multiprocessing.Pool(self.workers)
+            return self.pool
+
+    def iter_records(self, source_dir, names, cancel=None, file_stats=None):
+        """Yield the records of the files names in source_dir as they are
+        done, in no particular order.  Stops early once cancel (a
+        threading.Event) is set.  file_stats maps names to os.stat results,
+        if they're known."""
+        if cancel is None:
+            cancel = threading.Event()
+        start = time.time()
+        count = 0
+        stats = {}
+        jobs = self.prefetcher.prefetch(source_dir, names, cancel, stats, file_stats)
+        if self.workers == 1 or len(names) <= self.chunk_size:
+            # not worth the trip to the workers
+            for job in jobs:
+                if cancel.is_set():
+                    break
+                count += 1
+                yield import_file(job)
+        else:
+            # the chunks are sent from this thread rather than handing the
+            # prefetcher to imap: the pool's one task thread would import
+            # the sources one after another, and an error reading them
+            # would stop it for good
+            pool = self.get_pool()
+            chunks = chunked(jobs, self.chunk_size)
+            pending = []
+            sent_all = False
+            while not cancel.is_set():
+                sent = False
+                if not sent_all and len(pending) < self.workers * CHUNKS_PER_WORKER:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        # all sent, or the prefetcher was cancelled
+                        sent_all = True
+                    else:
+                        pending.append(pool.apply_async(import_chunk, (chunk,)))
+                        sent = True
+                done = [result for result in pending if result.ready()]
+                if not done and not sent:
+                    if not pending:
+                        break
+                    # the workers go through what they were already sent
+                    pending[0].wait(0.1)
+                for result in done:
+                    pending.remove(result)
+                    records = result.get()
+                    count += len(records)
+                    for record in records:
+                        yield record
+        logging.info(u'Imported {} of {} files from "{}" in {:.2f} s: {} header '
+                     'bytes, {:.2f} s ordering reads, {:.2f} s of I/O, parser '
+                     'waited {:.2f} s for headers'.format(
+                         count, len(names), source_dir, time.time() - start,
+                         stats['bytes'], stats['order_seconds'],
+                         stats['io_seconds'], stats['wait_seconds']))
+
+    def import_files(self, source_dir, names):
+        """Return the records of the files names in source_dir, in the same
+        order."""
+        records = list(self.iter_records(source_dir, names))
+        # back in the order of names, whichever read finished first
+        order = dict((name, i) for i, name in enumerate(names))
+        records.sort(key=lambda record: order[record[0]])
+        return records
+
+    def close(self):
+        with self.pool_lock:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool.join()
+                self.pool = None
+
+# -----------------------------------------------------------------------------
+# class ImportJob
+#        Background thread importing one source
+# -----------------------------------------------------------------------------
+class ImportJob(threading.Thread):
+    """Imports the files names of source_dir: stats them (unless their stat
+    results are given in stats, see discover.find_images), takes what it
+    can from cache (a MetadataCache or None) and has importer parse the rest.
+    Results are put on queue as (job, 'records', [(filename, seconds since
+    the epoch), ...]) in batches, cached files first, and the job ends with
+    (job, 'done', None).  A job stops early once cancel is set, what it put
+    on the queue before that is still good.  names is every file of the
+    source, or with delta only the ones that changed (see watcher).
+
+    If names is None the job finds them first, walking source_dir with
+    path_filter (a discover.PathFilter), and puts the number found so far
+    on queue as (job, 'found', count) while it does."""
+
+    def __init__(self, importer, cache, source_dir, names, queue, stats=None,
+                 delta=False, path_filter=None, walk_threads=DEF_WALK_THREADS):
+        threading.Thread.__init__(self, name='import ' + source_dir)
+        self.daemon = True
+        self.importer = importer
+        self.cache = cache
+        self.source_dir = source_dir
+        self.names = names
+        self.queue = queue
+        self.stats = stats
+        self.delta = delta
+        self.path_filter = path_filter
+        self.walk_threads = walk_threads
+        self.cancel = threading.Event()
+        self.start_time = time.time()
+        # files the app has taken off the queue so far, and found so far
+        # while names is None
+        self.added = 0
+        self.found = 0
+
+    def run(self):
+        try:
+            self.import_source()
+        except Exception:
+            # the app is still waiting for 'done'
+            logging.exception(u'Import of "{}" failed'.format(self.source_dir))
+        self.queue.put((self, 'done', None))
+
+    def find_names(self):
+        sent = [0.0]
+        def progress(count):
+            # called by one walking thread at a time
+            if time.time() - sent[0] >= BATCH_SECONDS:
+                self.queue.put((self, 'found', count))
+                sent[0] = time.time()
+        names, self.stats = find_images(
+            self.source_dir, include=self.path_filter, threads=self.walk_threads,
+            progress=progress, stop=self.cancel)
+        self.names = names
+        self.queue.put((self, 'found', len(names)))
+
+    def import_source(self):
+        if self.names is None:
+            self.find_names()
+            if self.cancel.is_set() or not self.names:
+                return
+        # kept on the job for whoever wants them afterwards (see watcher)
+        if self.stats is None:
+            self.stats = {}
+        stats = self.stats
+        for name in self.names:
+            if self.cancel.is_set():
+                return
+            if name in stats:
+                continue
+            try:
+                stats[name] = os.stat(os.path.join(self.source_dir, name))
+            except os.error:
+                logging.warn(u'Failed to stat: "{}"'.format(name))
+
+        def seconds(name, capture_time):
+            # file's modified time if it has no capture time, and if
+            # everything fails the current time
+            if capture_time is not None:
+                return capture_time
+            if name in stats:
+                return stats[name].st_mtime
+            return time.time()
+
+        # files that haven't changed since they were cached aren't opened
+        cached = {}
+        if self.cache:
+            try:
+                cached = self.cache.lookup_directory(self.source_dir, stats)
+            except sqlite3.Error as e:
+                logging.error('Metadata cache lookup failed: {}'.format(e))
+        for batch in chunked([name for name in self.names if name in cached],
+                             BATCH_FILES):
+            self.queue.put((self, 'records',
+                            [(name, seconds(name, cached[name].capture_time))
+                             for name in batch]))
+
+        parsed = {}
+        batch = []
+        sent = time.time()
+        for name, capture_time, flags, thumbnail in self.importer.iter_records(
+                self.source_dir, [x for x in self.names if x not in cached],
+                self.cancel, stats):
+            if flags & FLAG_UNREADABLE:
+                logging.warn(u'Failed to read: "{}"'.format(name))
+            elif name in stats:
+                parsed[name] = CacheEntry(capture_time, thumbnail)
+            batch.append((name, seconds(name, capture_time)))
+            if len(batch) >= BATCH_FILES or time.time() - sent >= BATCH_SECONDS:
+                self.queue.put((self, 'records', batch))
+                batch = []
+                sent = time.time()
+        if batch:
+            self.queue.put((self, 'records', batch))
+
+        # whatever was parsed is kept, even if the import was cancelled.  A
+        # full import also lets the cache forget files that are gone.
+        if self.cache and (parsed or not self.delta):
+            try:
+                if self.delta:
+                    self.cache.store_files(self.source_dir, stats, parsed)
+                else:
+                    self.cache.store_directory(self.source_dir, stats, parsed)
+            except sqlite3.Error as e:
+                logging.error('Metadata cache update failed: {}'.format(e))
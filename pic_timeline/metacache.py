@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Kyle Kawamura
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Persistent cache of what an import pulls out of each picture: its capture
+time and where its embedded thumbnail is.  An entry is only used while the
+file still has the same size, modified time and inode, so adding a source
+again costs a stat of each file instead of opening and parsing it.
+
+A whole directory is also remembered by a digest of its files' names and
+stats, when that still matches all of its entries come back in one query.
+"""
+
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+# bump when the tables change, an older cache is thrown away
+SCHEMA_VERSION = 1
+
+# default number of files to remember, least recently used go first.  The
+# cache is bounded by entries rather than bytes: a file's row is its path
+# and a few numbers, around 200 bytes with the indexes, so this keeps the
+# database to some 40MB
+DEF_MAX_ENTRIES = 200000
+
+# most parameters in one query (SQLite's limit is 999)
+BATCH_SIZE = 500
+
+# what's known about a file.  thumbnail is None or (format, offset, length)
+# with the offset from the start of the file, see EXIF.Thumbnail_Locator
+CacheEntry = namedtuple('CacheEntry', 'capture_time thumbnail')
+
+# -----------------------------------------------------------------------------
+# Helpers
+# -----------------------------------------------------------------------------
+def stat_key(st):
+    """Return the part of an os.stat result an entry is tied to."""
+    return st.st_size, st.st_mtime, st.st_ino
+
+def directory_digest(stats):
+    """Return a digest of the names and stat keys of the files in a
+    directory, stats maps file names to os.stat results."""
+    digest = hashlib.sha1()
+    for name in sorted(stats):
+        digest.update(repr((name, stat_key(stats[name]))))
+    return digest.hexdigest()
+
+def to_text(path):
+    """SQLite wants unicode (or ASCII) for TEXT columns."""
+    if isinstance(path, str):
+        return path.decode('utf-8', 'replace')
+    return path
+
+def batches(items, size=BATCH_SIZE):
+    for start in xrange(0, len(items), size):
+        yield items[start:start+size]
+
+# -----------------------------------------------------------------------------
+# class MetadataCache
+#        SQLite backed cache of per file import results
+# -----------------------------------------------------------------------------
+class MetadataCache(object):
+    """Cached capture times and thumbnail locators keyed by file path, size,
+    modified time and inode.  Entries are looked up and stored a directory
+    at a time, from any thread (one at a time)."""
+
+    def __init__(self, db_path, max_entries=DEF_MAX_ENTRIES):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.create_tables()
+
+    def create_tables(self):
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            logging.info('Creating metadata cache: "{}"'.format(self.db_path))
+            self.db.executescript("""
+                DROP TABLE IF EXISTS files;
+                DROP TABLE IF EXISTS dirs;
+                CREATE TABLE files (
+                    dir TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    size INTEGER, mtime REAL, inode INTEGER,
+                    capture_time REAL,
+                    thumb_format TEXT, thumb_offset INTEGER, thumb_length INTEGER,
+                    used REAL,
+                    PRIMARY KEY (dir, name));
+                CREATE INDEX files_used ON files (used);
+                CREATE TABLE dirs (
+                    dir TEXT PRIMARY KEY,
+                    digest TEXT,
+                    count INTEGER);
+                PRAGMA user_version = %d;
+                """ % SCHEMA_VERSION)
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    @staticmethod
+    def make_entry(row):
+        capture_time, thumb_format, thumb_offset, thumb_length = row
+        thumbnail = None
+        if thumb_format is not None:
+            thumbnail = (str(thumb_format), thumb_offset, thumb_length)
+        return CacheEntry(capture_time, thumbnail)
+
+    def lookup_directory(self, dir_path, stats):
+        """Return {name: CacheEntry} for the files of dir_path that are in
+        the cache and haven't changed.  stats maps file names to os.stat
+        results."""
+        with self.lock:
+            return self._lookup_directory(dir_path, stats)
+
+    def _lookup_directory(self, dir_path, stats):
+        dir_text = to_text(dir_path)
+        names = dict((to_text(name), name) for name in stats)
+        found = {}
+        row = self.db.execute("SELECT digest, count FROM dirs WHERE dir = ?",
+                              (dir_text,)).fetchone()
+        if row and row == (directory_digest(stats), len(stats)):
+            # nothing was added, removed or changed since it was stored
+            for row in self.db.execute(
+                    "SELECT name, capture_time, thumb_format, thumb_offset, "
+                    "thumb_length FROM files WHERE dir = ?", (dir_text,)):
+                if row[0] in names:
+                    found[names[row[0]]] = self.make_entry(row[1:])
+        if len(found) != len(stats):
+            # check the files one by one
+            found = {}
+            for batch in batches(names.keys()):
+                query = ("SELECT name, size, mtime, inode, capture_time, "
+                         "thumb_format, thumb_offset, thumb_length FROM files "
+                         "WHERE dir = ? AND name IN ({})".format(
+                             ",".join("?" * len(batch))))
+                for row in self.db.execute(query, [dir_text] + batch):
+                    name = names[row[0]]
+                    if tuple(row[1:4]) == stat_key(stats[name]):
+                        found[name] = self.make_entry(row[4:])
+        if found:
+            # keep what's in use away from eviction
+            now = time.time()
+            self.db.executemany(
+                "UPDATE files SET used = ? WHERE dir = ? AND name = ?",
+                [(now, dir_text, to_text(name)) for name in found])
+            self.db.commit()
+        logging.info(u'Metadata cache: {} of {} files in "{}"'.format(
+            len(found), len(stats), dir_text))
+        return found
+
+    def store_directory(self, dir_path, stats, entries):
+        """Store {name: CacheEntry} for files of dir_path, forget its files
+        that aren't in stats any more and remember the directory as a whole
+        once every file in stats has an entry.  stats is every file of the
+        directory, see store_files for some of them."""
+        with self.lock:
+            self._store_directory(dir_path, stats, entries)
+
+    def store_files(self, dir_path, stats, entries):
+        """Store {name: CacheEntry} for some files of dir_path, the ones that
+        changed.  Whether the directory as a whole is remembered is left to
+        the next store_directory."""
+        with self.lock:
+            self._store_files(to_text(dir_path), stats, entries)
+            self.evict()
+            self.db.commit()
+
+    def _store_files(self, dir_text, stats, entries):
+        now = time.time()
+        rows = []
+        for name, entry in entries.iteritems():
+            size, mtime, inode = stat_key(stats[name])
+            thumb_format, thumb_offset, thumb_length = (entry.thumbnail or
+                                                        (None, None, None))
+            rows.append((dir_text, to_text(name), size, mtime, inode,
+                         entry.capture_time, thumb_format, thumb_offset,
+                         thumb_length, now))
+        self.db.executemany(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows)
+
+    def _store_directory(self, dir_path, stats, entries):
+        dir_text = to_text(dir_path)
+        digest = directory_digest(stats)
+        row = self.db.execute("SELECT digest, count FROM dirs WHERE dir = ?",
+                              (dir_text,)).fetchone()
+        if not entries and row == (digest, len(stats)):
+            return
+        self._store_files(dir_text, stats, entries)
+        # files that were removed or renamed since they were stored
+        names = dict((to_text(name), name) for name in stats)
+        self.db.executemany(
+            "DELETE FROM files WHERE dir = ? AND name = ?",
+            [(dir_text, name) for (name,) in self.db.execute(
+                "SELECT name FROM files WHERE dir = ?", (dir_text,)).fetchall()
+             if name not in names])
+        self.db.execute("DELETE FROM dirs WHERE dir = ?", (dir_text,))
+        self.evict()
+        # a file that changed and wasn't stored again (the import was
+        # cancelled) keeps the directory from being remembered as a whole
+        current = 0
+        for row in self.db.execute("SELECT name, size, mtime, inode FROM files "
+                                   "WHERE dir = ?", (dir_text,)):
+            if tuple(row[1:]) == stat_key(stats[names[row[0]]]):
+                current += 1
+        if current == len(stats):
+            self.db.execute("INSERT INTO dirs VALUES (?, ?, ?)",
+                            (dir_text, digest, len(stats)))
+        self.db.commit()
+
+    def evict(self):
+        """Drop the least recently used files over max_entries."""
+        count = self.db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        excess = count - self.max_entries
+        if excess <= 0:
+            return
+        logging.info('Evicting {} files from the metadata cache'.format(excess))
+        self.db.execute("DELETE FROM files WHERE rowid IN "
+                        "(SELECT rowid FROM files ORDER BY used LIMIT ?)",
+                        (excess,))
+        # directories that lost files are checked file by file again
+        self.db.execute("DELETE FROM dirs WHERE count != "
+                        "(SELECT COUNT(*) FROM files WHERE files.dir = dirs.dir)")
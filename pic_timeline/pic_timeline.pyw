@@ -25,6 +25,7 @@
 Application: Picture Timeliner (pic_timeline_p2.py)
 
  - Add sources.
+ - Tick "Watch sources" to pick up photos added to them later (optional).
  - Double click source to enter timeshift information (optional).
  - Override photo's time information by double clicking photos (optional).
  - Use preview feature to verify output order.
@@ -37,19 +38,29 @@ import os
 import tempfile
 import shutil
 from Tkinter import *
+import ttk
 from tkFileDialog import askdirectory
 from tkMessageBox import showinfo, showerror, askyesno
 from datetime import datetime, timedelta
-from time import strptime, mktime
+import time
 from operator import attrgetter
+from bisect import bisect_right
+import Queue
 import ConfigParser
 import logging
+import multiprocessing
+import sqlite3
 # third party modules
-import EXIF
 from appdirs import AppDirs
 # my support modules
 from constants import *
 from custom_dlgs import TimeShiftDialog, DateTimeDialog
+from metacache import MetadataCache, DEF_MAX_ENTRIES
+from importer import (Importer, ImportJob, DEF_CHUNK_SIZE, DEF_PREFETCH_THREADS,
+                      DEF_PREFETCH_DEPTH)
+from diskio import ORDER_AUTO
+from discover import split_patterns, PathFilter, DEF_WALK_THREADS
+from watcher import WatchThread, DEF_POLL_SECONDS
 
 # -----------------------------------------------------------------------------
 # Constants
@@ -63,10 +74,29 @@ MIN_WIDTH = 480
 MIN_HEIGHT = 400
 DEF_SIZE = "640x480"
 COLS = 4
+POLL_MS = 100           # how often imports are checked for new files
+POLL_BUDGET = 0.05      # seconds of a poll spent adding files, at most
 # ConfigParser
 INI_FILENAME    = "pictime.ini"
 SECT_SETTINGS   = "SETTINGS"
 OPT_ASKDIRPATH  = "OPT_ASKDIRPATH"
+OPT_CACHE_MAX_ENTRIES = "OPT_CACHE_MAX_ENTRIES" # files, ~200 bytes each
+OPT_IMPORT_WORKERS = "OPT_IMPORT_WORKERS"       # 0 is one per CPU
+OPT_IMPORT_CHUNK_SIZE = "OPT_IMPORT_CHUNK_SIZE"
+OPT_PREFETCH_THREADS = "OPT_PREFETCH_THREADS"
+OPT_PREFETCH_DEPTH = "OPT_PREFETCH_DEPTH"
+OPT_READ_ORDER = "OPT_READ_ORDER"               # auto, extent, inode or none
+OPT_READ_HINTS = "OPT_READ_HINTS"               # posix_fadvise the headers
+OPT_NOATIME = "OPT_NOATIME"                     # don't touch access times
+OPT_RECURSIVE = "OPT_RECURSIVE"                 # also add sub directories
+OPT_INCLUDE = "OPT_INCLUDE"                     # ';' separated patterns
+OPT_EXCLUDE = "OPT_EXCLUDE"
+OPT_WALK_THREADS = "OPT_WALK_THREADS"
+OPT_WATCH = "OPT_WATCH"                         # keep sources up to date
+OPT_WATCH_SECONDS = "OPT_WATCH_SECONDS"         # between checks of sources
+OPT_WATCH_INOTIFY = "OPT_WATCH_INOTIFY"         # false polls even on Linux
+# metacache
+CACHE_FILENAME = "pictime_cache.db"
 # Logging
 LOG_FILE = "pictime.log"
 DEF_LEVEL = 'warning'
@@ -102,6 +132,10 @@ class PicTimelineApp(Frame):
         def __init__(self):
             self.time_shift = timedelta()
             
+            # files imported from the source: their stat results (None if
+            # not known), for watching it
+            self.files = {}
+            
             # pop first item out of colors list and assign it to this source
             # if this source is deleted, then it's pushed back onto the list.
             # If no colors are left in the list, use the default of black on white. 
@@ -233,11 +267,76 @@ class PicTimelineApp(Frame):
             self.ini_parser.add_section(SECT_SETTINGS)
         if not self.ini_parser.has_option(SECT_SETTINGS, OPT_ASKDIRPATH):
             self.ini_parser.set(SECT_SETTINGS, OPT_ASKDIRPATH, os.path.expanduser("~"))
+        if not self.ini_parser.has_option(SECT_SETTINGS, OPT_CACHE_MAX_ENTRIES):
+            self.ini_parser.set(SECT_SETTINGS, OPT_CACHE_MAX_ENTRIES, DEF_MAX_ENTRIES)
+        if not self.ini_parser.has_option(SECT_SETTINGS, OPT_IMPORT_WORKERS):
+            self.ini_parser.set(SECT_SETTINGS, OPT_IMPORT_WORKERS, 0)
+        if not self.ini_parser.has_option(SECT_SETTINGS, OPT_IMPORT_CHUNK_SIZE):
+            self.ini_parser.set(SECT_SETTINGS, OPT_IMPORT_CHUNK_SIZE, DEF_CHUNK_SIZE)
+        if not self.ini_parser.has_option(SECT_SETTINGS, OPT_PREFETCH_THREADS):
+            self.ini_parser.set(SECT_SETTINGS, OPT_PREFETCH_THREADS, DEF_PREFETCH_THREADS)
+        if not self.ini_parser.has_option(SECT_SETTINGS, OPT_PREFETCH_DEPTH):
+            self.ini_parser.set(SECT_SETTINGS, OPT_PREFETCH_DEPTH, DEF_PREFETCH_DEPTH)
+        if not self.ini_parser.has_option(SECT_SETTINGS, OPT_READ_ORDER):
+            self.ini_parser.set(SECT_SETTINGS, OPT_READ_ORDER, ORDER_AUTO)
+        if not self.ini_parser.has_option(SECT_SETTINGS, OPT_READ_HINTS):
+            self.ini_parser.set(SECT_SETTINGS, OPT_READ_HINTS, "true")
+        if not self.ini_parser.has_option(SECT_SETTINGS, OPT_NOATIME):
+            self.ini_parser.set(SECT_SETTINGS, OPT_NOATIME, "true")
+        if not self.ini_parser.has_option(SECT_SETTINGS, OPT_RECURSIVE):
+            self.ini_parser.set(SECT_SETTINGS, OPT_RECURSIVE, "true")
+        if not self.ini_parser.has_option(SECT_SETTINGS, OPT_INCLUDE):
+            self.ini_parser.set(SECT_SETTINGS, OPT_INCLUDE, "")
+        if not self.ini_parser.has_option(SECT_SETTINGS, OPT_EXCLUDE):
+            self.ini_parser.set(SECT_SETTINGS, OPT_EXCLUDE, "")
+        if not self.ini_parser.has_option(SECT_SETTINGS, OPT_WALK_THREADS):
+            self.ini_parser.set(SECT_SETTINGS, OPT_WALK_THREADS, DEF_WALK_THREADS)
+        if not self.ini_parser.has_option(SECT_SETTINGS, OPT_WATCH):
+            self.ini_parser.set(SECT_SETTINGS, OPT_WATCH, "false")
+        if not self.ini_parser.has_option(SECT_SETTINGS, OPT_WATCH_SECONDS):
+            self.ini_parser.set(SECT_SETTINGS, OPT_WATCH_SECONDS, DEF_POLL_SECONDS)
+        if not self.ini_parser.has_option(SECT_SETTINGS, OPT_WATCH_INOTIFY):
+            self.ini_parser.set(SECT_SETTINGS, OPT_WATCH_INOTIFY, "true")
 
         # write it out to ensure that it exists
         self.write_ini_file()
         
         logging.info('askdirpath="{}"'.format(self.ini_parser.get(SECT_SETTINGS, OPT_ASKDIRPATH)))
+
+        # capture times of files seen in earlier sessions.  The app works
+        # without it, just slower.
+        cache_dir = dirs.user_cache_dir
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        try:
+            self.metadata_cache = MetadataCache(
+                os.path.join(cache_dir, CACHE_FILENAME),
+                self.ini_parser.getint(SECT_SETTINGS, OPT_CACHE_MAX_ENTRIES))
+        except sqlite3.Error as e:
+            logging.error('Failed to open metadata cache: {}'.format(e))
+            self.metadata_cache = None
+
+        # imports running in the background, by source dir, and where they
+        # send their results
+        self.imports = {}
+        self.import_queue = Queue.Queue()
+        # parses the files of new sources, in worker processes if there are
+        # enough of them, with their headers read ahead by I/O threads in
+        # disk order
+        self.importer = Importer(self.ini_parser.getint(SECT_SETTINGS, OPT_IMPORT_WORKERS),
+                                 self.ini_parser.getint(SECT_SETTINGS, OPT_IMPORT_CHUNK_SIZE),
+                                 self.ini_parser.getint(SECT_SETTINGS, OPT_PREFETCH_THREADS),
+                                 self.ini_parser.getint(SECT_SETTINGS, OPT_PREFETCH_DEPTH),
+                                 self.ini_parser.get(SECT_SETTINGS, OPT_READ_ORDER),
+                                 self.ini_parser.getboolean(SECT_SETTINGS, OPT_READ_HINTS),
+                                 self.ini_parser.getboolean(SECT_SETTINGS, OPT_NOATIME))
+
+        # sources being watched for changed files (WatchThreads) by source
+        # dir, and their changes that wait for an import of the source
+        self.watchers = {}
+        self.watch_changes = {}
+        # pending call of poll_imports
+        self.import_poll = None
         
         self.configure_widgets()
 
@@ -245,6 +344,13 @@ class PicTimelineApp(Frame):
         # clean up temp files before exitting
         if askyesno(title=APP_NAME, message="Do you want to exit?"):
             self.clean_up_temp_dir()        
+            self.stop_watching()
+            for job in self.imports.values():
+                job.cancel.set()
+                job.join(1.0)
+            if self.metadata_cache:
+                self.metadata_cache.close()
+            self.importer.close()
             self.master.destroy()
         
     def clean_up_temp_dir(self):
@@ -276,7 +382,10 @@ class PicTimelineApp(Frame):
         for col in range(COLS):
             self.columnconfigure(col, weight=1)
 
-        Label(self, text="Picture sources:").grid(row=0, column=0, columnspan=2, sticky=WIDTH)
+        Label(self, text="Picture sources:").grid(row=0, column=0, sticky=WIDTH)
+        self.watch_var = BooleanVar(value=self.ini_parser.getboolean(SECT_SETTINGS, OPT_WATCH))
+        Checkbutton(self, text="Watch sources", variable=self.watch_var,
+                    command=self.handle_watch).grid(row=0, column=1, sticky=E)
         
         self.listbox_sources = Listbox(self, selectmode=SINGLE)
         self.listbox_sources.grid(row=1, column=0, columnspan=2, sticky=ALL)
@@ -297,6 +406,17 @@ class PicTimelineApp(Frame):
         
         status_bar = Label(self, text="(c) 2012 Kyle Kawamura", font=("Helvetica", 10))
         status_bar.grid(row=9, column=0, columnspan=5, sticky=WIDTH)
+
+        # import progress, only shown while sources are being imported
+        self.progress_frame = Frame(self)
+        self.progress_frame.columnconfigure(1, weight=1)
+        self.progress_frame.grid(row=10, column=0, columnspan=COLS, sticky=WIDTH)
+        self.progress_label = Label(self.progress_frame, anchor=W, width=40)
+        self.progress_label.grid(row=0, column=0, sticky=WIDTH)
+        self.progress_bar = ttk.Progressbar(self.progress_frame, mode='determinate')
+        self.progress_bar.grid(row=0, column=1, sticky=WIDTH)
+        Button(self.progress_frame, text="Cancel", command=self.handle_cancel_import).grid(row=0, column=2)
+        self.progress_frame.grid_remove()
         
         # create subframe used for output section
         sub_frame = Frame(self)
@@ -343,56 +463,91 @@ class PicTimelineApp(Frame):
             else:
                 ok = new_source_dir.lower() not in [x.lower() for x in self.listbox_sources.get(0, END)]
             
-            if ok:
-                jpeg_files = [x for x in os.listdir(new_source_dir) if os.path.splitext(x)[1].lower() in [".jpg", ".jpeg"]]
-                if jpeg_files:
-                    #directory is new(ok) and has some jpgs in it so add it
-                    self.listbox_sources.insert(END, new_source_dir)
-                    new_data = self.SourceListData()
-                    self.sources_data[new_source_dir] = new_data
-                    self.listbox_sources.itemconfig(END, new_data.color)
-                    
-                    self.process_new_source(new_source_dir, jpeg_files)
-    
-                    self.listbox_sources.activate(END)
-                    self.listbox_sources.focus_set()
-                    
-                    # go up one level in path
-                    up_one_level = os.path.split(new_source_dir)[0]
-                    if (os.path.isdir(up_one_level) and 
-                        up_one_level != self.ini_parser.get(SECT_SETTINGS, OPT_ASKDIRPATH)):
-                        self.ini_parser.set(SECT_SETTINGS, OPT_ASKDIRPATH, up_one_level)
-                        self.write_ini_file()
-                else:
-                    logging.warn("Directory selection does not contain any JPG images")
-                    showerror(title="Source selection error", message='"{}" does not contain any JPG images'.format(new_source_dir))
+            overlap = self.overlapping_source(new_source_dir) if ok else None
+            if ok and overlap:
+                logging.warn('Directory selection overlaps source "{}"'.format(overlap))
+                showerror(title="Source selection error", message='"{}" overlaps source "{}"'.format(new_source_dir, overlap))
+            elif ok:
+                # directory is new(ok), its images are found by the import
+                # in the background (the whole tree, a card's DCIM/100CANON,
+                # DCIM/101CANON..., unless turned off).  If there aren't any
+                # it's taken off again when the import is done.
+                self.listbox_sources.insert(END, new_source_dir)
+                new_data = self.SourceListData()
+                self.sources_data[new_source_dir] = new_data
+                self.listbox_sources.itemconfig(END, new_data.color)
+
+                self.process_new_source(new_source_dir)
+
+                self.listbox_sources.activate(END)
+                self.listbox_sources.focus_set()
+
+                # go up one level in path
+                up_one_level = os.path.split(new_source_dir)[0]
+                if (os.path.isdir(up_one_level) and 
+                    up_one_level != self.ini_parser.get(SECT_SETTINGS, OPT_ASKDIRPATH)):
+                    self.ini_parser.set(SECT_SETTINGS, OPT_ASKDIRPATH, up_one_level)
+                    self.write_ini_file()
             else:
                 logging.warn("Directory selection alread exists as a source")
                 showerror(title="Source selection error", message='"{}" already added as source'.format(new_source_dir))
 
+    def source_filter(self):
+        """Return the discover.PathFilter for the files of sources."""
+        return PathFilter(self.ini_parser.getboolean(SECT_SETTINGS, OPT_RECURSIVE),
+                          split_patterns(self.ini_parser.get(SECT_SETTINGS, OPT_INCLUDE)),
+                          split_patterns(self.ini_parser.get(SECT_SETTINGS, OPT_EXCLUDE)))
+
+    def overlapping_source(self, new_source_dir):
+        """Return a source that new_source_dir is in or that is in it, which
+        would add some files twice when sub directories are added.  None if
+        there isn't one.
+        """
+        if not self.ini_parser.getboolean(SECT_SETTINGS, OPT_RECURSIVE):
+            return None
+        def norm(path):
+            path = os.path.join(os.path.normpath(path), '')
+            return path if self.fs_case_sensitive else path.lower()
+        new_dir = norm(new_source_dir)
+        for source_dir in self.sources_data:
+            old_dir = norm(source_dir)
+            if new_dir.startswith(old_dir) or old_dir.startswith(new_dir):
+                return source_dir
+        return None
+
     def handle_delete_source(self):
         cursel = self.listbox_sources.curselection()
         if cursel:
-            index = int(cursel[0])
-            key = self.get_source_key(index)
-            logging.info('Deleting source: "{}"'.format(key))
-            
-            # delete listbox item
-            self.listbox_sources.delete(index)
-            
-            # restore the text color to the list of available colors unless it's
-            # the default (black/white)
-            cur_color = self.sources_data[key].color
-            if (cur_color != PicTimelineApp.SourceListData.DEFAULT_COLORS):
-                PicTimelineApp.SourceListData.colors.insert(0, cur_color)
-            
-            # delete item data corresponding to removed source
-            del self.sources_data[key]
-            
-            # update the outputs listbox and remove all files from the
-            # deleted source
-            self.list_data = [val for val in self.list_data if val.id != key]
-            self.update_outputs()
+            self.delete_source(int(cursel[0]))
+
+    def delete_source(self, index):
+        key = self.get_source_key(index)
+        logging.info('Deleting source: "{}"'.format(key))
+        
+        # delete listbox item
+        self.listbox_sources.delete(index)
+        
+        # restore the text color to the list of available colors unless it's
+        # the default (black/white)
+        cur_color = self.sources_data[key].color
+        if (cur_color != PicTimelineApp.SourceListData.DEFAULT_COLORS):
+            PicTimelineApp.SourceListData.colors.insert(0, cur_color)
+        
+        # delete item data corresponding to removed source, and stop
+        # importing it
+        del self.sources_data[key]
+        job = self.imports.pop(key, None)
+        if job:
+            job.cancel.set()
+        watcher = self.watchers.pop(key, None)
+        if watcher:
+            watcher.close()
+        self.watch_changes.pop(key, None)
+        
+        # update the outputs listbox and remove all files from the
+        # deleted source
+        self.list_data = [val for val in self.list_data if val.id != key]
+        self.update_outputs()
         
     def on_double_click_sources(self, click_event):
         ndx_cursel = int(self.listbox_sources.curselection()[0])
@@ -451,33 +606,216 @@ class PicTimelineApp(Frame):
             self.text_path.delete(1.0, END)
             self.text_path.insert(END, new_source_dir)
     
-    def process_new_source(self, new_source_dir, jpeg_files):
+    def process_new_source(self, new_source_dir, image_files=None, stats=None, changed=None):
+        """Import image_files of a source, all of them if None.  changed is
+        None for a new source, for a watched one it's the files among
+        image_files that are already in the outputs and get their times
+        updated.
+        """
         if not os.path.isdir(new_source_dir):
             # Should be able to get here but anyhoo
             logging.error('Invalid source directory: "{}"'.format(new_source_dir))
             raise ValueError("Input path is not a directory")
-                        
-        for file in jpeg_files:
-            full_path = os.path.join(new_source_dir, file)
-            with open(full_path, 'rb') as f:
-                tags = EXIF.process_file(f)
-                dt_val = tags.get('Image DateTime', None)
-                if dt_val:
-                    ts = strptime(str(dt_val), "%Y:%m:%d %H:%M:%S")
-                    dt = datetime.fromtimestamp(mktime(ts))
-                else:
-                    # what if getmtime fails too?  is this possible???
-                    try:
-                        mtime = os.path.getmtime(full_path)
-                    except os.error:
-                        # if everything fails, just use the current time.
-                        mtime = time.time()
-                    dt = datetime.fromtimestamp(mtime)
-                
-                new_item = self.OutputsListData(new_source_dir, file, self.sources_data[new_source_dir], dt)
-                self.list_data.append(new_item)
-        self.update_outputs()
+
+        # the files are read in the background, they are added to the
+        # outputs as they come in (see poll_imports)
+        job = ImportJob(self.importer, self.metadata_cache, new_source_dir,
+                        image_files, self.import_queue, stats,
+                        delta=changed is not None, path_filter=self.source_filter(),
+                        walk_threads=self.ini_parser.getint(SECT_SETTINGS, OPT_WALK_THREADS))
+        job.changed = None if changed is None else set(changed)
+        if not self.imports:
+            self.progress_frame.grid()
+        self.schedule_poll()
+        self.imports[new_source_dir] = job
+        job.start()
+        self.update_progress()
         return True
+
+    def schedule_poll(self):
+        if self.import_poll is None:
+            self.import_poll = self.after(POLL_MS, self.poll_imports)
+
+    def poll_imports(self):
+        """Add whatever the running imports sent since the last poll, as
+        much as fits in POLL_BUDGET so the window stays responsive, and
+        apply the changes the watchers found.
+        """
+        self.import_poll = None
+        start = time.time()
+        while time.time() - start < POLL_BUDGET:
+            try:
+                job, kind, data = self.import_queue.get_nowait()
+            except Queue.Empty:
+                break
+            if kind == 'changes':
+                if self.watchers.get(job.source_dir) is job:
+                    self.watch_changes.setdefault(job.source_dir, []).append(data)
+                    self.apply_changes(job.source_dir)
+                continue
+            if self.imports.get(job.source_dir) is not job:
+                # source was deleted meanwhile
+                continue
+            if kind == 'records':
+                self.add_records(job, data)
+            elif kind == 'found':
+                job.found = data
+            elif kind == 'done':
+                self.finish_import(job)
+        self.update_progress()
+        if self.imports or self.watchers:
+            self.schedule_poll()
+        if not self.imports:
+            self.progress_frame.grid_remove()
+
+    def add_records(self, job, records):
+        """Insert a batch of (filename, seconds since the epoch) from an
+        import into list_data and the outputs listbox at their sorted places.
+        Files the import updates replace their items, keeping any override.
+        """
+        source_data = self.sources_data[job.source_dir]
+        new_items = []
+        if job.changed:
+            listed = dict((x.filename, x) for x in self.list_data
+                          if x.id == job.source_dir and x.filename in job.changed)
+        for file, seconds in records:
+            cur_item = self.OutputsListData(job.source_dir, file, source_data, datetime.fromtimestamp(seconds))
+            if job.changed and file in job.changed:
+                old_item = listed.get(file)
+                if old_item is None:
+                    # the user took it off the outputs
+                    continue
+                if old_item.is_overriden():
+                    cur_item.dt = old_item.dt
+                ndx = self.list_data.index(old_item)
+                del self.list_data[ndx]
+                self.listbox_output.delete(ndx)
+            new_items.append(cur_item)
+        keys = [x.dt for x in self.list_data]
+        for cur_item in sorted(new_items, key=attrgetter('dt')):
+            # after any equal ones, like the sort in update_outputs
+            ndx = bisect_right(keys, cur_item.dt)
+            keys.insert(ndx, cur_item.dt)
+            self.list_data.insert(ndx, cur_item)
+            self.listbox_output.insert(ndx, cur_item)
+            self.listbox_output.itemconfig(ndx, cur_item.colors)
+        job.added += len(records)
+
+    def finish_import(self, job):
+        del self.imports[job.source_dir]
+        if not job.names:
+            # found no images, or was cancelled before it found any
+            keys = [self.get_source_key(i) for i in range(self.listbox_sources.size())]
+            self.delete_source(keys.index(job.source_dir))
+            if not job.cancel.is_set():
+                logging.warn('"{}" does not contain any images'.format(job.source_dir))
+                showerror(title="Source selection error", message='"{}" does not contain any images'.format(job.source_dir))
+            return
+        if job.cancel.is_set():
+            logging.info('Import of "{}" cancelled after {} of {} files'.format(
+                job.source_dir, job.added, len(job.names)))
+        # what the watcher compares the source with.  Files a cancelled import
+        # didn't get to count too, or watching would import them after all.
+        files = self.sources_data[job.source_dir].files
+        for file in job.names:
+            files[file] = (job.stats or {}).get(file)
+        if self.watch_var.get() and job.source_dir not in self.watchers:
+            self.start_watching(job.source_dir)
+        if job.changed is not None:
+            # changes of a watched source, they're in place already
+            self.apply_changes(job.source_dir)
+            return
+        # files came in as they were read.  Put the source's files back in
+        # directory order, after the sources already imported and before the
+        # ones still importing, so equal times end up the same way every time.
+        order = dict((file, i) for i, file in enumerate(job.names))
+        list_data = ([x for x in self.list_data if x.id not in self.imports and x.id != job.source_dir] +
+                     sorted([x for x in self.list_data if x.id == job.source_dir],
+                            key=lambda x: order[x.filename]) +
+                     [x for x in self.list_data if x.id in self.imports])
+        list_data.sort(key=attrgetter('dt'))
+        if any(a is not b for a, b in zip(list_data, self.list_data)):
+            self.list_data = list_data
+            self.update_outputs()
+
+    def update_progress(self):
+        jobs = self.imports.values()
+        # job.names is None while the job is still finding its files
+        finding = sum(job.found for job in jobs if job.names is None)
+        total = sum(len(job.names) for job in jobs if job.names is not None)
+        done = sum(job.added for job in jobs)
+        if any(job.names is None for job in jobs) and not done:
+            self.progress_label.config(text="Finding images: {} files".format(finding + total))
+            return
+        if not total:
+            return
+        elapsed = time.time() - min(job.start_time for job in self.imports.values())
+        self.progress_label.config(text="Importing {} of {} files ({:.0f} files/s)".format(
+            done, total, done / max(elapsed, 0.001)))
+        self.progress_bar.config(maximum=total, value=done)
+
+    def handle_cancel_import(self):
+        # the imports stop soon after, what they read so far stays
+        for job in self.imports.values():
+            job.cancel.set()
+
+    def handle_watch(self):
+        watch = self.watch_var.get()
+        self.ini_parser.set(SECT_SETTINGS, OPT_WATCH, "true" if watch else "false")
+        self.write_ini_file()
+        if watch:
+            # sources still importing start when they're done
+            for source_dir in self.sources_data:
+                if source_dir not in self.imports:
+                    self.start_watching(source_dir)
+        else:
+            self.stop_watching()
+
+    def start_watching(self, source_dir):
+        """Watch a source in the background, from the files it has now."""
+        logging.info('Watching source: "{}"'.format(source_dir))
+        watcher = WatchThread(
+            source_dir, self.sources_data[source_dir].files, self.import_queue,
+            self.ini_parser.getfloat(SECT_SETTINGS, OPT_WATCH_SECONDS),
+            self.source_filter(), self.ini_parser.getint(SECT_SETTINGS, OPT_WALK_THREADS),
+            self.ini_parser.getboolean(SECT_SETTINGS, OPT_WATCH_INOTIFY))
+        self.watchers[source_dir] = watcher
+        watcher.start()
+        self.schedule_poll()
+
+    def stop_watching(self):
+        for watcher in self.watchers.values():
+            watcher.close()
+        self.watchers = {}
+        self.watch_changes = {}
+
+    def apply_changes(self, source_dir):
+        """Take the files that were removed from a watched source out and
+        import the ones that were added or changed, unless the source is
+        importing.  Then its changes wait until the import is done.
+        """
+        pending = self.watch_changes.get(source_dir)
+        while pending and source_dir not in self.imports:
+            changes = pending.pop(0)
+            if changes.removed:
+                self.remove_files(source_dir, changes.removed)
+            if changes.added or changes.changed:
+                self.process_new_source(source_dir, changes.added + changes.changed,
+                                        changes.stats, changes.changed)
+        if not pending:
+            self.watch_changes.pop(source_dir, None)
+
+    def remove_files(self, source_dir, files):
+        """Take files of a source that are gone off the outputs."""
+        files = set(files)
+        for ndx in reversed(range(len(self.list_data))):
+            cur_item = self.list_data[ndx]
+            if cur_item.id == source_dir and cur_item.filename in files:
+                del self.list_data[ndx]
+                self.listbox_output.delete(ndx)
+        source_files = self.sources_data[source_dir].files
+        for file in files:
+            source_files.pop(file, None)
         
     def update_outputs(self):
         self.list_data.sort(key=attrgetter('dt'))
@@ -489,7 +827,9 @@ class PicTimelineApp(Frame):
     def handle_do_the_thing(self):
         output_path = self.text_path.get(1.0, END).strip()
         prefix = self.file_prefix.get()
-        if not output_path:
+        if self.imports:
+            showerror(title="Import in progress", message='Wait for the sources to finish importing')
+        elif not output_path:
             logging.warn('Output path is not set.')
             showerror(title="Output path error", message='Enter a path for the output files')
             self.handle_set_output_path()
@@ -506,8 +846,8 @@ class PicTimelineApp(Frame):
             showerror(title="No files to output", message='No files to process')
         else:
             ok = True
-            jpeg_files = [x for x in os.listdir(output_path) if os.path.splitext(x)[1].lower() in [".jpg", ".jpeg"]]
-            if jpeg_files:
+            image_files = [x for x in os.listdir(output_path) if os.path.splitext(x)[1].lower() in IMAGE_EXTENSIONS]
+            if image_files:
                 logging.warn('Output directory "{}" already contains image files.'.format(output_path))
                 ok = askyesno(title="Output path contains files",
                               message='"{}" already contains image files.  Do you wish to continue?'.format(output_path))
@@ -518,7 +858,9 @@ class PicTimelineApp(Frame):
     
                 for ndx, src_path in enumerate([os.path.join(cur_item.id, cur_item.filename)
                                             for cur_item in self.list_data], 1):
-                    dest_path = os.path.join(output_path, "{}{}.jpg".format(prefix, str(ndx).zfill(index_width)))
+                    # keep the extension, the output can mix formats
+                    ext = os.path.splitext(src_path)[1]
+                    dest_path = os.path.join(output_path, "{}{}{}".format(prefix, str(ndx).zfill(index_width), ext))
                     
                     # use copy2 to preserve metadata
                     shutil.copy2(src_path, dest_path)
@@ -595,11 +937,15 @@ class PicTimelineApp(Frame):
             logging.warn('Linux preview not implemented')
             showerror(title="Preview Error", message="Linux preview not implemented")
         
-root = Tk()
-root.title(APP_NAME)
-root.minsize(MIN_WIDTH, MIN_HEIGHT)
-root.geometry(DEF_SIZE)
-app = PicTimelineApp(master=root)
-# register OnExit handling so we can clean up temp files.
-root.protocol(name="WM_DELETE_WINDOW", func=app.on_window_delete)
-app.mainloop()
+# the import workers load this module too (on Windows), they mustn't start
+# another app
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    root = Tk()
+    root.title(APP_NAME)
+    root.minsize(MIN_WIDTH, MIN_HEIGHT)
+    root.geometry(DEF_SIZE)
+    app = PicTimelineApp(master=root)
+    # register OnExit handling so we can clean up temp files.
+    root.protocol(name="WM_DELETE_WINDOW", func=app.on_window_delete)
+    app.mainloop()
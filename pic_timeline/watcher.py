@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Kyle Kawamura
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Watching a source for image files that are added, changed or removed after
+it was imported (a tethered camera, photos copied in from elsewhere).
+
+Only directories are checked each poll: with pyinotify (Linux) the kernel
+says which ones had something happen, otherwise their modified times are
+compared, which is a stat per directory.  A directory that changed is
+listed again and its files' stat results compared with what's known.  A
+new or changed file is only reported once its stat stays the same for a
+poll, so files still being written aren't read half done.
+
+The app runs each SourceWatcher in a WatchThread, which sends what changed
+through the same queue as the imports.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+from discover import DEF_WALK_THREADS, PathFilter, find_images, list_dir
+from metacache import stat_key
+
+# a directory modified this recently is listed again next poll too, a file
+# added within the resolution of its modified time (2s on FAT) doesn't change it
+MTIME_SLACK = 2.0
+
+# seconds between polls
+DEF_POLL_SECONDS = 2.0
+
+# what a poll found.  added, changed and removed are paths relative to the
+# source, stats has the stat results of the added and changed ones
+Changes = namedtuple('Changes', 'added changed removed stats')
+
+# -----------------------------------------------------------------------------
+# class SourceWatcher
+#        Finds the files of a source that changed since the last poll
+# -----------------------------------------------------------------------------
+class SourceWatcher(object):
+    """Watches the files of the source root that path_filter (a
+    discover.PathFilter) lets through.  files maps the paths already
+    imported (relative to root) to their stat results, or None if they
+    aren't known, anything different on disk is in the first poll."""
+
+    def __init__(self, root, files, path_filter=None, threads=DEF_WALK_THREADS,
+                 use_inotify=True):
+        self.root = root
+        self.path_filter = path_filter or PathFilter()
+        self.threads = threads
+        # relative directory: modified time when it was last listed
+        self.dirs = {}
+        # relative path: stat key, of the files reported so far
+        self.files = {}
+        # relative path: stat key, of new or changed files not reported yet
+        self.pending = {}
+        self.dirty = set()
+        self.missing = False
+        self.watch_manager = None
+        self.notifier = None
+        if use_inotify and pyinotify is not None:
+            self.start_inotify()
+
+        found = find_images(root, include=self.path_filter, threads=threads,
+                            dir_mtimes=self.dirs)[1]
+        for rel, st in found.iteritems():
+            key = stat_key(st)
+            if rel not in files:
+                self.pending[rel] = key
+            elif files[rel] is None or stat_key(files[rel]) == key:
+                self.files[rel] = key
+            else:
+                self.files[rel] = stat_key(files[rel])
+                self.pending[rel] = key
+        self.removed = [rel for rel in files if rel not in found]
+        logging.info(u'Watching "{}" ({}): {} files in {} directories'.format(
+            root, 'inotify' if self.notifier else 'polling', len(found),
+            len(self.dirs)))
+
+    def start_inotify(self):
+        """Have the kernel report changes in the watched directories, fall
+        back to polling if it can't (too many directories for
+        max_user_watches, a file system that doesn't support it)."""
+        mask = (pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+                pyinotify.IN_CLOSE_WRITE | pyinotify.IN_ATTRIB |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO |
+                pyinotify.IN_DELETE_SELF)
+        try:
+            watch_manager = pyinotify.WatchManager()
+            notifier = pyinotify.Notifier(watch_manager, self.on_event, timeout=0)
+            recursive = self.path_filter.recursive
+            watches = watch_manager.add_watch(
+                self.root, mask, rec=recursive, auto_add=recursive, quiet=True,
+                exclude_filter=lambda path: not self.path_filter.dir(self.relative(path)))
+        except (OSError, IOError, pyinotify.PyinotifyError) as e:
+            logging.warn(u'Failed to watch "{}", polling instead: {}'.format(self.root, e))
+            return
+        # excluded directories come back with a negative descriptor too
+        failed = [path for path, wd in watches.iteritems()
+                  if wd < 0 and self.path_filter.dir(self.relative(path))]
+        if failed:
+            logging.warn(u'Failed to watch "{}", polling instead'.format(self.root))
+            notifier.stop()
+            return
+        self.watch_manager = watch_manager
+        self.notifier = notifier
+
+    def close(self):
+        if self.notifier:
+            self.notifier.stop()
+            self.notifier = None
+
+    def relative(self, path):
+        rel = os.path.relpath(path, self.root)
+        return '' if rel == os.curdir else rel
+
+    def on_event(self, event):
+        # event.path is the watched directory something happened in
+        self.dirty.add(self.relative(event.path))
+
+    def changed_dirs(self):
+        """Return the directories that may have changed since they were
+        listed, parents first."""
+        if not os.path.isdir(self.root):
+            # a card that was taken out: its files are kept until it's back
+            if not self.missing:
+                logging.info(u'"{}" is gone'.format(self.root))
+                self.missing = True
+            return []
+        if self.missing:
+            logging.info(u'"{}" is back'.format(self.root))
+            self.missing = False
+            if self.watch_manager:
+                self.close()
+                self.start_inotify()
+            self.dirty = set()
+            return sorted(self.dirs)
+        if self.notifier:
+            if self.notifier.check_events(timeout=0):
+                self.notifier.read_events()
+                self.notifier.process_events()
+            dirty, self.dirty = self.dirty, set()
+        else:
+            dirty = set()
+            now = time.time()
+            for rel_dir, mtime in self.dirs.items():
+                try:
+                    st = os.stat(os.path.join(self.root, rel_dir))
+                except os.error:
+                    dirty.add(rel_dir)
+                    continue
+                if st.st_mtime != mtime or now - mtime < MTIME_SLACK:
+                    dirty.add(rel_dir)
+        return sorted(rel_dir for rel_dir in dirty if rel_dir in self.dirs)
+
+    def poll(self):
+        """Return the Changes since the last poll (or since the import, the
+        first time)."""
+        removed, self.removed = self.removed, []
+        fresh = set()
+        for rel_dir in self.changed_dirs():
+            self.rescan(rel_dir, removed, fresh)
+
+        added = []
+        changed = []
+        stats = {}
+        for rel in self.pending.keys():
+            if rel in fresh:
+                # wait a poll to see if it's still being written
+                continue
+            try:
+                st = os.stat(os.path.join(self.root, rel))
+            except os.error:
+                # the rescan of its directory will say if it's gone
+                del self.pending[rel]
+                continue
+            key = stat_key(st)
+            if key != self.pending[rel]:
+                self.pending[rel] = key
+                continue
+            del self.pending[rel]
+            (changed if rel in self.files else added).append(rel)
+            self.files[rel] = key
+            stats[rel] = st
+        if added or changed or removed:
+            logging.info(u'"{}": {} added, {} changed, {} removed'.format(
+                self.root, len(added), len(changed), len(removed)))
+        return Changes(sorted(added), sorted(changed), removed, stats)
+
+    def note(self, rel, st, fresh):
+        """A file was seen with stat result st."""
+        key = stat_key(st)
+        if self.files.get(rel) == key:
+            self.pending.pop(rel, None)
+        elif self.pending.get(rel) != key:
+            self.pending[rel] = key
+            fresh.add(rel)
+
+    def rescan(self, rel_dir, removed, fresh):
+        """List a directory again, files that are gone are added to removed
+        and new or changed ones are noted."""
+        path = os.path.join(self.root, rel_dir)
+        try:
+            mtime = os.stat(path).st_mtime
+            files, subdirs = list_dir(path)
+        except (IOError, OSError) as e:
+            logging.info(u'"{}" is gone: {}'.format(path, e))
+            self.drop_dir(rel_dir, removed)
+            return
+        self.dirs[rel_dir] = mtime
+
+        seen = set()
+        for name, st in files:
+            rel = os.path.join(rel_dir, name)
+            if self.path_filter.file(rel):
+                seen.add(rel)
+                self.note(rel, st, fresh)
+        for rel in [x for x in self.files if os.path.dirname(x) == rel_dir and x not in seen]:
+            del self.files[rel]
+            removed.append(rel)
+        for rel in [x for x in self.pending if os.path.dirname(x) == rel_dir and x not in seen]:
+            del self.pending[rel]
+
+        subdirs = set(os.path.join(rel_dir, name) for name in subdirs)
+        for rel in [x for x in self.dirs if x and os.path.dirname(x) == rel_dir and x not in subdirs]:
+            self.drop_dir(rel, removed)
+        for rel in sorted(subdirs):
+            if rel not in self.dirs and self.path_filter.dir(rel):
+                found = find_images(self.root, include=self.path_filter, threads=self.threads,
+                                    start=rel, dir_mtimes=self.dirs)[1]
+                for file_rel, st in found.iteritems():
+                    self.note(file_rel, st, fresh)
+
+    def drop_dir(self, rel_dir, removed):
+        """Forget a directory that's gone and everything that was in it."""
+        def inside(rel):
+            return not rel_dir or rel == rel_dir or rel.startswith(rel_dir + os.sep)
+        for rel in [x for x in self.dirs if inside(x)]:
+            del self.dirs[rel]
+        for rel in [x for x in self.files if inside(x)]:
+            del self.files[rel]
+            removed.append(rel)
+        for rel in [x for x in self.pending if inside(x)]:
+            del self.pending[rel]
+
+# -----------------------------------------------------------------------------
+# class WatchThread
+#        Background thread watching one source
+# -----------------------------------------------------------------------------
+class WatchThread(threading.Thread):
+    """Creates a SourceWatcher for source_dir (which walks it) and polls it
+    every poll_seconds until closed.  The Changes it finds are put on queue
+    as (thread, 'changes', changes), for the app to apply.  files is copied,
+    the app can go on changing its own."""
+
+    def __init__(self, source_dir, files, queue, poll_seconds=DEF_POLL_SECONDS,
+                 path_filter=None, threads=DEF_WALK_THREADS, use_inotify=True):
+        threading.Thread.__init__(self, name='watch ' + source_dir)
+        self.daemon = True
+        self.source_dir = source_dir
+        self.files = dict(files)
+        self.queue = queue
+        self.poll_seconds = poll_seconds
+        self.path_filter = path_filter
+        self.threads = threads
+        self.use_inotify = use_inotify
+        self.stop = threading.Event()
+
+    def close(self):
+        """Stop watching, soon after."""
+        self.stop.set()
+
+    def run(self):
+        try:
+            watcher = SourceWatcher(self.source_dir, self.files, self.path_filter,
+                                    self.threads, self.use_inotify)
+        except Exception:
+            logging.exception(u'Failed to watch "{}"'.format(self.source_dir))
+            return
+        self.files = None
+        try:
+            while not self.stop.wait(self.poll_seconds):
+                try:
+                    changes = watcher.poll()
+                except Exception:
+                    logging.exception(u'Failed to check "{}"'.format(self.source_dir))
+                    continue
+                if changes.added or changes.changed or changes.removed:
+                    self.queue.put((self, 'changes', changes))
+        finally:
+            watcher.close()